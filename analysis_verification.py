@@ -1,5 +1,5 @@
 import datetime, copy, argparse
-import call_utils, utils, batch_utils
+import call_utils, async_call_utils, utils, batch_utils, prompt_utils
 
 parser = argparse.ArgumentParser(
     description='Runs Analysis Verification on Shelter Check dataset')
@@ -12,67 +12,78 @@ parser.add_argument('--model', required=True,
                     help='which LLM to call or prepare to call')
 parser.add_argument('--callnow', action="store_true",
                     help='whether to make the calls right now or in batch')
+parser.add_argument('--concurrency', default=async_call_utils.DEFAULT_CONCURRENCY, type=int,
+                    help='with --callnow, how many calls to make at the same time')
+parser.add_argument('--cache_prefix', action="store_true",
+                    help='whether to mark the per-strategy preamble as a cached prefix (where the provider supports it)')
 args = parser.parse_args()
 print("args=", args)
 start_timestamp = call_utils.log_arbitrary("analysis_verification, with args=" + str(args))
 
-list_ids_prompts = [] # These will be actually passed to the LLM; list of 2-tuples of (id, prompt)
-for filename in utils.get_list_filenames():
-    if args.num is None or filename == utils.get_filename_from_prefix(args.num):
-        authorities_str, background_str, goal_str, strategy_str, analysis_str, \
-            adversarial_step_str, primary_area_str, strategy_type_str = utils.parse_file(filename)
+# The prompt is compiled once; the per-strategy part is bound once per strategy, and then each analysis
+# step is rendered from that.
+if args.standard == 'viable':
+    question = "Even if it is not necessarily correct, is the following analysis potentially viable, " + \
+        "based on the information and authorities provided? Spell out your reasoning in detail, and " + \
+        "resolve all reasonable doubts in favor of the analysis being viable.  " + \
+        "Here is the analysis to weigh: "
+elif args.standard == 'correct':
+    question = "Is the following analysis correct, based on the information and authorities provided? " + \
+        "Spell out your reasoning in detail. Here is the analysis to weigh: "
+else:
+    assert False
+PROMPT_TEMPLATE = prompt_utils.PromptTemplate(
+    "You will be verifying some legal analysis of a tax strategy, given authorities and factual background.  " +
+    "{ignore_doctrines}\n\nHere are the authorities you will be applying:\n\n{authorities}{background}" +
+    "\n\nHere is the strategy:\n\n{strategy}\n\n{assumed_analysis}{question}{analysis_step}"
+).bind(ignore_doctrines=utils.IGNORE_DOCTRINES_PROMPT_TEXT, question=question)
 
-        analysis_steps = utils.strip_numbering(analysis_str)
+# Generates the (id, prompt) pairs that will be actually passed to the LLM, one at a time, so that they
+# can be streamed straight to the batch file
+def generate_ids_prompts():
+    for filename in utils.get_list_filenames():
+        if args.num is None or filename == utils.get_filename_from_prefix(args.num):
+            record = utils.load_strategy(filename)
+            strategy_template = PROMPT_TEMPLATE.bind(
+                authorities=record.authorities_str,
+                background=prompt_utils.optional_section("\n\nHere is the background:\n\n", record.background_str),
+                strategy=record.strategy_str)
+            analysis_steps = record.analysis_steps
 
-        prompt_start = "You will be verifying some legal analysis "
-        prompt_start += "of a tax strategy, given authorities and factual background.  "
-        prompt_start += utils.IGNORE_DOCTRINES_PROMPT_TEXT
-        prompt_start += "\n\nHere are the authorities you will be applying:\n\n" + authorities_str
-        if len(background_str.strip()) > 0:
-            prompt_start += "\n\nHere is the background:\n\n" + background_str
-        prompt_start += "\n\nHere is the strategy:\n\n"
-        prompt_start += strategy_str
-        prompt_start += "\n\n"
+            for idx_analysis, analysis_step in enumerate(analysis_steps):
+                assumed_analysis = ""
+                if idx_analysis > 0:
+                    assumed_analysis = "Assume that the following analysis is " + args.standard + ":\n" + \
+                        "".join([prev_analysis + "\n" for prev_analysis in analysis_steps[:idx_analysis]]) + "\n"
+                if args.cache_prefix:
+                    prompt = strategy_template.render_split(assumed_analysis=assumed_analysis, analysis_step=analysis_step)
+                else:
+                    prompt = strategy_template.render(assumed_analysis=assumed_analysis, analysis_step=analysis_step)
 
-        for idx_analysis, analysis_step in enumerate(analysis_steps):
-            prompt = prompt_start
-
-            if idx_analysis > 0:
-                prompt += "Assume that the following analysis is " + args.standard + ":\n"
-                for prev_analysis in range(idx_analysis):
-                    prompt += analysis_steps[prev_analysis] + "\n"
-                prompt += "\n"
-
-            if args.standard == 'viable':
-                prompt += "Even if it is not necessarily correct, is the following analysis potentially viable, " + \
-                "based on the information and authorities provided? Spell out your reasoning in detail, and " + \
-                "resolve all reasonable doubts in favor of the analysis being viable.  " + \
-                "Here is the analysis to weigh: " + analysis_step
-            elif args.standard == 'correct':
-                prompt += "Is the following analysis correct, based on the information and authorities provided? " + \
-                "Spell out your reasoning in detail. Here is the analysis to weigh: " + analysis_step
-            else:
-                assert False
-
-            id = "Strategy_" + utils.get_prefix_from_filename(filename) + \
-                "_Analysis_" + str(idx_analysis+1)
-            list_ids_prompts.append((id, prompt))
+                id = "Strategy_" + utils.get_prefix_from_filename(filename) + \
+                    "_Analysis_" + str(idx_analysis+1)
+                yield id, prompt
 
 if args.callnow:
     num_correct = 0
     total_called = 0
-    for id, prompt in list_ids_prompts:
+    num_failed = 0
+    ids_prompts = list(generate_ids_prompts())
+    results = async_call_utils.call_api_yesno_many([prompt_utils.prompt_text(prompt) for id, prompt in ids_prompts],
+                                                   args.model, "analysis_verification: " + str(args), args.concurrency)
+    for (id, prompt), (correct, explanation, timestamp) in zip(ids_prompts, results):
         print("********: id=", id)
         print(prompt)
-        correct, explanation, timestamp = \
-            call_utils.call_api_yesno(prompt, args.model, "analysis_verification: " + str(args))
         print("TIMESTAMP =", timestamp)
         print("CORRECT=", correct)
         print(explanation)
+        if correct is None: # the call failed
+            num_failed += 1
+            continue
         total_called += 1
         if correct:
             num_correct += 1
-    print("num_correct =", num_correct, "; total_called =", total_called)
+    print("num_correct =", num_correct, "; total_called =", total_called, "; num_failed =", num_failed)
 else: # then we are creating a batch file
     if args.num is None:
         testname = batch_utils.get_testname("analysis_verification", args.model)
@@ -82,5 +93,5 @@ else: # then we are creating a batch file
     batch_filename = batch_utils.write_batch_file(testname,
                                                   batch_utils.POSTFIX_UPLOAD1,
                                                   args.model,
-                                                  list_ids_prompts)
+                                                  generate_ids_prompts())
     batch_utils.upload_file_and_start(batch_filename, args.model)
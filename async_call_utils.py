@@ -0,0 +1,151 @@
+# This is the code for making many immediate calls concurrently (e.g. for --callnow), rather than one at a
+# time.  The calls share long-lived async clients (see call_utils.get_client), at most a given number are
+# in flight at once, and each provider's request and token rate limits are kept to.  The results come back
+# in the same order as the prompts, however the calls happen to finish.
+import asyncio, collections, copy, time
+import call_utils, retry_utils, cache_utils
+
+DEFAULT_CONCURRENCY = 8
+
+# Per-provider limits, as (requests per minute, input tokens per minute).  These depend on the account's
+# usage tier, so set them to your own limits.
+RATE_LIMITS = {
+    "openai": (500, 800000),
+    "anthropic": (50, 40000),
+}
+
+# Keeps to a limit on requests and tokens over any minute.  Callers wait their turn, first come first served.
+class RateLimiter:
+    def __init__(self, requests_per_minute:int, tokens_per_minute:int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._calls = collections.deque() # (time, tokens) of the calls in the last minute
+        self._tokens = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens:int):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while len(self._calls) > 0 and self._calls[0][0] <= now - 60.0:
+                    self._tokens -= self._calls.popleft()[1]
+                # a single call bigger than the token limit is let through on its own, rather than never
+                if len(self._calls) < self.requests_per_minute and \
+                        (self._tokens + tokens <= self.tokens_per_minute or len(self._calls) == 0):
+                    self._calls.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                await asyncio.sleep(self._calls[0][0] + 60.0 - now)
+
+# A rough count of the input tokens of a call, for rate limiting (about 4 characters per token)
+def estimate_tokens(messages) -> int:
+    return sum([len(str(message["content"])) for message in messages]) // 4 + 1
+
+# Runs the calls of one batch of work, sharing the async clients, the concurrency limit and the rate limiters
+class CallEngine:
+    def __init__(self, concurrency:int = DEFAULT_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._rate_limiters = {provider: RateLimiter(*limits) for provider, limits in RATE_LIMITS.items()}
+
+    # The async version of call_utils.raw_call, with the same retry policy and response cache.  If on_response
+    # is passed, it is called with each response the SDK returns (e.g. to record its usage).
+    async def raw_call(self, messages_arg, model:str, on_response = None) -> str:
+        cache = cache_utils.get_cache()
+        if cache is not None:
+            cache_key = cache_utils.make_key(cache_utils.KIND_LIVE, call_utils.get_cache_request(messages_arg, model))
+            cached_rv = cache.get(cache_key)
+            if cached_rv is not None:
+                return cached_rv
+        retry_state = None
+        count_unresponsive = 0
+        while count_unresponsive < 10:
+            messages = copy.deepcopy(messages_arg)  # do deepcopy to keep any changes from interfering with calling function's copy
+            rv = None
+            try:
+                provider, timeout, api, call_kwargs, get_text = call_utils.get_call_spec(messages, model)
+                if retry_state is None:
+                    retry_state = retry_utils.RetryState(provider, model)
+                await asyncio.sleep(retry_state.get_wait()) # if the circuit breaker is open
+                await self._rate_limiters[provider].acquire(estimate_tokens(messages))
+                async with self._semaphore:
+                    response = await call_utils.get_create_function(
+                        call_utils.get_client(provider, timeout, is_async=True), api)(**call_kwargs)
+                if on_response is not None:
+                    on_response(response)
+                rv = get_text(response)
+                retry_state.record_success()
+
+            except Exception as e:  # Catches most exceptions; often LLM APIs have temporary hiccups
+                delay = None if retry_state is None else retry_state.get_retry_delay(e)
+                if delay is None:
+                    raise  # re-throw it, since it is not worth retrying (again)
+                await asyncio.sleep(delay) # hopefully LLM API hiccup will be resolved
+            else:
+                if not call_utils.is_unresponsive(rv):
+                    if cache is not None:
+                        cache.put(cache_key, rv)
+                    return rv
+                else:
+                    count_unresponsive += 1
+                    print("Retrying call due to nonresponsive response, number", count_unresponsive, rv)
+
+    # The async version of call_utils.call_api_yesno
+    async def call_api_yesno(self, prompt:str, model:str, context:str) -> (bool, str, str):
+        count_not_yesno = 0
+        while count_not_yesno < 10:
+            messages = [{"role": "user", "content": prompt}]
+            response1 = await self.raw_call(messages, model)
+            answer = call_utils.parse_yesno(response1)
+            if answer is not None:
+                timestamp = call_utils.log_messages_freeform(messages, context)
+                return answer, response1, timestamp
+            print("Making Yes/No Followup Call")
+            messages.append({"role": "assistant", "content": response1}) # store to re-call and to write to log
+            messages.append({"role": "user", "content": call_utils.YESNO_FOLLOW_UP})
+            response2 = await self.raw_call(messages, model) # call again!
+            messages.append({"role": "assistant", "content": response2}) # store for writing to log
+            answer = call_utils.parse_yesno(response2, is_follow_up=True)
+            if answer is not None:
+                timestamp = call_utils.log_messages_freeform(messages, context)
+                return answer, response1, timestamp
+            count_not_yesno += 1
+            print("Retrying call due to failure to get yes or no, number",
+                  count_not_yesno, "response instead was:", response2)
+        # If we are here, there were too many nonresponsive
+        print("TOO MANY NONRESPONSIVE")
+        return False, response1, ""
+
+# Runs the calls that make_calls(engine) makes on a new engine, returning their results in order.  A call
+# that raises gives failed_result instead, once all the calls are done, so that one failure does not lose
+# the results of the others.
+def run_calls(make_calls, concurrency:int, failed_result = None) -> list:
+    async def run_all():
+        return await asyncio.gather(*make_calls(CallEngine(concurrency)), return_exceptions=True)
+    call_utils.clear_async_clients() # async clients are bound to the event loop they were first used in
+    try:
+        results = asyncio.run(run_all())
+    finally:
+        call_utils.clear_async_clients()
+    failures = [result for result in results if isinstance(result, BaseException)]
+    for e in failures:
+        print("EXCEPTION in call", f", Error Type: {type(e).__name__} {e}; giving up on this call")
+    if len(failures) > 0:
+        print("FAILED CALLS:", len(failures), "of", len(results))
+    return [failed_result if isinstance(result, BaseException) else result for result in results]
+
+# Gets Yes/No answers to many prompts concurrently.  Returns the (correct, explanation, timestamp) results
+# of call_utils.call_api_yesno, in the same order as the prompts; a call that fails gives (None, "", "").
+def call_api_yesno_many(prompts, model:str, context:str, concurrency:int = DEFAULT_CONCURRENCY) -> list:
+    return run_calls(lambda engine: [engine.call_api_yesno(prompt, model, context) for prompt in prompts],
+                     concurrency, (None, "", ""))
+
+# Gets the responses to many single-message prompts concurrently (e.g. to re-ask what a batch failed to
+# answer), in the same order as the prompts.  A call that fails (or gets only nonresponsive replies) gives
+# None, rather than losing the other calls' responses.  If on_response is passed, it is called with the number
+# of the prompt and each response the SDK returns for it.
+def call_api_many(prompts, model:str, concurrency:int = DEFAULT_CONCURRENCY, on_response = None) -> list:
+    async def call(engine, prompt_num, prompt):
+        return await engine.raw_call([{"role": "user", "content": prompt}], model,
+                                     None if on_response is None else lambda response: on_response(prompt_num, response))
+    return run_calls(lambda engine: [call(engine, prompt_num, prompt) for prompt_num, prompt in enumerate(prompts)],
+                     concurrency)
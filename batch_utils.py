@@ -3,30 +3,63 @@ import openai
 import anthropic
 from google.cloud import storage # batch processing by VertexAI requires loading to/from Google Cloud
 from google.oauth2 import service_account
+from google.auth.credentials import AnonymousCredentials # for mock_batch_server.py
 from google import genai
 from google.genai.types import CreateBatchJobConfig, JobState, HttpOptions
 from google.cloud import aiplatform_v1 # used to actually access the output directory
-import datetime, json, call_utils, os
+import datetime, json, call_utils, prompt_utils, response_utils, pipeline_utils, cache_utils, preflight_utils, os
+from concurrent.futures import ThreadPoolExecutor
+import threading, mmap
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path="sheltercheck.env", override=True)
 
-DIR_BATCH_UPLOADS = "Batch_Uploads/"
-DIR_BATCH_DOWNLOADS = "Batch_Downloads/"
+DIR_BATCH_UPLOADS = call_utils.get_run_path("Batch_Uploads/")
+DIR_BATCH_DOWNLOADS = call_utils.get_run_path("Batch_Downloads/")
+if call_utils.MOCK_BATCH_SERVER: # the scratch directories are new
+    os.makedirs(DIR_BATCH_UPLOADS, exist_ok=True)
+    os.makedirs(DIR_BATCH_DOWNLOADS, exist_ok=True)
 POSTFIX_UPLOAD1 = "_upload1"
 POSTFIX_UPLOAD2 = "_upload2"
 POSTFIX_DOWNLOAD1 = "_download1"
 POSTFIX_DOWNLOAD2 = "_download2"
+POSTFIX_LOCAL2 = "_local2" # the answers resolved locally, rather than in the second batch (e.g. by binary_answers_clarify.py)
 
 GOOGLE_PROJECT  = "sheltercheck"
 GOOGLE_LOCATION = os.getenv("GOOGLE_LOCATION")
 GOOGLE_BUCKET   = os.getenv("GOOGLE_BUCKET")
 GOOGLE_OUTPUT_PREFIX = "batch‑out/"       # GCS folder for results
 
+# Provider limits on a single batch, as (max number of requests, max bytes of requests).  The byte limits
+# are a bit under the documented ones (200 MB for OpenAI, 256 MB for Anthropic), as they count bytes
+# slightly differently than we do.  Bigger runs are split into shards that are submitted concurrently.
+OPENAI_BATCH_LIMITS = (50000, 190 * 1024 * 1024)
+CLAUDE_BATCH_LIMITS = (100000, 240 * 1024 * 1024)
+GOOGLE_BATCH_LIMITS = (200000, 1000 * 1024 * 1024)
+MAX_CONCURRENT_SUBMISSIONS = 8
+BATCH_ID_SEPARATOR = "," # a sharded run's batch id is the shards' batch ids joined by this
+CACHED_ONLY_BATCH_ID_PREFIX = "cached_" # starts the batch id of a run with nothing to submit (see BatchFileWriter)
+CROSS_RUN_DEDUP_DAYS = float(os.getenv("BATCH_DEDUP_DAYS", "7")) # 0 turns off reusing other runs' responses
+
 def get_testname(test:str, model:str) -> str:
     assert " " not in test and ":" not in test and ";" not in test, "Prohibited for files"
     return test + "_" + model + "_" + str(datetime.datetime.now().strftime("%Y-%m-%dat%H.%M.%S"))
 
+# The upload file whose responses a download file holds
+def get_upload_filename(download_filename:str) -> str:
+    postfix = POSTFIX_UPLOAD2 if download_filename.endswith(POSTFIX_DOWNLOAD2 + ".jsonl") else POSTFIX_UPLOAD1
+    return DIR_BATCH_UPLOADS + get_testname_from_filename(download_filename) + postfix + ".jsonl"
+
+# The test name that an upload or download file is named after
+def get_testname_from_filename(filename:str) -> str:
+    testname = os.path.basename(filename)
+    assert testname.endswith(".jsonl")
+    testname = testname[:-len(".jsonl")]
+    for postfix in [POSTFIX_UPLOAD1, POSTFIX_UPLOAD2, POSTFIX_DOWNLOAD1, POSTFIX_DOWNLOAD2]:
+        if testname.endswith(postfix):
+            return testname[:-len(postfix)]
+    return testname
+
 def is_openai(model:str) -> bool:
     return model.startswith("gpt-") or model.startswith("o3")
 
@@ -38,72 +71,455 @@ def is_claude(model:str) -> bool:
 def is_google(model:str) -> bool:
     return model.startswith("gemini")
 
-def write_batch_file(testname:str, postfix:str, model:str, list_ids_prompts:list):
-    assert " " not in testname and ":" not in testname and ";" not in testname, "Prohibited for files"
-    assert len([x[0] for x in list_ids_prompts]) == len(set([x[0] for x in list_ids_prompts])), "need unique ids!"
-    filename = DIR_BATCH_UPLOADS + testname + postfix + ".jsonl"
-
-    with open(filename, "w", encoding="utf‑8") as f:
-        for i, id_prompt in enumerate(list_ids_prompts):
-            assert len(id_prompt) in [2, 4] # only supported sizes
+# Makes the content of a user message from a prompt.  For a SplitPrompt, Claude needs its shared prefix
+# marked for caching, whereas OpenAI and Gemini cache shared prefixes automatically.
+def make_user_content(prompt, model:str):
+    if type(prompt) == prompt_utils.SplitPrompt and is_claude(model):
+        return [{"type": "text", "text": prompt.prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": prompt.suffix}]
+    return prompt_utils.prompt_text(prompt)
+
+# The reverse of make_user_content, for reading back prompts from an uploaded file
+def read_user_content(content):
+    if type(content) == list:
+        assert len(content) == 2 and content[0]["type"] == "text" and content[1]["type"] == "text"
+        return prompt_utils.SplitPrompt(content[0]["text"], content[1]["text"])
+    return content
+
+# Returns a function that makes the request line for one item, where an item is either (id, prompt) or
+# (id, prompt1, response, prompt2).  The provider is checked once here, rather than for every item.
+def get_request_maker(model:str):
+    if is_openai(model) or is_claude(model):
+        def make_messages(id_prompt):
             if len(id_prompt) == 2:
-                if is_openai(model) or is_claude(model):
-                    messages = [ {"role": "user", "content": id_prompt[1]}]
-                elif is_google(model):
-                    messages = [{"role": "user",
-                                 "parts": [{"text": id_prompt[1]}]
-                                 }]
-
-            elif len(id_prompt) == 4:
-                if is_openai(model) or is_claude(model):
-                    messages = [
-                        {"role": "user", "content": id_prompt[1]},
-                        {"role": "assistant", "content": id_prompt[2]},
-                        {"role": "user", "content": id_prompt[3]}
-                    ]
-                elif is_google(model):
-                    messages = [
-                        {"role": "user", "parts": [{"text": id_prompt[1]}]},
-                        {"role": "model", "parts": [{"text": id_prompt[2]}]},
-                        {"role": "user", "parts": [{"text": id_prompt[3]}]}
-                    ]
-            else:
-                assert False, "Size not supported"
-
-            if is_openai(model):
-                request_line = {
-                    "custom_id": id_prompt[0],  # must be unique
+                return [{"role": "user", "content": make_user_content(id_prompt[1], model)}]
+            assert len(id_prompt) == 4, "Size not supported"
+            return [{"role": "user", "content": make_user_content(id_prompt[1], model)},
+                    {"role": "assistant", "content": id_prompt[2]},
+                    {"role": "user", "content": id_prompt[3]}]
+    elif is_google(model):
+        def make_messages(id_prompt):
+            if len(id_prompt) == 2:
+                return [{"role": "user", "parts": [{"text": prompt_utils.prompt_text(id_prompt[1])}]}]
+            assert len(id_prompt) == 4, "Size not supported"
+            return [{"role": "user", "parts": [{"text": prompt_utils.prompt_text(id_prompt[1])}]},
+                    {"role": "model", "parts": [{"text": id_prompt[2]}]},
+                    {"role": "user", "parts": [{"text": id_prompt[3]}]}]
+    else:
+        assert False, "not supported"
+
+    if is_openai(model):
+        def make_request_line(id_prompt):
+            return {"custom_id": id_prompt[0],  # must be unique
                     "method": "POST",
                     "url": "/v1/chat/completions",
                     "body": {
                         "model": model,
-                        "messages": messages,
+                        "messages": make_messages(id_prompt),
                         "reasoning_effort": "high"
-                    }
-                }
-            elif is_claude(model):
-                request_line = {
-                    "custom_id": id_prompt[0],     # unique per request
+                    }}
+    elif is_claude(model):
+        def make_request_line(id_prompt):
+            return {"custom_id": id_prompt[0],  # unique per request
                     "params": {
                         "model": model,
                         "max_tokens": 16000,
                         "thinking": {"type": "enabled", "budget_tokens": 8000},
-                        "messages": messages
-                    }
-                }
-            elif is_google(model):
-                request_line = \
-                    {"key": id_prompt[0],
-                        "request": {
-                            "contents": messages
-                        }
-                     }
-
-            json.dump(request_line, f)
-            f.write("\n")
-    return filename
-
-def upload_file_and_start(filename:str, model:str):
+                        "messages": make_messages(id_prompt)
+                    }}
+    else:
+        def make_request_line(id_prompt):
+            return {"key": id_prompt[0],
+                    "request": {
+                        "contents": make_messages(id_prompt)
+                    }}
+    return make_request_line
+
+BATCH_WRITE_BUFFER = 1 << 20 # bytes
+
+# Writes a batch file item by item, so that the task scripts can stream prompts straight from their builders
+# to disk without holding the whole run in memory.  The file only appears under its final name once it has
+# been closed successfully, along with its index (see UploadIndex).  Use as a context manager, calling
+# write() for each item.
+# Every item is written to the file (so its prompt can be looked up later), but only requests that need a
+# response are submitted.  An item is not submitted if its request is identical to one earlier in this run,
+# or to one whose response another run has downloaded in the last CROSS_RUN_DEDUP_DAYS (these are recorded
+# in an _aliases file), or if the response cache (see cache_utils) has its response (which is written to a _cached file).
+# If any items are skipped, the requests to submit are written to a _submit file, which is what
+# upload_file_and_start() then submits.  download_response() splices the skipped items' responses back in.
+class BatchFileWriter:
+    def __init__(self, testname:str, postfix:str, model:str):
+        assert " " not in testname and ":" not in testname and ";" not in testname, "Prohibited for files"
+        self.filename = DIR_BATCH_UPLOADS + testname + postfix + ".jsonl"
+        self.model = model
+        self.count = 0
+        self.cached_count = 0
+        self.aliased_count = 0
+        self._make_request_line = get_request_maker(model)
+        self._encoder = json.JSONEncoder()
+        self._offsets = {} # id -> [byte offset, byte length] of its line
+        self._offset = 0
+        self._file = open(self.filename + ".tmp", "w", encoding="utf-8", buffering=BATCH_WRITE_BUFFER)
+        self._cache = cache_utils.get_cache()
+        self._fingerprints = {} # fingerprint -> id, of the requests submitted by this run
+        self._aliases = {} # id -> {"fingerprint", "upload", "id"} of the request submitted in its place
+        self._submit_file = None # opened once the first item is skipped
+        self._cached_file = None
+
+    def write(self, id_prompt):
+        assert id_prompt[0] not in self._offsets, "need unique ids! " + str(id_prompt[0])
+        request_datum = self._make_request_line(id_prompt)
+        line = self._encoder.encode(request_datum) + "\n"
+        is_submitted = self._check_submitted(id_prompt[0], request_datum) # before the line is in the file
+        self._file.write(line)
+        self._offsets[id_prompt[0]] = [self._offset, len(line)] # the encoder escapes non-ASCII, so chars == bytes
+        self._offset += len(line)
+        self.count += 1
+        if is_submitted and self._submit_file is not None:
+            self._submit_file.write(line)
+
+    # Returns whether the request needs submitting, recording its response or alias if it does not
+    def _check_submitted(self, id:str, request_datum) -> bool:
+        fingerprint = cache_utils.make_key(cache_utils.KIND_BATCH, get_cache_request(request_datum, self.model))
+        if fingerprint in self._fingerprints:
+            self._add_alias(id, fingerprint, self.filename, self._fingerprints[fingerprint])
+            return False
+        cached_response = None if self._cache is None else self._cache.get(fingerprint)
+        if cached_response is not None:
+            self._start_skipping()
+            if self._cached_file is None:
+                self._cached_file = open(get_cached_responses_filename(self.filename) + ".tmp", "w", encoding="utf-8")
+            self._cached_file.write(set_response_id(cached_response, id, response_utils.SOURCE_CACHE) + "\n")
+            self.cached_count += 1
+            return False
+        submitted = None if CROSS_RUN_DEDUP_DAYS <= 0 else \
+            pipeline_utils.find_fingerprint(fingerprint, CROSS_RUN_DEDUP_DAYS)
+        if submitted is not None and submitted[0] != self.filename and \
+                os.path.exists(get_download_filename(submitted[0])): # the response is there to reuse
+            self._add_alias(id, fingerprint, submitted[0], submitted[1])
+            return False
+        self._fingerprints[fingerprint] = id
+        return True
+
+    def _add_alias(self, id:str, fingerprint:str, upload_filename:str, submitted_id:str):
+        self._start_skipping()
+        self._aliases[id] = {"fingerprint": fingerprint, "upload": upload_filename, "id": submitted_id}
+        self.aliased_count += 1
+
+    # Once the first item is skipped, the requests to submit need a file of their own, which starts with
+    # everything written so far (all of which is to be submitted)
+    def _start_skipping(self):
+        if self._submit_file is not None:
+            return
+        self._file.flush()
+        self._submit_file = open(get_submit_filename(self.filename) + ".tmp", "w", encoding="utf-8",
+                                 buffering=BATCH_WRITE_BUFFER)
+        with open(self.filename + ".tmp", "r", encoding="utf-8") as f:
+            for chunk in iter(lambda: f.read(BATCH_WRITE_BUFFER), ""):
+                self._submit_file.write(chunk)
+
+    def close(self):
+        self._file.close()
+        with open(get_index_filename(self.filename) + ".tmp", "w") as f:
+            json.dump(self._offsets, f, separators=(",", ":"))
+        os.replace(self.filename + ".tmp", self.filename)
+        os.replace(get_index_filename(self.filename) + ".tmp", get_index_filename(self.filename))
+
+        # Don't leave any stale files from an earlier run behind
+        for sidecar_filename in [get_submit_filename(self.filename), get_cached_responses_filename(self.filename),
+                                 get_aliases_filename(self.filename)]:
+            if os.path.exists(sidecar_filename):
+                os.remove(sidecar_filename)
+        if self._submit_file is not None:
+            self._submit_file.close()
+            os.replace(self._submit_file.name, get_submit_filename(self.filename))
+        if self._cached_file is not None:
+            self._cached_file.close()
+            os.replace(self._cached_file.name, get_cached_responses_filename(self.filename))
+        if len(self._aliases) > 0:
+            with open(get_aliases_filename(self.filename), "w") as f:
+                json.dump(self._aliases, f)
+
+        if self._cache is not None:
+            self._cache.flush()
+            print("Found", self.cached_count, "of", self.count, "responses in the response cache")
+        if self.aliased_count > 0:
+            print("Found", self.aliased_count, "of", self.count, "requests identical to ones already answered")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else: # don't leave a partial batch file behind
+            for partial_file in [self._file, self._submit_file, self._cached_file]:
+                if partial_file is not None:
+                    partial_file.close()
+                    os.remove(partial_file.name)
+
+# The file holding the requests of a batch file that are actually submitted (see BatchFileWriter)
+def get_submit_filename(filename:str) -> str:
+    return filename[:-len(".jsonl")] + "_submit.jsonl"
+
+# The file holding the cached responses for a batch file (see BatchFileWriter)
+def get_cached_responses_filename(filename:str) -> str:
+    return filename[:-len(".jsonl")] + "_cached.jsonl"
+
+# The file recording which requests of a batch file are identical to submitted ones (see BatchFileWriter)
+def get_aliases_filename(filename:str) -> str:
+    return filename[:-len(".jsonl")] + "_aliases.json"
+
+# The download file holding the responses to an upload file
+def get_download_filename(upload_filename:str) -> str:
+    postfix = POSTFIX_DOWNLOAD2 if upload_filename.endswith(POSTFIX_UPLOAD2 + ".jsonl") else POSTFIX_DOWNLOAD1
+    return DIR_BATCH_DOWNLOADS + get_testname_from_filename(upload_filename) + postfix + ".jsonl"
+
+# What determines the response to a batch request, for keying the response cache: everything but its id
+def get_cache_request(request_datum, model:str):
+    cache_request = {key: value for key, value in request_datum.items() if key not in ["custom_id", "key"]}
+    cache_request["model"] = model # Google's requests do not include it
+    return cache_request
+
+# Returns a line of a downloaded file (i.e. a response) with its id changed to the given id, marked as spliced
+# in from the given source (see response_utils.SPLICED_KEY)
+def set_response_id(response_line:str, id:str, source:str) -> str:
+    response_datum = json.loads(response_line)
+    response_datum["custom_id" if "custom_id" in response_datum else "key"] = id
+    response_datum[response_utils.SPLICED_KEY] = source
+    return json.dumps(response_datum)
+
+# Stores the responses in a downloaded file in the response cache, keyed by the requests in the upload file
+def cache_responses(downloaded_filename:str, upload_filename:str, model:str):
+    cache = cache_utils.get_cache()
+    with UploadIndex(upload_filename) as upload_index, open(downloaded_filename, "r", encoding="utf-8") as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            record = response_utils.normalize_line(line)
+            if record.error is None and record.id in upload_index:
+                cache.put(cache_utils.make_key(cache_utils.KIND_BATCH, get_cache_request(upload_index[record.id], model)),
+                          line.rstrip("\n"))
+
+# Lets later runs reuse the responses just downloaded (see BatchFileWriter), by registering the fingerprints of
+# their requests.  Only downloaded responses are registered, so a run never waits on (or is left without) the
+# responses of a batch that failed, expired or was never submitted.
+def register_downloaded_fingerprints(upload_filename:str, model:str, ids):
+    with UploadIndex(upload_filename) as upload_index:
+        pipeline_utils.register_fingerprints(upload_filename, [
+            (cache_utils.make_key(cache_utils.KIND_BATCH, get_cache_request(upload_index[id], model)), id)
+            for id in ids if id in upload_index])
+
+# Adds the responses for the requests that were identical to ones already answered (see BatchFileWriter) to
+# the download file: from the same download, if submitted by the same run, or else from the other run's
+# download (or the response cache).  A response missing from another run's download is an error, as this run
+# did not submit the request; one whose request this run submitted is missing just as the original is.
+def add_aliased_responses(outfile_name:str, upload_filename:str, handle_record):
+    with open(get_aliases_filename(upload_filename), "r") as f:
+        aliases = json.load(f)
+    wanted = {} # download file -> set of the ids wanted from it
+    for alias in aliases.values():
+        wanted.setdefault(get_download_filename(alias["upload"]), set()).add(alias["id"])
+    responses = {} # (download file, id) -> response line
+    for download_filename, ids in wanted.items():
+        source_filename = outfile_name if download_filename == get_download_filename(upload_filename) else download_filename
+        if not os.path.exists(source_filename):
+            continue
+        with open(source_filename, "r", encoding="utf-8") as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    record = response_utils.normalize_line(line)
+                    if record.id in ids and record.error is None:
+                        responses[(download_filename, record.id)] = line.rstrip("\n")
+
+    cache = cache_utils.get_cache()
+    missing_ids = []
+    with open(outfile_name, "a", encoding="utf-8") as outfile:
+        for id, alias in aliases.items():
+            line = responses.get((get_download_filename(alias["upload"]), alias["id"]))
+            if line is None and cache is not None:
+                line = cache.get(alias["fingerprint"])
+            if line is None:
+                missing_ids.append(id)
+                continue
+            line = set_response_id(line, id, response_utils.SOURCE_ALIAS)
+            outfile.write(line + "\n")
+            handle_record(response_utils.normalize_line(line))
+    print("Added", len(aliases) - len(missing_ids), "responses to requests identical to ones already answered")
+    unresolved_ids = [id for id in missing_ids if aliases[id]["upload"] != upload_filename]
+    assert len(unresolved_ids) == 0, str(len(unresolved_ids)) + " responses are missing from the downloads of the " + \
+        "runs that answered them (run this stage again with BATCH_DEDUP_DAYS=0 to submit them): " + \
+        ", ".join(unresolved_ids[:20])
+    if len(missing_ids) > 0:
+        print("NOTE:", len(missing_ids), "responses are missing, as are those to the identical requests submitted:",
+              ", ".join(missing_ids[:20]))
+
+# The sidecar file holding the index of a batch file (see UploadIndex)
+def get_index_filename(filename:str) -> str:
+    return filename + ".idx"
+
+# The id of a request line in a batch file
+def get_request_id(request_datum) -> str:
+    if "custom_id" in request_datum: # OpenAI and Claude
+        return request_datum["custom_id"]
+    return request_datum["key"] # Google
+
+# Gives access to the requests of an uploaded batch file by id, without loading the file.  The id -> (offset,
+# length) index is read from the sidecar file written by BatchFileWriter (or, for older uploads without one,
+# built with a single pass over the file), and each request is parsed only when asked for, from a memory map.
+class UploadIndex:
+    def __init__(self, filename:str):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) > 0 else b""
+        if os.path.exists(get_index_filename(filename)) and \
+                os.path.getmtime(get_index_filename(filename)) >= os.path.getmtime(filename):
+            with open(get_index_filename(filename), "r") as f:
+                self._offsets = json.load(f)
+        else:
+            self._offsets = {}
+            offset = 0
+            for line in self._file:
+                id = get_request_id(json.loads(line))
+                assert id not in self._offsets, "need unique ids! " + str(id)
+                self._offsets[id] = [offset, len(line)]
+                offset += len(line)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, id):
+        return id in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __getitem__(self, id):
+        offset, length = self._offsets[id]
+        return json.loads(self._map[offset:offset+length])
+
+    def close(self):
+        if type(self._map) == mmap.mmap:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Writes a batch file from any iterable (e.g. a generator) of items; see BatchFileWriter
+def write_batch_file(testname:str, postfix:str, model:str, ids_prompts):
+    with BatchFileWriter(testname, postfix, model) as writer:
+        for id_prompt in ids_prompts:
+            writer.write(id_prompt)
+    return writer.filename
+
+def get_batch_limits(model:str):
+    if is_openai(model):
+        return OPENAI_BATCH_LIMITS
+    elif is_claude(model):
+        return CLAUDE_BATCH_LIMITS
+    elif is_google(model):
+        return GOOGLE_BATCH_LIMITS
+    assert False, "not supported"
+
+# Splits a batch file into shards that each fit within the provider's limits (or within smaller limits, if
+# passed).  Returns the files to submit, which is just the original file if it already fits.
+def split_batch_file(filename:str, model:str, max_requests:int = None, max_bytes:int = None) -> list:
+    limit_requests, limit_bytes = get_batch_limits(model)
+    max_requests = limit_requests if max_requests is None else min(max_requests, limit_requests)
+    max_bytes = limit_bytes if max_bytes is None else min(max_bytes, limit_bytes)
+
+    if os.path.getsize(filename) <= max_bytes:
+        with open(filename, "rb") as f:
+            num_requests = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(BATCH_WRITE_BUFFER), b""))
+        if num_requests <= max_requests:
+            return [filename]
+
+    assert filename.endswith(".jsonl")
+    shard_filenames = []
+    shard_file = None
+    with open(filename, "rb") as f:
+        for line in f:
+            assert len(line) <= max_bytes, "a single request is bigger than the batch limit"
+            if shard_file is None or shard_requests >= max_requests or shard_bytes + len(line) > max_bytes:
+                if shard_file is not None:
+                    shard_file.close()
+                shard_filenames.append(filename[:-len(".jsonl")] + "_shard" + str(len(shard_filenames)+1).zfill(3) + ".jsonl")
+                shard_file = open(shard_filenames[-1], "wb", buffering=BATCH_WRITE_BUFFER)
+                shard_requests = 0
+                shard_bytes = 0
+            shard_file.write(line)
+            shard_requests += 1
+            shard_bytes += len(line)
+    if shard_file is not None:
+        shard_file.close()
+    print("Split", filename, "into", len(shard_filenames), "shards")
+    return shard_filenames
+
+# Uploads a batch file (split into shards if it is too big for one batch) and starts the batch(es).
+# Returns the batch id to pass to the download stage; for a sharded run, this is the shards' batch ids
+# joined by BATCH_ID_SEPARATOR, and the shards are also recorded in a _batches.json file next to the upload.
+# If BatchFileWriter skipped some of the requests (see there), only the rest are submitted, and if it skipped
+# all of them, nothing is, and the batch id is CACHED_ONLY_BATCH_ID_PREFIX followed by the test name.
+# Before anything is submitted, its tokens and cost are forecast (see preflight_utils), and it is not
+# submitted if that is over the budget.
+def upload_file_and_start(filename:str, model:str, max_requests:int = None, max_bytes:int = None) -> str:
+    submit_filename = filename
+    if os.path.exists(get_submit_filename(filename)): # BatchFileWriter removes any stale one
+        submit_filename = get_submit_filename(filename)
+    if os.path.getsize(submit_filename) == 0:
+        print("All responses are cached or already answered; nothing to submit")
+        shard_filenames = []
+        shard_results = [(CACHED_ONLY_BATCH_ID_PREFIX + get_testname_from_filename(filename),
+                          "All responses cached or already answered\n")]
+    else:
+        # Forecast the size and cost first
+        plan = preflight_utils.BatchPlan(submit_filename, model)
+        plan.print_forecast()
+        plan.check_budget()
+        shard_filenames = split_batch_file(submit_filename, model, max_requests, max_bytes)
+        with ThreadPoolExecutor(max_workers=min(len(shard_filenames), MAX_CONCURRENT_SUBMISSIONS)) as executor:
+            shard_results = list(executor.map(lambda shard_filename: start_batch(shard_filename, model), shard_filenames))
+    batch_ids = [batch_id for batch_id, _ in shard_results]
+
+    infotext = "".join([shard_infotext for _, shard_infotext in shard_results])
+    if len(shard_filenames) > 1:
+        with open(filename[:-len(".jsonl")] + "_batches.json", "w") as f:
+            json.dump({"file": filename, "model": model,
+                       "shards": [{"file": shard_filename, "batch_id": batch_id}
+                                  for shard_filename, batch_id in zip(shard_filenames, batch_ids)]}, f, indent=2)
+        print("ALL BATCH IDS =", BATCH_ID_SEPARATOR.join(batch_ids))
+
+    # Do logging (with a reference to the uploaded file, rather than a copy of it), and register the run so
+    # that pipeline.py can start the next stage once it is done
+    call_utils.log_arbitrary(infotext, get_testname_from_filename(filename), BATCH_ID_SEPARATOR.join(batch_ids),
+                             payload_file=filename)
+    pipeline_utils.register_batch(BATCH_ID_SEPARATOR.join(batch_ids), get_testname_from_filename(filename), model)
+    return BATCH_ID_SEPARATOR.join(batch_ids)
+
+# The Vertex AI clients, pointed at mock_batch_server.py instead if call_utils.MOCK_BATCH_SERVER is set (the
+# OpenAI, Anthropic and storage clients pick it up from the environment)
+def get_genai_client():
+    if call_utils.MOCK_BATCH_SERVER:
+        return genai.Client(http_options=HttpOptions(api_version="v1", base_url=call_utils.MOCK_BATCH_SERVER + "/"),
+                            vertexai=True, project=GOOGLE_PROJECT, location=GOOGLE_LOCATION,
+                            credentials=AnonymousCredentials())
+    return genai.Client(http_options=HttpOptions(api_version="v1"),
+                        vertexai=True, project=GOOGLE_PROJECT, location=GOOGLE_LOCATION)
+
+def get_job_service():
+    if call_utils.MOCK_BATCH_SERVER:
+        return aiplatform_v1.JobServiceClient(credentials=AnonymousCredentials(), transport="rest",
+                                              client_options={"api_endpoint": call_utils.MOCK_BATCH_SERVER})
+    return aiplatform_v1.JobServiceClient(
+        client_options={"api_endpoint": f"{GOOGLE_LOCATION}-aiplatform.googleapis.com"}
+    )
+
+# Uploads a single file and starts a single batch on it, returning the batch id and text to log
+def start_batch(filename:str, model:str):
     infotext = "Uploaded file " + filename + " against model" + model + "\n"
 
     if is_openai(model):
@@ -120,17 +536,19 @@ def upload_file_and_start(filename:str, model:str):
         )
         print("batch.id=", batch.id)
         infotext += "batch.id:" + batch.id + "\n"
+        batch_id = batch.id
 
     elif is_claude(model):
         client = anthropic.Anthropic()
         requests = []
         with open(filename, "r") as f:
-            for line in f.readlines():
+            for line in f:
                 requests.append(json.loads(line))
 
         batch = client.messages.batches.create(requests=requests)
         print("Batch ID:", batch.id)
         infotext += "batch.id:" + batch.id + "\n"
+        batch_id = batch.id
 
     elif is_google(model):
         # authenticate to Google Cloud Storage
@@ -146,8 +564,7 @@ def upload_file_and_start(filename:str, model:str):
         blob.upload_from_filename(filename)
 
         # make actual call
-        client = genai.Client(http_options=HttpOptions(api_version="v1"),
-                              vertexai=True, project=GOOGLE_PROJECT, location=GOOGLE_LOCATION)
+        client = get_genai_client()
         assert filename.startswith(DIR_BATCH_UPLOADS)
         SRC_URI = f"gs://{GOOGLE_BUCKET}/gemini_input/{gs_filename}"  # ← already uploaded
         DEST_URI = f"gs://{GOOGLE_BUCKET}/gemini_output/"  # ← empty folder for results
@@ -159,48 +576,194 @@ def upload_file_and_start(filename:str, model:str):
         )
         print(f"JOB NAME = {job.name} (state={job.state})")
         infotext += "job.name:" + job.name + "\n"
+        batch_id = job.name
     else:
         assert False, "not supported"
-
-    # Do logging
-    with open(filename, "r") as f:
-        infotext += f.read()
-    call_utils.log_arbitrary(infotext)
-
-
-def download_response(batchid:str, outfile_name:str, model:str):
-    log_text = "DOWNLOADED " + outfile_name + " from model=" + model + " w/batchid=" + batchid + "\n"
-
+    return batch_id, infotext
+
+
+BATCH_RUNNING = "running"
+BATCH_COMPLETED = "completed"
+BATCH_FAILED = "failed"
+
+# Returns whether a batch is still running, has completed, or has failed (for a sharded run, the batch has
+# completed once all of its shards have, and has failed if any of them has)
+def get_batch_status(batchid:str, model:str) -> str:
+    if batchid.startswith(CACHED_ONLY_BATCH_ID_PREFIX):
+        return BATCH_COMPLETED
+    statuses = [get_single_batch_status(batch_id, model) for batch_id in batchid.split(BATCH_ID_SEPARATOR)]
+    if BATCH_FAILED in statuses:
+        return BATCH_FAILED
+    elif BATCH_RUNNING in statuses:
+        return BATCH_RUNNING
+    return BATCH_COMPLETED
+
+def get_single_batch_status(batchid:str, model:str) -> str:
+    if is_openai(model):
+        status = openai.OpenAI().batches.retrieve(batchid).status
+        if status == "completed":
+            return BATCH_COMPLETED
+        elif status in ["failed", "expired", "cancelling", "cancelled"]:
+            return BATCH_FAILED
+    elif is_claude(model):
+        batch = anthropic.Anthropic().messages.batches.retrieve(batchid)
+        if batch.processing_status == "ended":
+            return BATCH_COMPLETED if batch.request_counts.succeeded > 0 else BATCH_FAILED
+        elif batch.processing_status == "canceling":
+            return BATCH_FAILED
+    elif is_google(model):
+        job_service = get_job_service()
+        state = job_service.get_batch_prediction_job(name=batchid).state.name
+        if state in ["JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"]:
+            return BATCH_COMPLETED
+        elif state in ["JOB_STATE_FAILED", "JOB_STATE_CANCELLING", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"]:
+            return BATCH_FAILED
+    else:
+        assert False, "not supported"
+    return BATCH_RUNNING
+
+# Returns the (submitted, completed) times of a batch, in seconds since the epoch, or None if it has not
+# completed or nothing was submitted.  For a sharded run, it is from the first submission to the last completion.
+def get_batch_times(batchid:str, model:str):
+    if batchid.startswith(CACHED_ONLY_BATCH_ID_PREFIX):
+        return None
+    batch_times = [get_single_batch_times(batch_id, model) for batch_id in batchid.split(BATCH_ID_SEPARATOR)]
+    if None in batch_times:
+        return None
+    return min([submitted for submitted, completed in batch_times]), max([completed for submitted, completed in batch_times])
+
+def get_single_batch_times(batchid:str, model:str):
+    if is_openai(model):
+        batch = openai.OpenAI().batches.retrieve(batchid)
+        completed = batch.completed_at or batch.failed_at or batch.expired_at or batch.cancelled_at
+        return None if completed is None else (float(batch.created_at), float(completed))
+    elif is_claude(model):
+        batch = anthropic.Anthropic().messages.batches.retrieve(batchid)
+        return None if batch.ended_at is None else (batch.created_at.timestamp(), batch.ended_at.timestamp())
+    elif is_google(model):
+        job_service = get_job_service()
+        job = job_service.get_batch_prediction_job(name=batchid)
+        return None if not job.end_time else (job.create_time.timestamp(), job.end_time.timestamp())
+    assert False, "not supported"
+
+# Downloads the results of a batch to outfile_name, streaming them record by record, so memory use stays
+# bounded however big the results are.  If on_record is passed, it is called with each record (as a
+# response_utils.ResponseRecord) as it arrives, so a later stage can start on the records without waiting for the whole download.
+# For a sharded run (i.e., batch ids joined by BATCH_ID_SEPARATOR), the shards are downloaded concurrently
+# and reassembled, in order, into outfile_name; on_record then sees the shards' records interleaved.
+def download_response(batchid:str, outfile_name:str, model:str, on_record = None):
+    log_text = "DOWNLOADED " + outfile_name + " from model=" + model + " w/batchid=" + batchid
+
+    # Report how much of the input was served from the provider's prompt cache
+    cache_tokens = [0, 0] # read, written
+    usage_totals = response_utils.UsageTotals() # of the new responses, for pre-flight projections of later runs
+    downloaded_ids = [] # of the new responses that succeeded, for later runs to reuse
+    lock = threading.Lock() # the shards' records arrive on different threads
+    def handle_new_record(record):
+        with lock:
+            if record.error is None:
+                downloaded_ids.append(record.id)
+        handle_record(record)
+    def handle_record(record):
+        with lock:
+            cache_tokens[0] += record.cached_tokens
+            cache_tokens[1] += record.cache_write_tokens
+            usage_totals.add(record)
+            if on_record is not None:
+                on_record(record)
+
+    batch_ids = batchid.split(BATCH_ID_SEPARATOR)
+    if batchid.startswith(CACHED_ONLY_BATCH_ID_PREFIX):
+        open(outfile_name, "w").close()
+    elif len(batch_ids) == 1:
+        download_batch(batchid, outfile_name, model, handle_new_record)
+    else:
+        shard_outfile_names = [outfile_name + ".shard" + str(i+1).zfill(3) for i in range(len(batch_ids))]
+        with ThreadPoolExecutor(max_workers=min(len(batch_ids), MAX_CONCURRENT_SUBMISSIONS)) as executor:
+            list(executor.map(lambda x: download_batch(x[0], x[1], model, handle_new_record),
+                              zip(batch_ids, shard_outfile_names)))
+        with open(outfile_name, "wb") as outfile:
+            for shard_outfile_name in shard_outfile_names:
+                with open(shard_outfile_name, "rb") as f:
+                    for chunk in iter(lambda: f.read(BATCH_WRITE_BUFFER), b""):
+                        outfile.write(chunk)
+                os.remove(shard_outfile_name)
+
+    # Store the new responses in the response cache, and splice in the responses that were already there
+    upload_filename = get_upload_filename(outfile_name)
+    if not batchid.startswith(CACHED_ONLY_BATCH_ID_PREFIX):
+        preflight_utils.record_download(batchid, upload_filename, model, usage_totals)
+    if cache_utils.get_cache() is not None and os.path.exists(upload_filename):
+        cache_responses(outfile_name, upload_filename, model)
+    if CROSS_RUN_DEDUP_DAYS > 0 and len(downloaded_ids) > 0 and os.path.exists(upload_filename):
+        register_downloaded_fingerprints(upload_filename, model, downloaded_ids)
+    if os.path.exists(get_cached_responses_filename(upload_filename)):
+        num_cached = 0
+        with open(outfile_name, "a", encoding="utf-8") as outfile, \
+                open(get_cached_responses_filename(upload_filename), "r", encoding="utf-8") as f:
+            for line in f:
+                outfile.write(line)
+                handle_record(response_utils.normalize_line(line))
+                num_cached += 1
+        print("Added", num_cached, "responses from the response cache")
+    if os.path.exists(get_aliases_filename(upload_filename)):
+        add_aliased_responses(outfile_name, upload_filename, handle_record)
+
+    call_utils.log_arbitrary(log_text, get_testname_from_filename(outfile_name), batchid, payload_file=outfile_name)
+
+    print("total_cache_read_tokens =", cache_tokens[0])
+    if is_claude(model):
+        print("total_cache_write_tokens =", cache_tokens[1])
+
+DOWNLOAD_PROGRESS_INTERVAL = 1000 # records
+
+# Downloads the results of a single batch to outfile_name, a record at a time, printing progress as it
+# goes and calling on_record (if passed) with each record.  Returns the number of records.
+def download_batch(batchid:str, outfile_name:str, model:str, on_record = None) -> int:
+    num_records = 0
+    with open(outfile_name + ".tmp", "w", encoding="utf-8", buffering=BATCH_WRITE_BUFFER) as outfile:
+        for line in stream_batch_lines(batchid, model):
+            if len(line.strip()) == 0:
+                continue
+            outfile.write(line + "\n")
+            if on_record is not None:
+                on_record(response_utils.normalize_line(line))
+            num_records += 1
+            if num_records % DOWNLOAD_PROGRESS_INTERVAL == 0:
+                print("Downloaded", num_records, "records from", batchid)
+    os.replace(outfile_name + ".tmp", outfile_name) # so a failed download never leaves a partial file
+    print("Downloaded", num_records, "records from", batchid, "in total")
+    return num_records
+
+# Yields the lines of the results of a single batch (one JSON record per line), as they arrive
+def stream_batch_lines(batchid:str, model:str):
     if is_openai(model):
         client = openai.OpenAI()
         batch = client.batches.retrieve(batchid)
         output_file_id = batch.output_file_id
         print("output file id:", output_file_id)
-        client.files.content(output_file_id).write_to_file(outfile_name)
+        with client.files.with_streaming_response.content(output_file_id) as response:
+            for line in response.iter_lines():
+                yield line
 
     elif is_claude(model):
         client = anthropic.Anthropic()
-        results = client.messages.batches.results(batchid)
-        outfile_text = ""
-        for line in results:  # ND‑JSON stream
+        encoder = json.JSONEncoder()
+        for line in client.messages.batches.results(batchid):  # ND‑JSON stream
             assert line.result.type == "succeeded"
-            outfile_text += json.dumps(line.model_dump()) +"\n"
-        with open(outfile_name, "w") as f:
-            f.write(outfile_text)
+            yield encoder.encode(line.model_dump())
 
     elif is_google(model):
         # creds = service_account.Credentials.from_service_account_file("sheltercheck-googlecloudkey.json", \
         #                                                               scopes=[
         #                                                                   "https://www.googleapis.com/auth/cloud-platform"])
 
-        job_service = aiplatform_v1.JobServiceClient(
-            client_options={"api_endpoint": f"{GOOGLE_LOCATION}-aiplatform.googleapis.com"}
-        )
+        job_service = get_job_service()
         bp = job_service.get_batch_prediction_job(name=batchid)
         true_dir = bp.output_info.gcs_output_directory
         print("Predictions are under:", true_dir)
 
-        # download from google cloud storage
+        # stream from google cloud storage
         storage_client = storage.Client(project=GOOGLE_PROJECT)  # , credentials=creds)
         bucket = storage_client.bucket(GOOGLE_BUCKET)
         file_loc = true_dir + "/predictions.jsonl"
@@ -209,145 +772,86 @@ def download_response(batchid:str, outfile_name:str, model:str):
         assert file_loc.startswith(GOOGLE_BUCKET)
         file_loc = file_loc[len(GOOGLE_BUCKET)+1:]
         blob = bucket.blob(file_loc)
-        blob.download_to_filename(outfile_name)
+        with blob.open("r", encoding="utf-8") as f:
+            for line in f:
+                yield line.rstrip("\n")
 
     else:
         assert False, "not supported"
 
-    with open(outfile_name, "r") as f:
-        log_text += f.read() + "\n"
-    call_utils.log_arbitrary(log_text)
-
-
+# Joins the responses to the prompts that produced them, giving (id, prompt1, response, follow_up) items for
+# the next batch.  For OpenAI and Claude, input_data gives the uploaded requests by id (e.g. an UploadIndex, or
+# a list of them), whereas Google includes the request in the response.  Responses may be in any order; any
+# missing, duplicate or unknown ids are reported, and only the items that can be joined are returned.
 def merge_input_response(input_data, response_data, model, follow_up:str):
-    total_input_tokens = 0
-    total_reasoning_tokens = 0
-    total_output_tokens = 0
+    usage_totals = response_utils.UsageTotals()
     list_ids_prompt1_response_prompt2 = []
-    for response_datum in response_data:
-        # count up the token usage
+    if type(input_data) == list:
+        input_by_id = {}
+        for input_datum in input_data:
+            assert get_request_id(input_datum) not in input_by_id, "need unique ids! " + get_request_id(input_datum)
+            input_by_id[get_request_id(input_datum)] = input_datum
+        input_data = input_by_id
+    response_ids = set()
+    duplicate_ids = []
+    unknown_ids = []
+    for record in response_data:
+        id = record.id
+        if id in response_ids:
+            duplicate_ids.append(id)
+            continue
+        response_ids.add(id)
+        if input_data is not None and id not in input_data:
+            unknown_ids.append(id)
+            continue
+        assert record.error == None, "error for " + id + ": " + str(record.error)
+        usage_totals.add(record)
+
+        # get the original prompt
         if is_openai(model):
-            # count tokens
-            assert response_datum["error"] == None
-            total_input_tokens += response_datum["response"]["body"]["usage"]["prompt_tokens"]
-            total_reasoning_tokens += response_datum["response"]["body"]["usage"]["completion_tokens_details"][
-                "reasoning_tokens"]
-            total_output_tokens += response_datum["response"]["body"]["usage"]["completion_tokens"]
-
-            # get the original prompt
-            id = response_datum["custom_id"]
-            prompt1 = None
-            for input_datum in input_data:
-                if input_datum["custom_id"] == id:
-                    assert prompt1 == None, "Should be only one with custom_id=" + id
-                    assert len(input_datum["body"]["messages"]) == 1
-                    assert input_datum["body"]["messages"][0]["role"] == "user"
-                    prompt1 = input_datum["body"]["messages"][0]["content"]
-
-            # now get the response data and merge it
-            assert len(response_datum["response"]["body"]["choices"]) == 1
-            assert response_datum["response"]["body"]["choices"][0]["message"]["role"] == "assistant"
-            response = response_datum["response"]["body"]["choices"][0]["message"]["content"]
-            list_ids_prompt1_response_prompt2.append((id, prompt1, response, follow_up))
-
-
+            input_datum = input_data[id]
+            assert len(input_datum["body"]["messages"]) == 1
+            assert input_datum["body"]["messages"][0]["role"] == "user"
+            prompt1 = input_datum["body"]["messages"][0]["content"]
         elif is_claude(model):
-            assert response_datum["result"]["type"] == "succeeded"
-
-            total_input_tokens += response_datum["result"]["message"]["usage"]["input_tokens"]
-            total_output_tokens += response_datum["result"]["message"]["usage"]["output_tokens"]
-
-            # get the original prompt
-            id = response_datum["custom_id"]
-            prompt1 = None
-            for input_datum in input_data:
-                if input_datum["custom_id"] == id:
-                    assert prompt1 == None, "Should be only one with custom_id=" + id
-                    assert len(input_datum["params"]["messages"]) == 1
-                    assert input_datum["params"]["messages"][0]["role"] == "user"
-                    prompt1 = input_datum["params"]["messages"][0]["content"]
-
-            # now get the response data and merge it
-            response = None
-            for content in response_datum["result"]["message"]["content"]:
-                if content["type"] == "text": # other type includes "thinking"
-                    assert response == None
-                    response = content["text"]
-            list_ids_prompt1_response_prompt2.append((id, prompt1, response, follow_up))
-
+            input_datum = input_data[id]
+            assert len(input_datum["params"]["messages"]) == 1
+            assert input_datum["params"]["messages"][0]["role"] == "user"
+            prompt1 = read_user_content(input_datum["params"]["messages"][0]["content"])
         elif is_google(model):
-            input_data, response_data, model, follow_up
-
-            total_input_tokens += response_datum["response"]["usageMetadata"]["promptTokenCount"]
-            total_output_tokens += response_datum["response"]["usageMetadata"]["candidatesTokenCount"]
-
-            id = response_datum["key"]
-            prompt1 = response_datum["request"]["contents"][0]["parts"][0]["text"]
-            assert len(response_datum["request"]["contents"]) == 1
-            assert len(response_datum["request"]["contents"][0]["parts"]) == 1
-            assert response_datum["request"]["contents"][0]["role"] == "user"
-
-            assert len(response_datum["response"]["candidates"]) == 1
-            assert len(response_datum["response"]["candidates"][0]["content"]["parts"]) == 1
-            assert response_datum["response"]["candidates"][0]["content"]["role"] == "model"
-            assert response_datum["response"]["candidates"][0]["finishReason"] == "STOP"
-            response = response_datum["response"]["candidates"][0]["content"]["parts"][0]["text"]
-            list_ids_prompt1_response_prompt2.append((id, prompt1, response, follow_up))
-
-
+            assert len(record.request["contents"]) == 1
+            assert len(record.request["contents"][0]["parts"]) == 1
+            assert record.request["contents"][0]["role"] == "user"
+            assert record.finish_reason == "STOP"
+            prompt1 = record.request["contents"][0]["parts"][0]["text"]
         else:
             assert False, "model not implemented"
 
+        # now merge in the response
+        list_ids_prompt1_response_prompt2.append((id, prompt1, record.text, follow_up))
+
+    # Report anything that could not be joined
+    missing_ids = [] if input_data is None else [id for id in input_data if id not in response_ids]
+    for description, ids in [("prompts with no response", missing_ids),
+                             ("duplicate responses (all but the first ignored)", duplicate_ids),
+                             ("responses to no uploaded prompt (ignored)", unknown_ids)]:
+        if len(ids) > 0:
+            print("NOTE:", len(ids), description + ":", ", ".join(ids[:20]) + (", ..." if len(ids) > 20 else ""))
+    print("Joined", len(list_ids_prompt1_response_prompt2), "responses to their prompts")
+
     # Here is useful information for keeping track of costs
-    return list_ids_prompt1_response_prompt2, total_input_tokens, total_reasoning_tokens, total_output_tokens
+    return list_ids_prompt1_response_prompt2, usage_totals.input_tokens, usage_totals.reasoning_tokens, \
+        usage_totals.output_tokens
 
+# Reads the (id, response text) pairs from a downloaded file, along with the token usage
 def extract_response(downloaded_filename:str, model:str):
-    download_data = []
-    with open(downloaded_filename, "r") as f:
-        for line in f.readlines():
-            download_data.append(json.loads(line))
-
-    total_input_tokens = 0
-    total_reasoning_tokens = 0
-    total_output_tokens = 0
+    usage_totals = response_utils.UsageTotals()
     list_ids_responses = []
-
-    for response_datum in download_data:
-        if is_openai(model):
-            assert response_datum["error"] == None
-            total_input_tokens += response_datum["response"]["body"]["usage"]["prompt_tokens"]
-            total_reasoning_tokens += response_datum["response"]["body"]["usage"]["completion_tokens_details"][
-                "reasoning_tokens"]
-            total_output_tokens += response_datum["response"]["body"]["usage"]["completion_tokens"]
-            id = response_datum["custom_id"]
-            assert len(response_datum["response"]["body"]["choices"]) == 1
-            assert response_datum["response"]["body"]["choices"][0]["message"]["role"] == "assistant"
-            response = response_datum["response"]["body"]["choices"][0]["message"]["content"]
-        elif is_claude(model):
-            assert response_datum["result"]["type"] == "succeeded"
-            total_input_tokens += response_datum["result"]["message"]["usage"]["input_tokens"]
-            total_output_tokens += response_datum["result"]["message"]["usage"]["output_tokens"]
-            id = response_datum["custom_id"]
-
-            response = None
-            for content in response_datum["result"]["message"]["content"]:
-                if content["type"] == "text":  # other type includes "thinking"
-                    assert response == None, "should be only one"
-                    response = content["text"]
-        elif is_google(model):
-            id = response_datum["key"]
-
-            assert len(response_datum["response"]["candidates"]) == 1
-            assert response_datum["response"]["candidates"][0]["finishReason"] == "STOP"
-
-            total_input_tokens += response_datum["response"]["usageMetadata"]["promptTokenCount"]
-            total_output_tokens += response_datum["response"]["usageMetadata"]["candidatesTokenCount"]
-
-            assert len(response_datum["response"]["candidates"][0]["content"]["parts"]) == 1
-            response = response_datum["response"]["candidates"][0]["content"]["parts"][0]["text"]
-        else:
-            assert False, "not implemented"
-        list_ids_responses.append((id, response))
-
-    return list_ids_responses, total_input_tokens, total_reasoning_tokens, total_output_tokens
-
+    for record in response_utils.iter_responses(downloaded_filename):
+        assert record.error == None, "error for " + record.id + ": " + str(record.error)
+        if is_google(model):
+            assert record.finish_reason == "STOP"
+        usage_totals.add(record)
+        list_ids_responses.append((record.id, record.text))
+
+    return list_ids_responses, usage_totals.input_tokens, usage_totals.reasoning_tokens, usage_totals.output_tokens
@@ -1,57 +1,68 @@
 # This is used as the second step of analysis_verification or goal_verification_*
 # Call it with the testname (e.g. analysis_verification_1_gpt-4.1-nano-2025-04-14_2025-07-25at14_50_12),
 # model (e.g. o3), and batchid (e.g. batch_6883d1e653648190b2899232c2511603) to
-# have it upload a batch to clarify binary answers.
-import os, sys, json
-import batch_utils
+# have it upload a batch to clarify binary answers.  Responses that already state an unmistakable verdict
+# are resolved locally (see verdict_utils) and written to the _local2 file, so only the ambiguous rest go
+# into the batch; add --clarify_all to send them all.
+import json, os, sys
+import batch_utils, metrics_utils, response_utils, verdict_utils
 
-assert len(sys.argv) == 4, "Usage: <testname> <model> <batchid>"
+assert len(sys.argv) in [4, 5], "Usage: <testname> <model> <batchid> [--clarify_all]"
 testname = sys.argv[1]
 model = sys.argv[2]
 batchid = sys.argv[3] # This is an ID used by the server API (e.g. OpenAI's API)
+clarify_all = len(sys.argv) == 5
+assert not clarify_all or sys.argv[4] == "--clarify_all", "Usage: <testname> <model> <batchid> [--clarify_all]"
+metrics = metrics_utils.StageMetrics(testname, model, batchid)
 
-# If the response format does not have it, then open the file that was uploaded
+# If the response format does not have it, then index the file that was uploaded
 # to get this request, as we need this to build the next call
 if batch_utils.is_claude(model) or batch_utils.is_openai(model):
     uploaded_file = batch_utils.DIR_BATCH_UPLOADS + testname + batch_utils.POSTFIX_UPLOAD1 + ".jsonl"
     assert os.path.exists(uploaded_file), "ensure original file present"
-    input_data = []
-    with open(uploaded_file, "r") as f:
-        for line in f.readlines():
-            input_data.append(json.loads(line))
+    input_data = batch_utils.UploadIndex(uploaded_file)
+else:
+    input_data = None
 
 # Do the download from the server to a local file
 download_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_DOWNLOAD1 + ".jsonl"
 if os.path.exists(download_file):
     print("NOTE: The following file already exists:", download_file)
-batch_utils.download_response(batchid, download_file, model)
+with metrics.phase("download"):
+    batch_utils.download_response(batchid, download_file, model, metrics.add_record)
 
-# Open the downloaded file
-response_data = []
-with open(download_file, "r") as f:
-    for line in f.readlines():
-        response_data.append(json.loads(line))
-
-if batch_utils.is_google(model):
-    input_data = None
-else:
-    assert len(input_data) == len(response_data)
-
-list_ids_prompt1_response_prompt2, total_input_tokens, \
-    total_reasoning_tokens, total_output_tokens = \
-    batch_utils.merge_input_response(input_data,
-                                     response_data,
-                                     model,
-                                     "So the answer (just Yes or No) is:")
+# Join the downloaded responses (read a line at a time) to their prompts
+list_ids_prompt1_response_prompt2 = batch_utils.merge_input_response(input_data,
+                                                                     response_utils.iter_responses(download_file),
+                                                                     model,
+                                                                     "So the answer (just Yes or No) is:")[0]
+if input_data is not None:
+    input_data.close()
 
 # Here is useful information for keeping track of costs
-print("total_input_tokens =", total_input_tokens)
-print("total_reasoning_tokens =", total_reasoning_tokens)
-print("total_output_tokens = ", total_output_tokens)
+metrics.print_totals()
+
+# Resolve the clear verdicts here, writing them (with how sure we are and why) to the local file
+list_to_clarify = []
+local_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_LOCAL2 + ".jsonl"
+with open(local_file, "w", encoding="utf-8") as f:
+    for id, prompt1, response, prompt2 in list_ids_prompt1_response_prompt2:
+        verdict, confidence, rule = (None, 0.0, "clarify_all") if clarify_all else verdict_utils.extract_verdict(response)
+        if verdict is None or confidence < verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE:
+            list_to_clarify.append((id, prompt1, response, prompt2))
+            continue
+        f.write(json.dumps({"id": id, "answer": "Yes" if verdict else "No", "confidence": confidence,
+                            "rule": rule, "response": response}) + "\n")
+print("Resolved locally =", len(list_ids_prompt1_response_prompt2) - len(list_to_clarify),
+      "; to clarify =", len(list_to_clarify))
+metrics.add_count("resolved_locally", len(list_ids_prompt1_response_prompt2) - len(list_to_clarify))
+metrics.add_count("to_clarify", len(list_to_clarify))
 
 # Write the files to get the clarifications and make the call
-batch_filename = batch_utils.write_batch_file(testname,
-                                              batch_utils.POSTFIX_UPLOAD2,
-                                              model,
-                                              list_ids_prompt1_response_prompt2)
-batch_utils.upload_file_and_start(batch_filename, model)
+with metrics.phase("upload"):
+    batch_filename = batch_utils.write_batch_file(testname,
+                                                  batch_utils.POSTFIX_UPLOAD2,
+                                                  model,
+                                                  list_to_clarify)
+    batch_utils.upload_file_and_start(batch_filename, model)
+metrics.write()
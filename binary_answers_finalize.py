@@ -2,27 +2,38 @@
 # Call it with the testname (e.g. analysis_verification_1_gpt-4.1-nano-2025-04-14_2025-07-25at14_50_12),
 # model (e.g. o3), and batchid (e.g. batch_6883d1e653648190b2899232c2511603) to
 # have it upload a batch to clarify binary answers.
-import os, sys
-import batch_utils
+import json, os, sys
+import batch_utils, metrics_utils
 
 assert len(sys.argv) == 4, "Usage: <testname> <model> <batchid>"
 testname = sys.argv[1]
 model = sys.argv[2]
 batchid = sys.argv[3] # This is an ID used by the server API (e.g. OpenAI's API)
+metrics = metrics_utils.StageMetrics(testname, model, batchid)
 
 # Do the download from the server to a local file
 download_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_DOWNLOAD2 + ".jsonl"
 if os.path.exists(download_file):
     print("NOTE: The following file already exists:", download_file)
-batch_utils.download_response(batchid, download_file, model)
+with metrics.phase("download"):
+    batch_utils.download_response(batchid, download_file, model, metrics.add_record)
 
-list_ids_responses, total_input_tokens, total_reasoning_tokens, total_output_tokens = \
-    batch_utils.extract_response(download_file, model) # does much of the work
+list_ids_responses = batch_utils.extract_response(download_file, model)[0] # does much of the work
 
 # Here is useful information for keeping track of costs
-print("total_input_tokens =", total_input_tokens)
-print("total_reasoning_tokens =", total_reasoning_tokens)
-print("total_output_tokens = ", total_output_tokens)
+metrics.print_totals()
+
+# Add the answers that binary_answers_clarify.py resolved locally, rather than in the batch
+local_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_LOCAL2 + ".jsonl"
+if os.path.exists(local_file):
+    count_local = 0
+    with open(local_file, "r", encoding="utf-8") as f:
+        for line in f:
+            local_answer = json.loads(line)
+            list_ids_responses.append((local_answer["id"], local_answer["answer"]))
+            count_local += 1
+    print("Resolved locally =", count_local, "; clarified in the batch =", len(list_ids_responses) - count_local)
+    metrics.add_count("resolved_locally", count_local)
 
 total_responses = 0
 total_yes_responses = 0
@@ -59,3 +70,7 @@ print("Raw total_unknown_responses=", total_unknown_responses)
 
 print("Num Strategies =", len(list(dict_strategies.keys())))
 print("Num Strategies All Yeses   =", len([x[0] for x in list(dict_strategies.items()) if x[1] is None]))
+
+metrics.add_count("yes_responses", total_yes_responses)
+metrics.add_count("unknown_responses", total_unknown_responses)
+metrics.write()
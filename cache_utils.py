@@ -0,0 +1,99 @@
+# This is a local cache of responses, so that re-running a task with the same model and prompts does not
+# pay for the same calls again, whether they are made immediately or in a batch.  A response is keyed by a
+# hash of everything that determines it: the model, the messages and the generation parameters (e.g.
+# reasoning effort, thinking budget and seed).  The cache is off unless the environment variable
+# RESPONSE_CACHE is set to the sqlite file to keep it in.  Entries are evicted when they have not been used
+# for RESPONSE_CACHE_MAX_AGE_DAYS, or (least recently used first) when the cache grows past
+# RESPONSE_CACHE_MAX_BYTES.
+import atexit, hashlib, json, os, sqlite3, threading, time
+
+RESPONSE_CACHE_FILE = os.getenv("RESPONSE_CACHE")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_AGE_DAYS = float(os.getenv("RESPONSE_CACHE_MAX_AGE_DAYS", "90"))
+TOUCH_FLUSH_HITS = 1000 # hits whose last_used updates are held back and then written in one commit
+
+# Kinds of cached responses, which are stored differently, and so are keyed apart
+KIND_LIVE = "live" # the text of a response to an immediate call
+KIND_BATCH = "batch" # a line of a downloaded batch file
+
+# Returns the key for a request, given its kind and everything that determines its response (as JSON-able
+# data, e.g. the body of a batch request)
+def make_key(kind:str, request) -> str:
+    return hashlib.sha256((kind + "\n" + json.dumps(request, sort_keys=True, separators=(",", ":"))).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, filename:str):
+        self._connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, " +
+                                 "size INTEGER, created REAL, last_used REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._touched = {} # key -> time last used, of the hits not yet written
+        self.evict()
+
+    # Returns the cached response for the key, or None
+    def get(self, key:str):
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_FLUSH_HITS:
+                self._write_touched()
+            return row[0]
+
+    # Writes the held-back last_used updates, in a single commit (the lock must be held)
+    def _write_touched(self):
+        if len(self._touched) > 0:
+            self._connection.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                         [(last_used, key) for key, last_used in self._touched.items()])
+            self._connection.commit()
+            self._touched = {}
+
+    def flush(self):
+        with self._lock:
+            self._write_touched()
+
+    def put(self, key:str, response:str):
+        with self._lock:
+            now = time.time()
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                     (key, response, len(response), now, now))
+            self._connection.commit()
+
+    # Evicts the entries unused for too long, and then the least recently used until the cache is small enough
+    def evict(self, max_bytes:int = RESPONSE_CACHE_MAX_BYTES, max_age_days:float = RESPONSE_CACHE_MAX_AGE_DAYS):
+        with self._lock:
+            self._write_touched()
+            self._connection.execute("DELETE FROM responses WHERE last_used < ?", (time.time() - max_age_days * 86400,))
+            total_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_bytes > max_bytes:
+                cutoff = None
+                for last_used, size in self._connection.execute("SELECT last_used, size FROM responses ORDER BY last_used"):
+                    total_bytes -= size
+                    cutoff = last_used
+                    if total_bytes <= max_bytes:
+                        break
+                self._connection.execute("DELETE FROM responses WHERE last_used <= ?", (cutoff,))
+            self._connection.commit()
+
+    def print_stats(self):
+        if self.hits + self.misses > 0:
+            print("response cache hits =", self.hits, "; misses =", self.misses)
+
+
+_cache = None
+
+# Returns the response cache, or None if caching is off
+def get_cache():
+    global _cache
+    if _cache is None and RESPONSE_CACHE_FILE is not None and len(RESPONSE_CACHE_FILE) > 0:
+        _cache = ResponseCache(RESPONSE_CACHE_FILE)
+        atexit.register(_cache.flush) # so that the last hits' last_used updates are not lost
+    return _cache
@@ -1,9 +1,38 @@
 # This is the code for making immediate calls
 
-import datetime, copy, time
+import copy, os, time
+import log_utils, retry_utils, cache_utils, pipeline_utils
 import openai
 import anthropic
 
+# To run against mock_batch_server.py rather than the real services (e.g. to load-test the pipeline offline),
+# set MOCK_BATCH_SERVER to its URL, e.g. http://127.0.0.1:8765.  The SDKs' clients (here and in batch_utils)
+# pick up the base URLs from the environment, and batch_utils points the Google clients at it too.  All that
+# the runs write (the batch files, pipeline registry and usage history, call log, response cache, metrics and
+# stage logs) then goes under MOCK_SCRATCH_DIR, so that nothing real ever refers to a mock batch or response.
+MOCK_BATCH_SERVER = os.getenv("MOCK_BATCH_SERVER")
+MOCK_SCRATCH_DIR = os.getenv("MOCK_SCRATCH_DIR", "mock_scratch/")
+
+# Where a file or directory that the runs write goes (see MOCK_SCRATCH_DIR)
+def get_run_path(path:str) -> str:
+    return MOCK_SCRATCH_DIR + path if MOCK_BATCH_SERVER else path
+
+if MOCK_BATCH_SERVER:
+    MOCK_BATCH_SERVER = MOCK_BATCH_SERVER.rstrip("/")
+    os.environ["OPENAI_BASE_URL"] = MOCK_BATCH_SERVER + "/v1"
+    os.environ["ANTHROPIC_BASE_URL"] = MOCK_BATCH_SERVER
+    os.environ["STORAGE_EMULATOR_HOST"] = MOCK_BATCH_SERVER
+    for key in ["OPENAI_API_KEY", "ANTHROPIC_API_KEY"]:
+        os.environ.setdefault(key, "mock")
+    os.environ.setdefault("GOOGLE_LOCATION", "us-central1")
+    os.environ.setdefault("GOOGLE_BUCKET", "mock-bucket")
+    os.makedirs(MOCK_SCRATCH_DIR, exist_ok=True)
+    log_utils.DIR_LOG = get_run_path(log_utils.DIR_LOG)
+    log_utils.LOG_INDEX = get_run_path(log_utils.LOG_INDEX)
+    pipeline_utils.PIPELINE_REGISTRY = get_run_path(pipeline_utils.PIPELINE_REGISTRY)
+    if cache_utils.RESPONSE_CACHE_FILE:
+        cache_utils.RESPONSE_CACHE_FILE = get_run_path(os.path.basename(cache_utils.RESPONSE_CACHE_FILE))
+
 
 # This is a simple text query to see if the answer shows the LLM is being nonresponsive
 def is_unresponsive(response:str) -> bool:
@@ -14,120 +43,175 @@ def is_unresponsive(response:str) -> bool:
     return False
 
 
+# Long-lived clients, one per provider (and timeout), so that calls reuse their connection pools rather than
+# making new ones on every attempt.  The clients are safe to share across threads.
+_clients = {}
+
+def get_client(provider:str, timeout:float = None, is_async:bool = False):
+    key = (provider, timeout, is_async)
+    if key not in _clients:
+        client_kwargs = {"max_retries": 0} # retries are up to retry_utils, rather than the SDKs
+        if timeout is not None:
+            client_kwargs["timeout"] = timeout
+        if provider == "openai":
+            _clients[key] = openai.AsyncOpenAI(**client_kwargs) if is_async else openai.OpenAI(**client_kwargs)
+        elif provider == "anthropic":
+            _clients[key] = anthropic.AsyncAnthropic(**client_kwargs) if is_async else anthropic.Anthropic(**client_kwargs)
+        else:
+            assert False, "Provider not supported"
+    return _clients[key]
+
+# Drops the async clients, which can only be used within the event loop they were first used in
+def clear_async_clients():
+    for key in [key for key in _clients if key[2]]:
+        del _clients[key]
+
+# Returns how to call a model: the provider and client timeout, the API, the arguments to it, and a
+# function that gets the text out of the response (printing any token usage of interest).  This is shared
+# by raw_call() and the concurrent engine in async_call_utils.
+def get_call_spec(messages, model:str):
+    if model.startswith("gpt-4"):
+        return "openai", None, "chat", dict(model=model,
+                                            messages=messages,
+                                            temperature=0.0,
+                                            max_tokens=4095,
+                                            timeout=60,
+                                            seed=42), get_chat_text
+
+    elif model.startswith("o1"):
+        # Note that o1 and o3 do not support temperatures
+        return "openai", None, "chat", dict(model=model,
+                                            messages=messages,
+                                            timeout=240,
+                                            seed=42), get_chat_text
+
+    elif model.startswith("o3-20"):
+        # Note that o1 and o3 do not support temperatures
+        # With o3, we always want to use high reasoning effort
+        def get_text(response):
+            print("ACTUAL INPUT TOKENS :", response.usage.prompt_tokens)
+            print("REASONING TOKENS    :", response.usage.completion_tokens_details.reasoning_tokens)
+            print("ACTUAL OUTPUT TOKENS:", response.usage.completion_tokens- \
+                                            response.usage.completion_tokens_details.reasoning_tokens)
+            return get_chat_text(response)
+        return "openai", None, "chat", dict(model=model,
+                                            messages=messages,
+                                            timeout=240,
+                                            seed=42,
+                                            reasoning_effort="high"), get_text
+
+    elif model.startswith("o3-pro"):
+        # Note that o1 and o3 do not support temperatures
+        # With o3-pro, reasoning effort at high is too expensive
+        def get_text(response):
+            print("INPUT TOKENS        :", response.usage.input_tokens)
+            print("REASONING TOKENS    :", response.usage.output_tokens_details.reasoning_tokens)
+            print("ACTUAL OUTPUT TOKENS:",
+                  response.usage.output_tokens-response.usage.output_tokens_details.reasoning_tokens)
+            return response.output_text
+        return "openai", None, "responses", dict(model=model,
+                                                 input=messages), get_text
+
+    elif model.startswith("claude-3"):
+        return "anthropic", None, "messages", dict(model=model,
+                                                   max_tokens=4095,
+                                                   temperature=0,
+                                                   messages=messages), lambda response: response.content[0].text
+
+    elif model.startswith("claude-sonnet-4") or \
+            model.startswith("claude-opus-4-20250514"):
+        # Set the token budget to be the maximum (32000) for claude-opus-4-20250514
+        # Then set the reasoning-token budget to be half of that (16000)
+        # When setting thinking parameter, cannot also set temperature, alas
+        def get_text(response):
+            assert type(response.content[0]) == anthropic.types.thinking_block.ThinkingBlock
+            assert type(response.content[1]) == anthropic.types.text_block.TextBlock
+            print("INPUT TOKENS  (exact):", response.usage.input_tokens)
+            print("SUMMARY THINKING TOKENS (approx):", len(response.content[0].thinking.split()))
+            print("OUTPUT TOKENS (exact):", response.usage.output_tokens)
+            return response.content[1].text
+        return "anthropic", 300.0, "messages", dict(model=model,
+                                                    max_tokens=32000,
+                                                    thinking={"type": "enabled", "budget_tokens": 16000},
+                                                    messages=messages), get_text
+
+    else:
+        assert False, "Model not supported"
+
+def get_chat_text(response) -> str:
+    return response.choices[0].message.content
+
+# The function that makes a call on the given API of a (sync or async) client
+def get_create_function(client, api:str):
+    if api == "chat":
+        return client.chat.completions.create
+    elif api == "responses":
+        return client.responses.create
+    elif api == "messages":
+        return client.messages.create
+    assert False, "API not supported"
+
+
+# What determines the response to a call, for keying the response cache (see cache_utils)
+def get_cache_request(messages, model:str):
+    provider, timeout, api, call_kwargs, get_text = get_call_spec(messages, model)
+    return {key: value for key, value in call_kwargs.items() if key != "timeout"}
+
+# Makes a call, retrying (see retry_utils) on errors that are worth retrying.  If the response cache is on,
+# a cached response is returned rather than making the call again.
 def raw_call(messages_arg, model:str) -> str:
-    count_exceptions = 0
+    cache = cache_utils.get_cache()
+    if cache is not None:
+        cache_key = cache_utils.make_key(cache_utils.KIND_LIVE, get_cache_request(messages_arg, model))
+        cached_rv = cache.get(cache_key)
+        if cached_rv is not None:
+            return cached_rv
+    retry_state = None
     count_unresponsive = 0
     while count_unresponsive < 10:
         messages = copy.deepcopy(messages_arg)  # do deepcopy to keep any changes from interfering with calling function's copy
         rv = None
         try:
-            if model.startswith("gpt-4"):
-                client = openai.OpenAI()
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=0.0,
-                    max_tokens=4095,
-                    timeout=60,
-                    seed=42
-                )
-                rv = response.choices[0].message.content
-
-            elif model.startswith("o1"):
-                # Note that o1 and o3 do not support temperatures
-                client = openai.OpenAI()
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    timeout=240,
-                    seed=42
-                )
-                rv = response.choices[0].message.content
-
-            elif model.startswith("o3-20"):
-                # Note that o1 and o3 do not support temperatures
-                # With o3, we always want to use high reasoning effort
-                client = openai.OpenAI()
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    timeout=240,
-                    seed=42,
-                    reasoning_effort="high"
-                )
-
-                print("ACTUAL INPUT TOKENS :", response.usage.prompt_tokens)
-                print("REASONING TOKENS    :", response.usage.completion_tokens_details.reasoning_tokens)
-                print("ACTUAL OUTPUT TOKENS:", response.usage.completion_tokens- \
-                                                response.usage.completion_tokens_details.reasoning_tokens)
-
-                rv = response.choices[0].message.content
-
-            elif model.startswith("o3-pro"):
-                # Note that o1 and o3 do not support temperatures
-                # With o3-pro, reasoning effort at high is too expensive
-                client = openai.OpenAI()
-                response = client.responses.create(
-                    model=model,
-                    input=messages
-                )
-
-                print("INPUT TOKENS        :", response.usage.input_tokens)
-                print("REASONING TOKENS    :", response.usage.output_tokens_details.reasoning_tokens)
-                print("ACTUAL OUTPUT TOKENS:",
-                      response.usage.output_tokens-response.usage.output_tokens_details.reasoning_tokens)
-
-                rv = response.choices[0].message.content
-
-            elif model.startswith("claude-3"):
-                client = anthropic.Anthropic()
-
-                response = client.messages.create(
-                    model=model,
-                    max_tokens=4095,
-                    temperature=0,
-                    messages=messages)
-
-                rv = response.content[0].text
-
-            elif model.startswith("claude-sonnet-4") or \
-                    model.startswith("claude-opus-4-20250514"):
-                client = anthropic.Anthropic(timeout=300.0)
-                # Set the token budget to be the maximum (32000) for claude-opus-4-20250514
-                # Then set the reasoning-token budget to be half of that (16000)
-                # When setting thinking parameter, cannot also set temperature, alas
-                response = client.messages.create(
-                    model=model,
-                    max_tokens=32000,
-                    thinking={"type": "enabled", "budget_tokens": 16000},
-                    messages=messages)
-
-                assert type(response.content[0]) == anthropic.types.thinking_block.ThinkingBlock
-                assert type(response.content[1]) == anthropic.types.text_block.TextBlock
-                print("INPUT TOKENS  (exact):", response.usage.input_tokens)
-                print("SUMMARY THINKING TOKENS (approx):", len(response.content[0].thinking.split()))
-                print("OUTPUT TOKENS (exact):", response.usage.output_tokens)
-
-                rv = response.output_text
-
-            else:
-                assert False, "Model not supported"
+            provider, timeout, api, call_kwargs, get_text = get_call_spec(messages, model)
+            if retry_state is None:
+                retry_state = retry_utils.RetryState(provider, model)
+            time.sleep(retry_state.get_wait()) # if the circuit breaker is open
+            response = get_create_function(get_client(provider, timeout), api)(**call_kwargs)
+            rv = get_text(response)
+            retry_state.record_success()
 
         except Exception as e:  # Catches most exceptions; often LLM APIs have temporary hiccups
-            count_exceptions += 1
-            print("EXCEPTION from ", model, f", Error Type: {type(e).__name__} {e}, try number {count_exceptions}")
-            if count_exceptions >= 10:
-                raise  # re-throw it, since we've tried repeatedly
-            else:
-                time.sleep(10) # hopefully LLM API hiccup will be resolved
+            delay = None if retry_state is None else retry_state.get_retry_delay(e)
+            if delay is None:
+                raise  # re-throw it, since it is not worth retrying (again)
+            time.sleep(delay) # hopefully LLM API hiccup will be resolved
         else:
             if not is_unresponsive(rv):
+                if cache is not None:
+                    cache.put(cache_key, rv)
                 return rv
             else:
                 count_unresponsive += 1
                 print("Retrying call due to nonresponsive response, number", count_unresponsive, rv)
 
 
+YESNO_FOLLOW_UP = "So the answer (just Yes or No) is:"
+
+# Reads a Yes/No answer: True for yes, False for no, or None if it is neither.  The first response must be
+# just the answer, whereas the response to the follow-up need only start with it.
+def parse_yesno(response:str, is_follow_up:bool = False):
+    if not is_follow_up:
+        stripped_response = response.strip().strip(".").lower()
+        if stripped_response in ["yes", "no"]:
+            return stripped_response == "yes"
+        return None
+    stripped_response = response.strip().strip(".*").lower() # the * is stripped since LLMs may try to bold the answer
+    if stripped_response.startswith("yes"):
+        return True
+    elif stripped_response.startswith("no"):
+        return False
+    return None
+
 # Makes call(s) to API to get Yes/No answers (along with the explanation)
 # Also returns the timestamp from the log file
 def call_api_yesno(prompt:str,
@@ -137,25 +221,19 @@ def call_api_yesno(prompt:str,
     while count_not_yesno < 10:
         messages = [{"role": "user", "content": prompt}]
         response1 = raw_call(messages, model)
-        stripped_response = response1.strip().strip(".").lower()
-        if stripped_response == "yes":
+        answer = parse_yesno(response1)
+        if answer is not None:
             timestamp = log_messages_freeform(messages, context)
-            return True, response1, timestamp
-        elif stripped_response == "no":
-            timestamp = log_messages_freeform(messages, context)
-            return False, response1, timestamp
+            return answer, response1, timestamp
         print("Making Yes/No Followup Call")
         messages.append({"role": "assistant", "content": response1}) # store to re-call and to write to log
-        messages.append({"role": "user", "content": "So the answer (just Yes or No) is:"})
+        messages.append({"role": "user", "content": YESNO_FOLLOW_UP})
         response2 = raw_call(messages, model) # call again!
         messages.append({"role": "assistant", "content": response2}) # store for writing to log
-        stripped_response = response2.strip().strip(".*").lower() # the * is stripped since LLMs may try to bold the answer
-        if stripped_response.startswith("yes"):
-            timestamp = log_messages_freeform(messages, context)
-            return True, response1, timestamp
-        elif stripped_response.startswith("no"):
+        answer = parse_yesno(response2, is_follow_up=True)
+        if answer is not None:
             timestamp = log_messages_freeform(messages, context)
-            return False, response1, timestamp
+            return answer, response1, timestamp
         count_not_yesno += 1
         print("Retrying call due to failure to get yes or no, number",
               count_not_yesno, "response instead was:", response2)
@@ -167,24 +245,15 @@ def call_api_yesno(prompt:str,
 # This allows logging messages with freeform background information
 # Returns the datetime stamp used in the log, to allow cross-referencing, if needed.
 def log_messages_freeform(messages, background:str):
-    timestamp = str(datetime.datetime.now())
-    with open("calls.LOG", "a") as logfile:
-        logfile.write("*******************************************\n")
-        logfile.write(timestamp + "\n")
-        if background is not None and len(background.strip()) > 0:
-            logfile.write(str(background) + "\n")
-        for message in messages:
-            logfile.write("****** " + message["role"] + "\n")
-            logfile.write(message["content"])
-            logfile.write("\n")
-    return timestamp
-
-# Allows writing any type of information into the log file
+    text = ""
+    if background is not None and len(background.strip()) > 0:
+        text += str(background) + "\n"
+    for message in messages:
+        text += "****** " + message["role"] + "\n" + message["content"] + "\n"
+    return log_utils.log_entry(text[:-1])
+
+# Allows writing any type of information into the log (see log_utils), optionally indexed under a test
+# name and batch id, and with a reference to a payload file (which is not copied into the log).
 # Returns the datetime stamp used in the log, to allow cross-referencing, if needed.
-def log_arbitrary(information:str):
-    timestamp = str(datetime.datetime.now())
-    with open("calls.LOG", "a") as logfile:
-        logfile.write("*******************************************\n")
-        logfile.write(timestamp + "\n")
-        logfile.write(information + "\n")
-    return timestamp
+def log_arbitrary(information:str, testname:str = None, batch_id:str = None, payload_file:str = None):
+    return log_utils.log_entry(information, testname, batch_id, payload_file)
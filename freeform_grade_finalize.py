@@ -1,20 +1,21 @@
 import os, sys, re
-import batch_utils, utils
+import batch_utils, metrics_utils, utils
 from scipy.stats import spearmanr
 
 assert len(sys.argv) == 4, "Usage: <testname> <model> <batchid>"
 testname = sys.argv[1]
 model = sys.argv[2]
 batchid = sys.argv[3] # This is an ID used by the server API (e.g. OpenAI's API)
+metrics = metrics_utils.StageMetrics(testname, model, batchid)
 
 # Do the download from the server to a local file
 download_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_DOWNLOAD1 + ".jsonl"
 if os.path.exists(download_file):
     print("NOTE: The following file already exists:", download_file)
-batch_utils.download_response(batchid, download_file, model)
+with metrics.phase("download"):
+    batch_utils.download_response(batchid, download_file, model, metrics.add_record)
 
-list_ids_responses, total_input_tokens, total_reasoning_tokens, total_output_tokens = \
-    batch_utils.extract_response(download_file, model) # does much of the work
+list_ids_responses = batch_utils.extract_response(download_file, model)[0] # does much of the work
 
 # First index is the ACTUAL, and second index is PREDICTED
 dict_confusion_matrix = {
@@ -86,9 +87,7 @@ print(f"P-value: {p_value}")
 
 # Here is useful information for keeping track of costs
 print("argv=", sys.argv[1:])
-print("total_input_tokens =", total_input_tokens)
-print("total_reasoning_tokens =", total_reasoning_tokens)
-print("total_output_tokens = ", total_output_tokens)
+metrics.print_totals()
 
 
 print("Confusion Matrix (columns from model):")
@@ -113,3 +112,4 @@ for human_grade in ["3", "2", "1", "0"]:
 
 print("\ntotal human grades:", dict_total_human_grades, sum(dict_total_human_grades.values()))
 print("total model grades:", dict_total_model_grades, sum(dict_total_model_grades.values()))
+metrics.write()
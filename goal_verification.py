@@ -1,5 +1,5 @@
 import datetime, copy, argparse
-import call_utils, utils, batch_utils
+import call_utils, async_call_utils, utils, batch_utils, prompt_utils
 
 parser = argparse.ArgumentParser(
     description='Runs Goal Verification (with or without analysis, or with adversarial step) on Shelter Check dataset')
@@ -17,79 +17,93 @@ parser.add_argument('--test', required=True,
                     help='which test to run')
 parser.add_argument('--callnow', action="store_true",
                     help='whether to make the calls right now or in batch')
+parser.add_argument('--concurrency', default=async_call_utils.DEFAULT_CONCURRENCY, type=int,
+                    help='with --callnow, how many calls to make at the same time')
+parser.add_argument('--cache_prefix', action="store_true",
+                    help='whether to mark the per-strategy preamble as a cached prefix (where the provider supports it)')
 args = parser.parse_args()
 print("args=", args)
 start_timestamp = call_utils.log_arbitrary("goal_verification, with args=" + str(args))
 
-list_ids_prompts = [] # These will be actually passed to the LLM; list of 2-tuples of (id, prompt)
-for filename in utils.get_list_filenames():
-    if args.num is None or filename == utils.get_filename_from_prefix(args.num):
-        include_analysis = (args.test == "goal_verification_with_analysis")
-        use_adversarial_step = (args.test == "goal_verification_adversarial_step")
+# The prompt is compiled once for this test; the per-strategy part is bound once per strategy, and then
+# each goal is rendered from that.
+include_analysis = (args.test == "goal_verification_with_analysis")
+use_adversarial_step = (args.test == "goal_verification_adversarial_step")
+template_str = "You will be determining whether a specified tax strategy meets a particular goal, "
+if include_analysis:
+    template_str += "given the authorities, factual background, and analysis of the strategy below. "
+else:
+    template_str += "given the authorities and factual background below. "
+template_str += "{ignore_doctrines}\n\nHere are the authorities you will be applying:\n\n{authorities}{background}" + \
+                "\n\nHere is the strategy:\n\n{strategy}"
+if include_analysis:
+    template_str += "\n\nHere is an analysis of the strategy:\n\n{analysis}" + \
+                    "\n\nBased on the legal authorities, background, and analysis above, "
+else:
+    template_str += "\n\nBased on the legal authorities and background above, "
+if args.standard == 'viable':
+    template_str += "is it viable that the strategy above meets the following goal?  " + \
+                    "Spell out your reasoning in detail, and resolve all reasonable doubts " + \
+                    "in favor of the strategy being viable for meeting the goal.  Here is the goal: "
+elif args.standard == 'correct':
+    template_str += "is it correct that the strategy above meets the following goal?  " + \
+                    "Spell out your reasoning in detail.  Here is the goal: "
+else:
+    assert False
+template_str += "{goal}"
+PROMPT_TEMPLATE = prompt_utils.PromptTemplate(template_str).bind(ignore_doctrines=utils.IGNORE_DOCTRINES_PROMPT_TEXT)
 
-        authorities_str, background_str, goal_str, strategy_str, analysis_str, \
-            adversarial_step_str, primary_area_str, strategy_type_str = utils.parse_file(filename)
+# Generates the (id, prompt) pairs that will be actually passed to the LLM, one at a time, so that they
+# can be streamed straight to the batch file
+def generate_ids_prompts():
+    for filename in utils.get_list_filenames():
+        if args.num is None or filename == utils.get_filename_from_prefix(args.num):
+            record = utils.load_strategy(filename)
 
-        prompt_start = "You will be determining whether a specified tax strategy meets a particular goal, "
-        if include_analysis:
-            prompt_start += "given the authorities, factual background, and analysis of the strategy below. "
-        else:
-            prompt_start += "given the authorities and factual background below. "
-        prompt_start += utils.IGNORE_DOCTRINES_PROMPT_TEXT
+            if use_adversarial_step:
+                strategy_str = utils.replace_adversarial_step(record.strategy_str, record.adversarial_step_str)
+            else:
+                strategy_str = record.strategy_str
+            strategy_fields = {"authorities": record.authorities_str,
+                               "background": prompt_utils.optional_section("\n\nHere is the background:\n\n",
+                                                                           record.background_str),
+                               "strategy": strategy_str}
+            if include_analysis:
+                strategy_fields["analysis"] = record.analysis_str
+            strategy_template = PROMPT_TEMPLATE.bind(**strategy_fields)
 
-        prompt_start += "\n\nHere are the authorities you will be applying:\n\n" + authorities_str
-        if len(background_str.strip()) > 0:
-            prompt_start += "\n\nHere is the background:\n\n" + background_str
+            # Iterate over all goals for the strategy.  Most strategies have only one goal, but some have
+            # up to four.  We want to meet all goals for a strategy to "pass."
+            for idx_goal, goal in enumerate(record.goals):
+                if args.cache_prefix:
+                    prompt = strategy_template.render_split(goal=goal)
+                else:
+                    prompt = strategy_template.render(goal=goal)
 
-        prompt_start += "\n\nHere is the strategy:\n\n"
-        if use_adversarial_step:
-            prompt_start += utils.replace_adversarial_step(strategy_str, adversarial_step_str)
-        else:
-            prompt_start += strategy_str
-
-        if include_analysis:
-            prompt_start += "\n\nHere is an analysis of the strategy:\n\n" + analysis_str
-
-        if include_analysis:
-            prompt_start += "\n\nBased on the legal authorities, background, and analysis above, "
-        else:
-            prompt_start += "\n\nBased on the legal authorities and background above, "
-
-        if args.standard == 'viable':
-            prompt_start += "is it viable that the strategy above meets the following goal?  " + \
-                            "Spell out your reasoning in detail, and resolve all reasonable doubts " + \
-                            "in favor of the strategy being viable for meeting the goal.  Here is the goal: "
-        elif args.standard == 'correct':
-            prompt_start += "is it correct that the strategy above meets the following goal?  " + \
-                            "Spell out your reasoning in detail.  Here is the goal: "
-        else:
-            assert False
-
-        # Iterate over all goals for the strategy.  Most strategies have only one goal, but some have
-        # up to four.  We want to meet all goals for a strategy to "pass."
-        goals = utils.strip_numbering(goal_str)
-        for idx_goal, goal in enumerate(goals):
-            prompt = prompt_start + goal
-
-            id = "Strategy_" + utils.get_prefix_from_filename(filename) + \
-                "_Goal_" + str(idx_goal+1)
-            list_ids_prompts.append((id, prompt))
+                id = "Strategy_" + utils.get_prefix_from_filename(filename) + \
+                    "_Goal_" + str(idx_goal+1)
+                yield id, prompt
 
 if args.callnow:
     num_correct = 0
     total_called = 0
-    for id, prompt in list_ids_prompts:
+    num_failed = 0
+    ids_prompts = list(generate_ids_prompts())
+    results = async_call_utils.call_api_yesno_many([prompt_utils.prompt_text(prompt) for id, prompt in ids_prompts],
+                                                   args.model, "goal_verification: " + str(args), args.concurrency)
+    for (id, prompt), (correct, explanation, timestamp) in zip(ids_prompts, results):
         print("********: id=", id)
         print(prompt)
-        correct, explanation, timestamp = \
-            call_utils.call_api_yesno(prompt, args.model, "goal_verification: " + str(args))
         print("TIMESTAMP =", timestamp)
         print("CORRECT=", correct)
         print(explanation)
+        if correct is None: # the call failed
+            num_failed += 1
+            continue
         total_called += 1
         if correct:
             num_correct += 1
-    print("num_correct =", num_correct, "; total_called =", total_called)
+    print("num_correct =", num_correct, "; total_called =", total_called, "; num_failed =", num_failed)
 else: # then we are creating a batch file
     if args.num is None:
         testname = batch_utils.get_testname(args.test, args.model)
@@ -99,5 +113,5 @@ else: # then we are creating a batch file
     batch_filename = batch_utils.write_batch_file(testname,
                                                   batch_utils.POSTFIX_UPLOAD1,
                                                   args.model,
-                                                  list_ids_prompts)
+                                                  generate_ids_prompts())
     batch_utils.upload_file_and_start(batch_filename, args.model)
@@ -0,0 +1,111 @@
+# This file handles the log of calls, kept in calls_log/.
+# Each entry is compressed on its own and appended to the current segment file; a segment is rotated out
+# once it gets big, so no single file grows without bound.  An sqlite index records where each entry is,
+# along with its timestamp, test name and batch id, so that an entry can be found without scanning the log.
+# Batch files are not copied into the log; an entry just refers to them (by name, size and hash).
+import datetime, gzip, hashlib, os, sqlite3, argparse
+
+DIR_LOG = "calls_log/"
+LOG_INDEX = DIR_LOG + "index.sqlite"
+LOG_SEGMENT_BYTES = 64 * 1024 * 1024 # a segment is rotated out once it is at least this big
+LOG_SEGMENT_PREFIX = "segment_"
+LOG_SEGMENT_POSTFIX = ".log.gz"
+LOG_SEPARATOR = "*******************************************\n"
+
+_index_connection = None
+
+def get_index_connection():
+    global _index_connection
+    if _index_connection is None:
+        os.makedirs(DIR_LOG, exist_ok=True)
+        # isolation_level=None so that the BEGIN IMMEDIATE in log_entry() is what serializes writers, even
+        # across processes
+        _index_connection = sqlite3.connect(LOG_INDEX, timeout=60, isolation_level=None)
+        _index_connection.execute("CREATE TABLE IF NOT EXISTS entries (timestamp TEXT, testname TEXT, batch_id TEXT, " +
+                                  "segment INTEGER, offset INTEGER, length INTEGER, payload_file TEXT)")
+        for column in ["timestamp", "testname", "batch_id"]:
+            _index_connection.execute("CREATE INDEX IF NOT EXISTS entries_" + column + " ON entries (" + column + ")")
+    return _index_connection
+
+def get_segment_filename(segment:int) -> str:
+    return DIR_LOG + LOG_SEGMENT_PREFIX + str(segment).zfill(6) + LOG_SEGMENT_POSTFIX
+
+# A short reference to a payload file (e.g. a batch upload or download), to log in place of its contents
+def describe_payload_file(filename:str) -> str:
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    return "PAYLOAD FILE " + filename + " (" + str(os.path.getsize(filename)) + " bytes, sha256=" + \
+        hasher.hexdigest() + ")\n"
+
+# Appends an entry to the log, and indexes it under its timestamp and any test name and batch id.
+# If payload_file is passed, a reference to that file is logged after the text (rather than its contents).
+# Returns the timestamp used in the log, to allow cross-referencing, if needed.
+def log_entry(text:str, testname:str = None, batch_id:str = None, payload_file:str = None) -> str:
+    timestamp = str(datetime.datetime.now())
+    entry = LOG_SEPARATOR + timestamp + "\n" + text + "\n"
+    if payload_file is not None:
+        entry += describe_payload_file(payload_file)
+    # Each entry is a complete gzip member, so a segment is still a valid .gz file (e.g. for zcat), and any
+    # one entry can be decompressed on its own given its offset and length
+    compressed = gzip.compress(entry.encode("utf-8"))
+
+    connection = get_index_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        segment = connection.execute("SELECT MAX(segment) FROM entries").fetchone()[0]
+        if segment is None:
+            segment = 1
+        elif os.path.exists(get_segment_filename(segment)) and \
+                os.path.getsize(get_segment_filename(segment)) >= LOG_SEGMENT_BYTES:
+            segment += 1
+        with open(get_segment_filename(segment), "ab") as f:
+            offset = f.tell()
+            f.write(compressed)
+        connection.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (timestamp, testname, batch_id, segment, offset, len(compressed), payload_file))
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+    return timestamp
+
+# Returns the (timestamp, testname, batch_id, segment, offset, length, payload_file) rows of the matching
+# entries, oldest first.  A timestamp matches as a prefix (e.g. "2025-06-01" matches the whole day).
+def find_entries(timestamp:str = None, testname:str = None, batch_id:str = None) -> list:
+    conditions = []
+    values = []
+    if timestamp is not None:
+        conditions.append("timestamp LIKE ?")
+        values.append(timestamp + "%")
+    if testname is not None:
+        conditions.append("testname = ?")
+        values.append(testname)
+    if batch_id is not None: # a sharded run is indexed under the joined batch ids, so match any one of them
+        conditions.append("(',' || batch_id || ',') LIKE ?")
+        values.append("%," + batch_id + ",%")
+    query = "SELECT * FROM entries"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    return get_index_connection().execute(query + " ORDER BY timestamp", values).fetchall()
+
+# Reads back the text of an entry, given its row from find_entries()
+def read_entry(row) -> str:
+    segment, offset, length = row[3], row[4], row[5]
+    with open(get_segment_filename(segment), "rb") as f:
+        f.seek(offset)
+        return gzip.decompress(f.read(length)).decode("utf-8")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prints the logged entries matching the given keys')
+    parser.add_argument('--timestamp', required=False,
+                        help='timestamp (or prefix of it, e.g. a date) of the entries')
+    parser.add_argument('--testname', required=False,
+                        help='test name of the entries')
+    parser.add_argument('--batch_id', required=False,
+                        help='batch id of the entries')
+    args = parser.parse_args()
+    for row in find_entries(args.timestamp, args.testname, args.batch_id):
+        print(read_entry(row), end="")
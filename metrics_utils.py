@@ -0,0 +1,209 @@
+# This file records the metrics of a stage (i.e. a run of one of the scripts that processes a batch's
+# responses): the token usage of each response and in total, per strategy and for the stage, the estimated
+# cost by the price table below, how long the batch took from being submitted to completing, and how long
+# the stage itself took (by phase, e.g. downloading).  When the stage finishes, they are written to
+# metrics/, as JSON (everything), CSV (a row per response) and a Prometheus-style textfile (the totals),
+# so that the stages' costs can be compared across tasks and strategies.
+import contextlib, csv, json, os, re, sys, time
+import batch_utils, call_utils, response_utils
+
+DIR_METRICS = call_utils.get_run_path("metrics/")
+METRIC_PREFIX = "llm_batch_"
+
+# Dollars per million tokens, as (input, cached input, cache write, output), at the batch APIs' prices
+# (i.e. half of the prices of immediate calls).  A model is priced by the longest prefix of its name here,
+# so update them as the providers' prices change.  Responses spliced in from the response cache or from other
+# runs (see response_utils.SPLICED_KEY) cost nothing, and immediate calls cost LIVE_PRICE_MULTIPLIER times as much.
+PRICES_PER_MILLION = {
+    "gpt-4.1-nano": (0.05, 0.0125, 0.0, 0.2),
+    "gpt-4.1-mini": (0.2, 0.05, 0.0, 0.8),
+    "gpt-4.1": (1.0, 0.25, 0.0, 4.0),
+    "gpt-4o-mini": (0.075, 0.0375, 0.0, 0.3),
+    "gpt-4o": (1.25, 0.625, 0.0, 5.0),
+    "o1": (7.5, 3.75, 0.0, 30.0),
+    "o3-pro": (10.0, 10.0, 0.0, 40.0),
+    "o3": (1.0, 0.25, 0.0, 4.0),
+    "claude-opus-4": (7.5, 0.75, 9.375, 37.5),
+    "claude-sonnet-4": (1.5, 0.15, 1.875, 7.5),
+    "claude-3-7-sonnet": (1.5, 0.15, 1.875, 7.5),
+    "claude-3-5-haiku": (0.4, 0.04, 0.5, 2.0),
+    "gemini-2.5-pro": (0.625, 0.155, 0.0, 5.0),
+    "gemini-2.5-flash": (0.15, 0.0375, 0.0, 1.25),
+}
+LIVE_PRICE_MULTIPLIER = 2.0
+
+# Returns the (input, cached input, cache write, output) prices for a model, or None if it is not in the table
+def get_prices(model:str):
+    prefixes = [prefix for prefix in PRICES_PER_MILLION if model.startswith(prefix)]
+    if len(prefixes) == 0:
+        return None
+    return PRICES_PER_MILLION[max(prefixes, key=len)]
+
+# The estimated cost (in dollars) of a response, or of the totals of many.  The providers count differently:
+# OpenAI and Gemini include the cached tokens in the input tokens, Claude does not; OpenAI includes the
+# reasoning tokens in the output tokens, Gemini does not (and Claude does not report them apart).
+def estimate_cost(model:str, usage) -> float:
+    prices = get_prices(model)
+    if prices is None:
+        return 0.0
+    input_price, cached_price, cache_write_price, output_price = prices
+    uncached_tokens = usage.input_tokens if batch_utils.is_claude(model) else usage.input_tokens - usage.cached_tokens
+    billed_output_tokens = usage.output_tokens + (usage.reasoning_tokens if batch_utils.is_google(model) else 0)
+    return (uncached_tokens * input_price + usage.cached_tokens * cached_price +
+            usage.cache_write_tokens * cache_write_price + billed_output_tokens * output_price) / 1e6
+
+# The estimated cost (in dollars) of a single response, by where it came from
+def estimate_record_cost(model:str, record:response_utils.ResponseRecord) -> float:
+    if record.is_spliced():
+        return 0.0
+    cost = estimate_cost(model, record)
+    return cost * LIVE_PRICE_MULTIPLIER if record.source == response_utils.SOURCE_LIVE else cost
+
+# The group that a response counts towards in the breakdown, e.g. "Strategy_3" for "Strategy_3_Step_2"
+def get_group(id:str) -> str:
+    match = re.match(r"(Strategy_\d+)", id)
+    if match is not None:
+        return match.group(1)
+    return id.split("_")[0]
+
+USAGE_FIELDS = ["input_tokens", "cached_tokens", "cache_write_tokens", "reasoning_tokens", "output_tokens"]
+
+
+class StageMetrics:
+    def __init__(self, testname:str, model:str, batchid:str = None, stage:str = None):
+        self.testname = testname
+        self.model = model
+        self.batchid = batchid
+        self.stage = os.path.splitext(os.path.basename(sys.argv[0]))[0] if stage is None else stage
+        self.totals = response_utils.UsageTotals()
+        self.totals_by_group = {} # group -> UsageTotals
+        self.cost = 0.0 # estimated, of the responses paid for by this stage
+        self.cost_by_group = {} # group -> estimated cost
+        self.rows = [] # a dict per response
+        self.counts = {} # other counts of interest, e.g. of the answers resolved locally
+        self.phase_seconds = {}
+        self._start = time.time()
+
+    # Records the usage of a response (e.g. as the on_record of batch_utils.download_response, or from
+    # response_utils.normalize_live for an immediate call)
+    def add_record(self, record:response_utils.ResponseRecord):
+        self.totals.add(record)
+        group = get_group(record.id)
+        if group not in self.totals_by_group:
+            self.totals_by_group[group] = response_utils.UsageTotals()
+            self.cost_by_group[group] = 0.0
+        self.totals_by_group[group].add(record)
+        cost = estimate_record_cost(self.model, record)
+        self.cost += cost
+        self.cost_by_group[group] += cost
+        if record.source is not None:
+            self.add_count(record.source + "_responses")
+        row = {"id": record.id, "group": group, "source": record.source or "batch"}
+        for field in USAGE_FIELDS:
+            row[field] = getattr(record, field)
+        row["cost"] = cost
+        row["error"] = "" if record.error is None else str(record.error)
+        self.rows.append(row)
+
+    def add_count(self, name:str, value:int = 1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    # Times a phase of the stage, e.g. with metrics.phase("download"): ...
+    @contextlib.contextmanager
+    def phase(self, name:str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + time.time() - start
+
+    # Here is useful information for keeping track of costs
+    def print_totals(self):
+        self.totals.print_totals()
+        if get_prices(self.model) is None:
+            print("NOTE: no prices for", self.model, "in metrics_utils.PRICES_PER_MILLION")
+        else:
+            print("estimated_cost = $%.4f" % self.cost)
+        spliced_count = self.counts.get(response_utils.SOURCE_CACHE + "_responses", 0) + \
+            self.counts.get(response_utils.SOURCE_ALIAS + "_responses", 0)
+        if spliced_count > 0:
+            print("(not counting the", spliced_count, "responses reused from the response cache or other runs)")
+
+    # Seconds from the batch being submitted to completing, or None if unknown (e.g. nothing was submitted)
+    def get_batch_latency(self):
+        if self.batchid is None:
+            return None
+        try:
+            batch_times = batch_utils.get_batch_times(self.batchid, self.model)
+        except Exception as e: # the metrics are not worth failing the stage over
+            print("NOTE: could not get the batch times:", type(e).__name__, e)
+            return None
+        if batch_times is None:
+            return None
+        return batch_times[1] - batch_times[0]
+
+    def get_summary(self) -> dict:
+        summary = {"testname": self.testname, "stage": self.stage, "model": self.model, "batchid": self.batchid,
+                   "responses": self.totals.count,
+                   "estimated_cost": self.cost,
+                   "batch_latency_seconds": self.get_batch_latency(),
+                   "processing_seconds": time.time() - self._start,
+                   "phase_seconds": self.phase_seconds,
+                   "counts": self.counts,
+                   "groups": {}}
+        for field in USAGE_FIELDS:
+            summary[field] = getattr(self.totals, field)
+        for group, totals in sorted(self.totals_by_group.items()):
+            summary["groups"][group] = {field: getattr(totals, field) for field in USAGE_FIELDS}
+            summary["groups"][group]["responses"] = totals.count
+            summary["groups"][group]["estimated_cost"] = self.cost_by_group[group]
+        return summary
+
+    # Writes the metrics to metrics/<testname>_<stage>.json, .csv and .prom, returning the summary
+    def write(self) -> dict:
+        os.makedirs(DIR_METRICS, exist_ok=True)
+        filename_base = DIR_METRICS + self.testname + "_" + self.stage
+        summary = self.get_summary()
+        with open(filename_base + ".json", "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "responses": self.rows}, f, indent=1)
+        with open(filename_base + ".csv", "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["id", "group", "source"] + USAGE_FIELDS + ["cost", "error"])
+            writer.writeheader()
+            writer.writerows(self.rows)
+        with open(filename_base + ".prom.tmp", "w", encoding="utf-8") as f:
+            f.write(format_prometheus(summary))
+        os.replace(filename_base + ".prom.tmp", filename_base + ".prom") # the collector must never see half a file
+        print("Metrics written to", filename_base + ".{json,csv,prom}")
+        return summary
+
+
+# The totals of a stage in the Prometheus text format (e.g. for node_exporter's textfile collector)
+def format_prometheus(summary:dict) -> str:
+    def labels(**extra):
+        values = {"testname": summary["testname"], "stage": summary["stage"], "model": summary["model"]}
+        values.update(extra)
+        return "{" + ",".join([key + "=\"" + str(value).replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+                               for key, value in values.items()]) + "}"
+    lines = []
+    def add_metric(name:str, metric_type:str, description:str, samples):
+        lines.append("# HELP " + METRIC_PREFIX + name + " " + description)
+        lines.append("# TYPE " + METRIC_PREFIX + name + " " + metric_type)
+        for sample_labels, value in samples:
+            lines.append(METRIC_PREFIX + name + sample_labels + " " + str(value))
+
+    add_metric("tokens_total", "counter", "Tokens used, by kind",
+               [(labels(kind=field[:-len("_tokens")]), summary[field]) for field in USAGE_FIELDS])
+    add_metric("responses_total", "counter", "Responses processed", [(labels(), summary["responses"])])
+    add_metric("cost_dollars", "gauge", "Estimated cost", [(labels(), "%.6f" % summary["estimated_cost"])])
+    add_metric("group_cost_dollars", "gauge", "Estimated cost, by group (e.g. strategy)",
+               [(labels(group=group), "%.6f" % totals["estimated_cost"]) for group, totals in summary["groups"].items()])
+    if summary["batch_latency_seconds"] is not None:
+        add_metric("latency_seconds", "gauge", "Seconds from the batch being submitted to completing",
+                   [(labels(), "%.1f" % summary["batch_latency_seconds"])])
+    add_metric("processing_seconds", "gauge", "Seconds the stage took, by phase (all for the whole stage)",
+               [(labels(phase="all"), "%.3f" % summary["processing_seconds"])] +
+               [(labels(phase=phase), "%.3f" % seconds) for phase, seconds in summary["phase_seconds"].items()])
+    if len(summary["counts"]) > 0:
+        add_metric("items_total", "counter", "Other counts of the stage, by name",
+                   [(labels(name=name), value) for name, value in summary["counts"].items()])
+    return "\n".join(lines) + "\n"
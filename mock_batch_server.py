@@ -0,0 +1,586 @@
+# This is a local stand-in for the providers' services, so that the pipeline can be run, load-tested and
+# benchmarked without the network (or the bill).  It implements the parts of the APIs that batch_utils and
+# call_utils use: OpenAI's files, batches, chat completions and responses; Anthropic's message batches and
+# messages; and Vertex AI's batch prediction jobs along with the Google Cloud Storage uploads and downloads
+# they read from and write to.  The responses are synthetic, but shaped so that each task's later stages can
+# process them (e.g. a Yes/No verdict, or a step-cloze grade).  Latency, throughput and failures (of items, of
+# whole batches, and of HTTP requests) can be injected.
+#   To run the server: python mock_batch_server.py --port 8765
+#   and then, to point batch_utils and call_utils at it: export MOCK_BATCH_SERVER=http://127.0.0.1:8765
+#   (the runs' files, registry, logs and cache then go under mock_scratch/, or MOCK_SCRATCH_DIR if set)
+#   To benchmark the pipeline code end to end on it: python mock_batch_server.py --benchmark 100000 --model o3-2025-04-16
+import argparse, base64, datetime, email.parser, email.policy, hashlib, json, os, random, re, threading, time, \
+    urllib.parse, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8765
+YESNO_FOLLOW_UP = "So the answer (just Yes or No) is:" # as in call_utils
+
+parser = argparse.ArgumentParser(
+    description='Runs a local stand-in for the OpenAI, Anthropic and Vertex AI/GCS batch APIs')
+parser.add_argument('--port', default=DEFAULT_PORT, type=int)
+parser.add_argument('--request_latency', default=0.0, type=float,
+                    help='seconds added to every HTTP request')
+parser.add_argument('--batch_latency', default=2.0, type=float,
+                    help='seconds before a batch starts making progress')
+parser.add_argument('--throughput', default=10000.0, type=float,
+                    help='items per second that a batch completes, once it has started')
+parser.add_argument('--item_failure_rate', default=0.0, type=float,
+                    help='fraction of the items of a batch that fail')
+parser.add_argument('--batch_failure_rate', default=0.0, type=float,
+                    help='fraction of batches that fail as a whole')
+parser.add_argument('--http_error_rate', default=0.0, type=float,
+                    help='fraction of API requests answered with a retryable error (429, 500 or 503/529)')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed for the synthetic responses and injected failures')
+parser.add_argument('--benchmark', default=0, type=int,
+                    help='instead of serving, run a batch of this many synthetic items through the pipeline code')
+parser.add_argument('--model', default="o3-2025-04-16",
+                    help='the model to benchmark with')
+
+
+def timestamp_rfc3339(t:float) -> str:
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+def count_tokens(text:str) -> int:
+    return len(text) // 4 + 1
+
+def new_id(prefix:str) -> str:
+    return prefix + uuid.uuid4().hex[:24]
+
+# The text of a message's content, whether a string, a list of content blocks, or a list of Gemini parts
+def get_content_text(content) -> str:
+    if type(content) == str:
+        return content
+    return "".join([block.get("text", "") for block in content])
+
+# A synthetic response to a prompt, shaped like what each task expects back
+def make_response_text(prompt:str, rng:random.Random) -> str:
+    items = re.findall(r"^ITEM (\d+)$", prompt, re.MULTILINE)
+    if len(items) > 0: # a packed step-cloze grading (see step_grading_utils)
+        return "\n".join(["ITEM " + item + ": " + rng.choice("0123") for item in items])
+    elif "3, 2, 1 or 0" in prompt:
+        return rng.choice("0123")
+    elif prompt.strip().endswith(YESNO_FOLLOW_UP):
+        return rng.choice(["Yes", "No"])
+    elif rng.random() < 0.2: # some answers are ambiguous, needing clarification
+        return "It depends on the facts; there are arguments either way."
+    return "This is the analysis of the question.\n\nAnswer: " + rng.choice(["Yes", "No"])
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.files = {} # OpenAI file id -> {"data", "filename", "purpose", "created_at"}
+        self.batches = {} # batch id (OpenAI, Anthropic or Vertex) -> batch (see new_batch)
+        self.objects = {} # (GCS bucket, object name) -> data
+        self.resumable_uploads = {} # upload id -> {"bucket", "name", "data"}
+        self.requests_served = 0
+
+    def get_rng(self, *keys) -> random.Random:
+        return random.Random(hashlib.sha256(json.dumps([self.args.seed] + list(keys)).encode("utf-8")).digest())
+
+    # Starts a batch of the given kind ("openai", "anthropic" or "vertex") on the given requests
+    def new_batch(self, kind:str, batch_id:str, requests:list, extra:dict) -> dict:
+        now = time.time()
+        rng = self.get_rng("batch", batch_id)
+        batch = {"kind": kind, "id": batch_id, "requests": requests, "created_at": now,
+                 "done_at": now + self.args.batch_latency + len(requests) / self.args.throughput,
+                 "fails": rng.random() < self.args.batch_failure_rate, "results": None}
+        batch.update(extra)
+        with self.lock:
+            self.batches[batch_id] = batch
+        return batch
+
+    # Whether the batch has finished, making its results the first time it is found to have
+    def check_batch(self, batch:dict) -> bool:
+        if time.time() < batch["done_at"]:
+            return False
+        with self.lock:
+            if batch["results"] is None and not batch["fails"]:
+                batch["results"] = self.make_results(batch)
+        return True
+
+    def make_results(self, batch:dict):
+        num_failed = 0
+        successes = []
+        failures = []
+        for request in batch["requests"]:
+            request_id = request["custom_id"] if "custom_id" in request else request["key"]
+            rng = self.get_rng("item", batch["id"], request_id)
+            if rng.random() < self.args.item_failure_rate:
+                failures.append(self.make_failed_line(batch["kind"], request, request_id))
+                num_failed += 1
+            else:
+                successes.append(self.make_response_line(batch["kind"], request, request_id, rng))
+        batch["num_failed"] = num_failed
+        if batch["kind"] == "openai": # failed requests go to a file of their own
+            batch["output_file_id"] = self.add_file("\n".join(successes) + "\n", "batch_output")
+            batch["error_file_id"] = None if num_failed == 0 else self.add_file("\n".join(failures) + "\n", "batch_output")
+        elif batch["kind"] == "vertex":
+            self.objects[(batch["output_bucket"], batch["output_directory"] + "/predictions.jsonl")] = \
+                ("\n".join(successes + failures) + "\n").encode("utf-8")
+        return "\n".join(successes + failures) + "\n"
+
+    def add_file(self, text:str, purpose:str) -> str:
+        file_id = new_id("file-")
+        self.files[file_id] = {"data": text.encode("utf-8"), "filename": file_id + ".jsonl", "purpose": purpose,
+                               "created_at": int(time.time())}
+        return file_id
+
+    def make_response_line(self, kind:str, request:dict, request_id:str, rng:random.Random) -> str:
+        if kind == "openai":
+            return json.dumps({"id": new_id("batch_req_"), "custom_id": request_id,
+                               "response": {"status_code": 200, "request_id": new_id("req_"),
+                                            "body": make_chat_completion(request["body"], rng)},
+                               "error": None})
+        elif kind == "anthropic":
+            return json.dumps({"custom_id": request_id,
+                               "result": {"type": "succeeded", "message": make_message(request["params"], rng)}})
+        contents = request["request"]["contents"]
+        prompt = get_content_text(contents[-1]["parts"])
+        text = make_response_text(prompt, rng)
+        input_tokens = sum([count_tokens(get_content_text(content["parts"])) for content in contents])
+        return json.dumps({"key": request_id, "request": request["request"], "status": "",
+                           "processed_time": timestamp_rfc3339(time.time()),
+                           "response": {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]},
+                                                        "finishReason": "STOP"}],
+                                        "usageMetadata": {"promptTokenCount": input_tokens,
+                                                          "candidatesTokenCount": count_tokens(text),
+                                                          "thoughtsTokenCount": 4 * count_tokens(text),
+                                                          "totalTokenCount": input_tokens + 5 * count_tokens(text)},
+                                        "modelVersion": "mock"}})
+
+    def make_failed_line(self, kind:str, request:dict, request_id:str) -> str:
+        if kind == "openai":
+            return json.dumps({"id": new_id("batch_req_"), "custom_id": request_id, "response": None,
+                               "error": {"code": "server_error", "message": "injected failure (mock)"}})
+        elif kind == "anthropic":
+            return json.dumps({"custom_id": request_id,
+                               "result": {"type": "errored",
+                                          "error": {"type": "error", "error": {"type": "api_error",
+                                                                               "message": "injected failure (mock)"}}}})
+        return json.dumps({"key": request_id, "request": request["request"], "status": "injected failure (mock)",
+                           "processed_time": timestamp_rfc3339(time.time())})
+
+
+def make_chat_completion(body:dict, rng:random.Random) -> dict:
+    prompt = get_content_text(body["messages"][-1]["content"])
+    text = make_response_text(prompt, rng)
+    input_tokens = sum([count_tokens(get_content_text(message["content"])) for message in body["messages"]])
+    reasoning_tokens = 4 * count_tokens(text) if "reasoning_effort" in body or body["model"].startswith("o") else 0
+    return {"id": new_id("chatcmpl-"), "object": "chat.completion", "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text, "refusal": None},
+                         "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": input_tokens, "completion_tokens": count_tokens(text) + reasoning_tokens,
+                      "total_tokens": input_tokens + count_tokens(text) + reasoning_tokens,
+                      "prompt_tokens_details": {"cached_tokens": 0},
+                      "completion_tokens_details": {"reasoning_tokens": reasoning_tokens}}}
+
+def make_openai_response(body:dict, rng:random.Random) -> dict:
+    messages = body["input"] if type(body["input"]) == list else [{"role": "user", "content": body["input"]}]
+    text = make_response_text(get_content_text(messages[-1]["content"]), rng)
+    input_tokens = sum([count_tokens(get_content_text(message["content"])) for message in messages])
+    reasoning_tokens = 4 * count_tokens(text)
+    return {"id": new_id("resp_"), "object": "response", "created_at": int(time.time()), "model": body["model"],
+            "status": "completed", "parallel_tool_calls": True, "tool_choice": "auto", "tools": [],
+            "output": [{"type": "reasoning", "id": new_id("rs_"), "summary": []},
+                       {"type": "message", "id": new_id("msg_"), "role": "assistant", "status": "completed",
+                        "content": [{"type": "output_text", "text": text, "annotations": []}]}],
+            "usage": {"input_tokens": input_tokens, "input_tokens_details": {"cached_tokens": 0},
+                      "output_tokens": count_tokens(text) + reasoning_tokens,
+                      "output_tokens_details": {"reasoning_tokens": reasoning_tokens},
+                      "total_tokens": input_tokens + count_tokens(text) + reasoning_tokens}}
+
+def make_message(params:dict, rng:random.Random) -> dict:
+    prompt = get_content_text(params["messages"][-1]["content"])
+    text = make_response_text(prompt, rng)
+    content = [{"type": "text", "text": text}]
+    output_tokens = count_tokens(text)
+    if "thinking" in params:
+        thinking = "Let me think about this. " * (1 + rng.randrange(5))
+        content.insert(0, {"type": "thinking", "thinking": thinking, "signature": "mock"})
+        output_tokens += count_tokens(thinking)
+    return {"id": new_id("msg_"), "type": "message", "role": "assistant", "model": params["model"],
+            "content": content, "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": sum([count_tokens(get_content_text(message["content"]))
+                                           for message in params["messages"]]),
+                      "output_tokens": output_tokens,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}}
+
+def openai_batch_object(state:MockState, batch:dict) -> dict:
+    is_done = state.check_batch(batch)
+    status = "in_progress" if not is_done else ("failed" if batch["fails"] else "completed")
+    done_at = int(batch["done_at"]) if is_done else None
+    num_failed = batch.get("num_failed", 0)
+    return {"id": batch["id"], "object": "batch", "endpoint": batch["endpoint"],
+            "errors": {"object": "list", "data": [{"code": "mock_failure", "message": "injected failure (mock)"}]}
+            if status == "failed" else None,
+            "input_file_id": batch["input_file_id"], "completion_window": "24h", "status": status,
+            "output_file_id": batch.get("output_file_id"), "error_file_id": batch.get("error_file_id"),
+            "created_at": int(batch["created_at"]), "in_progress_at": int(batch["created_at"]),
+            "expires_at": int(batch["created_at"]) + 86400, "finalizing_at": None,
+            "completed_at": done_at if status == "completed" else None,
+            "failed_at": done_at if status == "failed" else None,
+            "expired_at": None, "cancelling_at": None, "cancelled_at": None,
+            "request_counts": {"total": len(batch["requests"]),
+                               "completed": len(batch["requests"]) - num_failed if status == "completed" else 0,
+                               "failed": num_failed},
+            "metadata": None}
+
+def anthropic_batch_object(state:MockState, batch:dict, base_url:str) -> dict:
+    is_done = state.check_batch(batch)
+    num_requests = len(batch["requests"])
+    num_failed = num_requests if batch["fails"] else batch.get("num_failed", 0)
+    return {"id": batch["id"], "type": "message_batch",
+            "processing_status": "ended" if is_done else "in_progress",
+            "request_counts": {"processing": 0 if is_done else num_requests,
+                               "succeeded": num_requests - num_failed if is_done else 0,
+                               "errored": num_failed if is_done else 0, "canceled": 0, "expired": 0},
+            "created_at": timestamp_rfc3339(batch["created_at"]),
+            "expires_at": timestamp_rfc3339(batch["created_at"] + 86400),
+            "ended_at": timestamp_rfc3339(batch["done_at"]) if is_done else None,
+            "archived_at": None, "cancel_initiated_at": None,
+            "results_url": base_url + "/v1/messages/batches/" + batch["id"] + "/results"
+            if is_done and not batch["fails"] else None}
+
+def vertex_job_object(state:MockState, batch:dict) -> dict:
+    is_done = state.check_batch(batch)
+    job = {"name": batch["id"], "displayName": batch["display_name"], "model": batch["model"],
+           "inputConfig": batch["input_config"], "outputConfig": batch["output_config"],
+           "createTime": timestamp_rfc3339(batch["created_at"]), "updateTime": timestamp_rfc3339(time.time()),
+           "state": "JOB_STATE_RUNNING"}
+    if is_done:
+        job["endTime"] = timestamp_rfc3339(batch["done_at"])
+        if batch["fails"]:
+            job["state"] = "JOB_STATE_FAILED"
+            job["error"] = {"code": 13, "message": "injected failure (mock)"}
+        else:
+            job["state"] = "JOB_STATE_SUCCEEDED"
+            job["outputInfo"] = {"gcsOutputDirectory": "gs://" + batch["output_bucket"] + "/" + batch["output_directory"]}
+    return job
+
+def gcs_object_metadata(bucket:str, name:str, data:bytes) -> dict:
+    return {"kind": "storage#object", "id": bucket + "/" + name + "/1", "name": name, "bucket": bucket,
+            "generation": "1", "metageneration": "1", "contentType": "application/octet-stream",
+            "size": str(len(data)), "md5Hash": base64.b64encode(hashlib.md5(data).digest()).decode("ascii"),
+            "timeCreated": timestamp_rfc3339(time.time()), "updated": timestamp_rfc3339(time.time())}
+
+# Splits a gs://bucket/name URI
+def parse_gcs_uri(uri:str):
+    assert uri.startswith("gs://")
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return bucket, name
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep connections alive, as the SDKs expect
+    state = None # the MockState, set by run_server
+
+    def log_message(self, format, *args):
+        pass # too many requests to log each one
+
+    def send_json(self, status:int, obj, headers:dict = None):
+        self.send_bytes(status, json.dumps(obj).encode("utf-8"), "application/json", headers)
+
+    def send_bytes(self, status:int, data:bytes, content_type:str = "application/octet-stream", headers:dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def get_base_url(self) -> str:
+        return "http://" + self.headers.get("Host", "127.0.0.1:" + str(self.server.server_address[1]))
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def handle_request(self, method:str):
+        state = MockHandler.state
+        with state.lock:
+            state.requests_served += 1
+        if state.args.request_latency > 0:
+            time.sleep(state.args.request_latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = self.read_body() if method in ["POST", "PUT"] else b""
+        is_gcs = url.path.startswith("/upload/storage/") or url.path.startswith("/download/storage/") or \
+            url.path.startswith("/storage/")
+        if not is_gcs and state.get_rng("http", str(time.time()), self.path).random() < state.args.http_error_rate:
+            self.send_injected_error(url.path)
+            return
+        for route_method, pattern, handler in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match is not None:
+                try:
+                    handler(self, state, match, query, body)
+                except Exception as e: # so that a bug here shows up in the client, rather than as a hang
+                    self.send_json(500, {"error": {"type": "mock_error", "message": type(e).__name__ + ": " + str(e)}})
+                return
+        self.send_json(404, {"error": {"type": "not_found", "message": "mock does not implement " + method + " " + url.path}})
+
+    def send_injected_error(self, path:str):
+        status = random.choice([429, 500, 529 if path.startswith("/v1/messages") else 503])
+        self.send_json(status, {"type": "error", "error": {"type": "overloaded_error" if status in [503, 529] else
+                                                           "rate_limit_error" if status == 429 else "api_error",
+                                                           "message": "injected error (mock)"}},
+                       {"Retry-After": "1"} if status == 429 else None)
+
+    # OpenAI
+    def openai_create_file(self, state, match, query, body):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode("ascii") + b"\r\n\r\n" + body)
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+        data = fields["file"].get_payload(decode=True)
+        file_id = new_id("file-")
+        with state.lock:
+            state.files[file_id] = {"data": data, "filename": fields["file"].get_filename() or file_id,
+                                    "purpose": fields["purpose"].get_content().strip(), "created_at": int(time.time())}
+        self.send_json(200, self.openai_file_object(state, file_id))
+
+    def openai_file_object(self, state, file_id:str) -> dict:
+        file = state.files[file_id]
+        return {"id": file_id, "object": "file", "bytes": len(file["data"]), "created_at": file["created_at"],
+                "filename": file["filename"], "purpose": file["purpose"], "status": "processed"}
+
+    def openai_get_file(self, state, match, query, body):
+        if match.group(1) not in state.files:
+            self.send_json(404, {"error": {"message": "No such file", "type": "invalid_request_error"}})
+            return
+        self.send_json(200, self.openai_file_object(state, match.group(1)))
+
+    def openai_file_content(self, state, match, query, body):
+        if match.group(1) not in state.files:
+            self.send_json(404, {"error": {"message": "No such file", "type": "invalid_request_error"}})
+            return
+        self.send_bytes(200, state.files[match.group(1)]["data"])
+
+    def openai_create_batch(self, state, match, query, body):
+        request = json.loads(body)
+        data = state.files[request["input_file_id"]]["data"].decode("utf-8")
+        requests = [json.loads(line) for line in data.split("\n") if len(line.strip()) > 0]
+        batch = state.new_batch("openai", new_id("batch_"), requests,
+                                {"endpoint": request["endpoint"], "input_file_id": request["input_file_id"]})
+        self.send_json(200, openai_batch_object(state, batch))
+
+    def openai_get_batch(self, state, match, query, body):
+        batch = state.batches.get(match.group(1))
+        if batch is None or batch["kind"] != "openai":
+            self.send_json(404, {"error": {"message": "No such batch", "type": "invalid_request_error"}})
+            return
+        self.send_json(200, openai_batch_object(state, batch))
+
+    def openai_chat_completion(self, state, match, query, body):
+        request = json.loads(body)
+        self.send_json(200, make_chat_completion(request, state.get_rng("live", body.decode("utf-8"))))
+
+    def openai_response(self, state, match, query, body):
+        request = json.loads(body)
+        self.send_json(200, make_openai_response(request, state.get_rng("live", body.decode("utf-8"))))
+
+    # Anthropic
+    def anthropic_create_batch(self, state, match, query, body):
+        request = json.loads(body)
+        batch = state.new_batch("anthropic", new_id("msgbatch_"), request["requests"], {})
+        self.send_json(200, anthropic_batch_object(state, batch, self.get_base_url()))
+
+    def anthropic_get_batch(self, state, match, query, body):
+        batch = state.batches.get(match.group(1))
+        if batch is None or batch["kind"] != "anthropic":
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": "No such batch"}})
+            return
+        self.send_json(200, anthropic_batch_object(state, batch, self.get_base_url()))
+
+    def anthropic_batch_results(self, state, match, query, body):
+        batch = state.batches.get(match.group(1))
+        if batch is None or not state.check_batch(batch) or batch["results"] is None:
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": "No results"}})
+            return
+        self.send_bytes(200, batch["results"].encode("utf-8"), "application/binary")
+
+    def anthropic_message(self, state, match, query, body):
+        request = json.loads(body)
+        self.send_json(200, make_message(request, state.get_rng("live", body.decode("utf-8"))))
+
+    # Vertex AI
+    def vertex_create_job(self, state, match, query, body):
+        request = json.loads(body)
+        input_config = request.get("inputConfig") or request.get("input_config")
+        output_config = request.get("outputConfig") or request.get("output_config")
+        source_uri = (input_config.get("gcsSource") or input_config.get("gcs_source"))["uris"][0]
+        data = state.objects[parse_gcs_uri(source_uri)].decode("utf-8")
+        requests = [json.loads(line) for line in data.split("\n") if len(line.strip()) > 0]
+        output_bucket, output_prefix = parse_gcs_uri(
+            (output_config.get("gcsDestination") or output_config.get("gcs_destination"))["outputUriPrefix"])
+        job_id = "projects/" + match.group(1) + "/locations/" + match.group(2) + "/batchPredictionJobs/" + \
+            str(random.randrange(10 ** 18))
+        model = request.get("model", "")
+        batch = state.new_batch("vertex", job_id, requests,
+                                {"display_name": request.get("displayName", "mock"), "model": model,
+                                 "input_config": input_config, "output_config": output_config,
+                                 "output_bucket": output_bucket,
+                                 "output_directory": output_prefix.rstrip("/") + "/prediction-model-" +
+                                                     datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")})
+        self.send_json(200, vertex_job_object(state, batch))
+
+    def vertex_get_job(self, state, match, query, body):
+        batch = state.batches.get(match.group(1))
+        if batch is None or batch["kind"] != "vertex":
+            self.send_json(404, {"error": {"code": 404, "message": "No such job", "status": "NOT_FOUND"}})
+            return
+        self.send_json(200, vertex_job_object(state, batch))
+
+    # Google Cloud Storage
+    def gcs_upload(self, state, match, query, body):
+        bucket = urllib.parse.unquote(match.group(1))
+        if query.get("uploadType") == "resumable":
+            metadata = json.loads(body) if len(body) > 0 else {}
+            upload_id = uuid.uuid4().hex
+            with state.lock:
+                state.resumable_uploads[upload_id] = {"bucket": bucket, "name": metadata.get("name", query.get("name")),
+                                                      "data": bytearray()}
+            self.send_bytes(200, b"", headers={"Location": self.get_base_url() + "/upload/storage/v1/b/" +
+                                               urllib.parse.quote(bucket) + "/o?uploadType=resumable&upload_id=" + upload_id})
+            return
+        # a multipart upload: the object's metadata, and then its data
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode("ascii") + b"\r\n\r\n" + body)
+        parts = list(message.iter_parts())
+        metadata = json.loads(parts[0].get_payload(decode=True))
+        data = parts[1].get_payload(decode=True)
+        name = metadata.get("name", query.get("name"))
+        with state.lock:
+            state.objects[(bucket, name)] = data
+        self.send_json(200, gcs_object_metadata(bucket, name, data))
+
+    def gcs_resumable_chunk(self, state, match, query, body):
+        upload = state.resumable_uploads.get(query.get("upload_id"))
+        if upload is None:
+            self.send_json(404, {"error": {"code": 404, "message": "No such upload"}})
+            return
+        upload["data"].extend(body)
+        content_range = self.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2]
+        if total != "*" and len(upload["data"]) >= int(total):
+            data = bytes(upload["data"])
+            with state.lock:
+                state.objects[(upload["bucket"], upload["name"])] = data
+                del state.resumable_uploads[query["upload_id"]]
+            self.send_json(200, gcs_object_metadata(upload["bucket"], upload["name"], data))
+        else:
+            self.send_bytes(308, b"", headers={"Range": "bytes=0-" + str(len(upload["data"]) - 1)}
+                            if len(upload["data"]) > 0 else None)
+
+    def gcs_get_object(self, state, match, query, body):
+        bucket = urllib.parse.unquote(match.group(1))
+        name = urllib.parse.unquote(match.group(2))
+        data = state.objects.get((bucket, name))
+        if data is None:
+            self.send_json(404, {"error": {"code": 404, "message": "No such object: " + bucket + "/" + name}})
+            return
+        if query.get("alt") != "media" and not self.path.startswith("/download/"):
+            self.send_json(200, gcs_object_metadata(bucket, name, data))
+            return
+        range_match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if range_match is None:
+            md5 = base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+            self.send_bytes(200, data, headers={"x-goog-hash": "md5=" + md5, "x-goog-generation": "1"})
+            return
+        start = int(range_match.group(1))
+        end = min(len(data) - 1, int(range_match.group(2))) if len(range_match.group(2)) > 0 else len(data) - 1
+        self.send_bytes(206, data[start:end + 1],
+                        headers={"Content-Range": "bytes " + str(start) + "-" + str(end) + "/" + str(len(data)),
+                                 "x-goog-generation": "1"})
+
+
+ROUTES = [
+    ("POST", r"/v1/files", MockHandler.openai_create_file),
+    ("GET", r"/v1/files/([^/]+)", MockHandler.openai_get_file),
+    ("GET", r"/v1/files/([^/]+)/content", MockHandler.openai_file_content),
+    ("POST", r"/v1/batches", MockHandler.openai_create_batch),
+    ("GET", r"/v1/batches/([^/]+)", MockHandler.openai_get_batch),
+    ("POST", r"/v1/chat/completions", MockHandler.openai_chat_completion),
+    ("POST", r"/v1/responses", MockHandler.openai_response),
+    ("POST", r"/v1/messages/batches", MockHandler.anthropic_create_batch),
+    ("GET", r"/v1/messages/batches/([^/]+)", MockHandler.anthropic_get_batch),
+    ("GET", r"/v1/messages/batches/([^/]+)/results", MockHandler.anthropic_batch_results),
+    ("POST", r"/v1/messages", MockHandler.anthropic_message),
+    ("POST", r"/v1/projects/([^/]+)/locations/([^/]+)/batchPredictionJobs", MockHandler.vertex_create_job),
+    ("GET", r"/v1/(projects/[^/]+/locations/[^/]+/batchPredictionJobs/[^/]+)", MockHandler.vertex_get_job),
+    ("POST", r"/upload/storage/v1/b/([^/]+)/o", MockHandler.gcs_upload),
+    ("PUT", r"/upload/storage/v1/b/([^/]+)/o", MockHandler.gcs_resumable_chunk),
+    ("GET", r"/(?:download/)?storage/v1/b/([^/]+)/o/(.+)", MockHandler.gcs_get_object),
+]
+
+def run_server(args, in_background:bool = False):
+    MockHandler.state = MockState(args)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), MockHandler)
+    server.daemon_threads = True
+    print("Mock batch server on http://127.0.0.1:" + str(server.server_address[1]) +
+          " (export MOCK_BATCH_SERVER=http://127.0.0.1:" + str(server.server_address[1]) + ")")
+    if in_background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    server.serve_forever()
+
+# Runs a batch of synthetic items through the pipeline code (writing, submitting, polling, downloading and
+# joining), against a mock server in this process, timing each phase
+def run_benchmark(args):
+    server = run_server(args, in_background=True)
+    os.environ["MOCK_BATCH_SERVER"] = "http://127.0.0.1:" + str(server.server_address[1])
+    os.environ["BATCH_DEDUP_DAYS"] = "0" # every benchmark run is to be submitted in full
+    import batch_utils, response_utils # only now, so that they pick up MOCK_BATCH_SERVER
+
+    timings = []
+    def timed(phase:str, function):
+        start = time.time()
+        result = function()
+        timings.append((phase, time.time() - start))
+        return result
+    testname = batch_utils.get_testname("mock_benchmark", args.model)
+    items = (("Strategy_" + str(i // 100) + "_Step_" + str(i % 100), "Here is synthetic prompt number " + str(i) +
+              ".  " + "Some padding to make the prompt a realistic length.  " * 20) for i in range(args.benchmark))
+    filename = timed("write", lambda: batch_utils.write_batch_file(testname, batch_utils.POSTFIX_UPLOAD1, args.model, items))
+    batchid = timed("submit", lambda: batch_utils.upload_file_and_start(filename, args.model))
+    def wait():
+        while batch_utils.get_batch_status(batchid, args.model) == batch_utils.BATCH_RUNNING:
+            time.sleep(0.5)
+    timed("wait", wait)
+    download_file = batch_utils.get_download_filename(filename)
+    timed("download", lambda: batch_utils.download_response(batchid, download_file, args.model))
+    def join():
+        if batch_utils.is_google(args.model): # the responses include the requests
+            return batch_utils.merge_input_response(None, response_utils.iter_responses(download_file),
+                                                    args.model, YESNO_FOLLOW_UP)[0]
+        with batch_utils.UploadIndex(filename) as input_data:
+            return batch_utils.merge_input_response(input_data, response_utils.iter_responses(download_file),
+                                                    args.model, YESNO_FOLLOW_UP)[0]
+    joined = timed("join", join)
+
+    print("BENCHMARK:", args.benchmark, "items to", args.model, ";", len(joined), "joined ;",
+          MockHandler.state.requests_served, "HTTP requests served ; files in", batch_utils.call_utils.MOCK_SCRATCH_DIR)
+    for phase, seconds in timings:
+        print("  %-9s %8.2f s  %10.0f items/s" % (phase, seconds, args.benchmark / seconds if seconds > 0 else 0))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.benchmark > 0:
+        run_benchmark(args)
+    else:
+        run_server(args)
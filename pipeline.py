@@ -0,0 +1,145 @@
+# Drives batch runs from stage to stage, so that no one has to wait on a batch and copy its test name and
+# batch id to the next script by hand.  Start the first stage of a task as usual (e.g. goal_verification.py);
+# every batch started is registered in pipeline_utils.PIPELINE_REGISTRY.  This then polls all the outstanding
+# batches concurrently, backing off while they run, and as soon as one completes it runs the next stage
+# (which may itself start a batch, which is then polled in turn).  The output of each stage it runs is in
+# DIR_PIPELINE_LOGS.  It stops once nothing is outstanding (unless --forever is passed).
+import argparse, os, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+import batch_utils, call_utils, pipeline_utils, retry_utils
+
+DIR_PIPELINE_LOGS = call_utils.get_run_path("Pipeline_Logs/")
+
+# The next stage after the stage that started a batch, as a function of the run's test name, model and batch
+# id that returns the command line for the next stage.  Stages not here are the last stage of their task.
+NEXT_STAGES = {
+    "analysis_verification.py": lambda testname, model, batch_id: ["binary_answers_clarify.py", testname, model, batch_id],
+    "goal_verification.py": lambda testname, model, batch_id: ["binary_answers_clarify.py", testname, model, batch_id],
+    "binary_answers_clarify.py": lambda testname, model, batch_id: ["binary_answers_finalize.py", testname, model, batch_id],
+    "step_cloze_start.py": lambda testname, model, batch_id: ["step_cloze_grade.py", testname, model, batch_id],
+    "step_cloze_grade.py": lambda testname, model, batch_id: ["step_cloze_finalize.py", testname, batch_id],
+    "generate_freeform.py": lambda testname, model, batch_id: ["generate_freeform_retrieve.py", testname, model, batch_id],
+    "freeform_grade.py": lambda testname, model, batch_id: ["freeform_grade_finalize.py", testname, model, batch_id],
+}
+
+parser = argparse.ArgumentParser(
+    description='Polls the registered batch runs and runs each next stage as soon as its batch completes')
+parser.add_argument('--poll_interval', default=30.0, type=float,
+                    help='seconds to wait before first polling a batch, doubling while it is still running')
+parser.add_argument('--max_poll_interval', default=600.0, type=float,
+                    help='most seconds to wait between polls of a batch')
+parser.add_argument('--workers', default=16, type=int,
+                    help='number of batches to poll at the same time')
+parser.add_argument('--max_poll_failures', default=20, type=int,
+                    help='consecutive failed polls of a batch after which its run is marked failed')
+parser.add_argument('--forever', action="store_true",
+                    help='keep waiting for new runs even once nothing is outstanding')
+parser.add_argument('--list', action="store_true",
+                    help='just print the registered runs and stop')
+parser.add_argument('--add', nargs=4, metavar=("SCRIPT", "TESTNAME", "MODEL", "BATCHID"),
+                    help='register a batch started before the registry existed (SCRIPT is the stage that started it)')
+args = parser.parse_args()
+
+if args.list:
+    for batch_id, script, testname, model, status, note, created, updated in pipeline_utils.get_runs():
+        print(status.ljust(12), updated[:19], script.ljust(26), testname, batch_id, note)
+    sys.exit(0)
+if args.add is not None:
+    script, testname, model, batch_id = args.add
+    assert script in NEXT_STAGES, "no next stage for " + script
+    pipeline_utils.register_batch(batch_id, testname, model, script)
+
+POLL_ERROR = "poll_error" # polling the batch failed, but might succeed later
+
+# Returns the status of a batch and a note on any error.  An error that retrying will not fix (e.g. the batch
+# id is unknown to the provider) fails the run; any other (often LLM APIs have temporary hiccups) is a
+# POLL_ERROR, so that the batch is polled again later.
+def poll(run):
+    batch_id, script, testname, model = run[:4]
+    try:
+        return batch_utils.get_batch_status(batch_id, model), ""
+    except Exception as e:
+        print("EXCEPTION polling", batch_id, f", Error Type: {type(e).__name__} {e}")
+        note = "polling raised " + type(e).__name__ + ": " + str(e)[:200]
+        if retry_utils.classify_error(e) == retry_utils.ERROR_FATAL:
+            return batch_utils.BATCH_FAILED, note
+        return POLL_ERROR, note
+
+# Starts the next stage for a completed run, returning the process (or None if there is no next stage)
+def start_next_stage(run):
+    batch_id, script, testname, model = run[:4]
+    if script not in NEXT_STAGES:
+        pipeline_utils.set_status(batch_id, pipeline_utils.STATUS_DONE, "no next stage")
+        return None
+    command = NEXT_STAGES[script](testname, model, batch_id)
+    os.makedirs(DIR_PIPELINE_LOGS, exist_ok=True)
+    log_filename = DIR_PIPELINE_LOGS + testname + "_" + command[0][:-len(".py")] + ".txt"
+    print("Starting", " ".join(command), ">", log_filename)
+    with open(log_filename, "w") as log_file:
+        process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), command[0])] +
+                                   command[1:], stdout=log_file, stderr=subprocess.STDOUT)
+    pipeline_utils.set_status(batch_id, pipeline_utils.STATUS_RUNNING_NEXT, log_filename)
+    return process
+
+next_polls = {} # batch id -> (time of next poll, current interval)
+processes = {} # batch id -> process running its next stage
+poll_failures = {} # batch id -> polls in a row that failed
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    while True:
+        # Poll the batches that are due, all at once
+        now = time.time()
+        runs = [run for run in pipeline_utils.get_runs(pipeline_utils.STATUS_SUBMITTED)
+                if run[0] not in next_polls or next_polls[run[0]][0] <= now]
+        for run, (status, note) in zip(runs, executor.map(poll, runs)):
+            batch_id = run[0]
+            if status == POLL_ERROR:
+                poll_failures[batch_id] = poll_failures.get(batch_id, 0) + 1
+                if poll_failures[batch_id] >= args.max_poll_failures:
+                    status = batch_utils.BATCH_FAILED
+                    note = str(poll_failures[batch_id]) + " polls in a row failed; last " + note
+                else:
+                    status = batch_utils.BATCH_RUNNING
+            else:
+                poll_failures.pop(batch_id, None)
+            if status == batch_utils.BATCH_RUNNING:
+                interval = args.poll_interval if batch_id not in next_polls else \
+                    min(2 * next_polls[batch_id][1], args.max_poll_interval)
+                next_polls[batch_id] = (time.time() + interval, interval)
+                continue
+            next_polls.pop(batch_id, None)
+            poll_failures.pop(batch_id, None)
+            if status == batch_utils.BATCH_FAILED:
+                print("FAILED:", run[1], run[2], batch_id, note)
+                pipeline_utils.set_status(batch_id, pipeline_utils.STATUS_FAILED, note or "batch failed")
+            else:
+                process = start_next_stage(run)
+                if process is not None:
+                    processes[batch_id] = process
+
+        # Check on the next stages that are running
+        for batch_id, process in list(processes.items()):
+            if process.poll() is not None:
+                del processes[batch_id]
+                if process.returncode == 0:
+                    pipeline_utils.set_status(batch_id, pipeline_utils.STATUS_DONE)
+                else:
+                    print("FAILED: next stage for", batch_id, "with return code", process.returncode)
+                    pipeline_utils.set_status(batch_id, pipeline_utils.STATUS_FAILED,
+                                              "next stage returned " + str(process.returncode))
+
+        outstanding = pipeline_utils.get_runs(pipeline_utils.STATUS_SUBMITTED)
+        if len(outstanding) == 0 and len(processes) == 0 and not args.forever:
+            break
+
+        # Sleep until the next poll is due (but check on any running stages, and for new runs, regularly)
+        wait = args.poll_interval if len(processes) == 0 else min(5.0, args.poll_interval)
+        due_times = [next_polls[run[0]][0] for run in outstanding if run[0] in next_polls]
+        if len(due_times) < len(outstanding):
+            wait = 0.0 # a new run, not yet polled
+        elif len(due_times) > 0:
+            wait = min(wait, max(0.0, min(due_times) - time.time()))
+        time.sleep(wait)
+
+print("Nothing outstanding:")
+for batch_id, script, testname, model, status, note, created, updated in pipeline_utils.get_runs():
+    print(status.ljust(12), script.ljust(26), testname, note)
@@ -0,0 +1,91 @@
+# This file keeps the registry of batch runs that pipeline.py drives from stage to stage.
+# Every batch that is started is registered (by upload_file_and_start) along with the script that started
+# it, its test name and model, so that the next stage can be run without copying these around by hand.
+import datetime, os, sqlite3, sys, time
+
+PIPELINE_REGISTRY = "pipeline.sqlite"
+
+# Statuses of a registered run
+STATUS_SUBMITTED = "submitted" # the batch is running at the provider
+STATUS_RUNNING_NEXT = "running_next" # the batch has finished, and its next stage is running
+STATUS_DONE = "done" # the next stage has finished (or there is none)
+STATUS_FAILED = "failed" # the batch failed at the provider, or its next stage failed
+
+_registry_connection = None
+
+def get_registry_connection():
+    global _registry_connection
+    if _registry_connection is None:
+        _registry_connection = sqlite3.connect(PIPELINE_REGISTRY, timeout=60, check_same_thread=False)
+        _registry_connection.execute("CREATE TABLE IF NOT EXISTS runs (batch_id TEXT PRIMARY KEY, script TEXT, " +
+                                     "testname TEXT, model TEXT, status TEXT, note TEXT, created TEXT, updated TEXT)")
+        # the requests whose responses each run has downloaded, by fingerprint (see batch_utils.BatchFileWriter)
+        _registry_connection.execute("CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY, " +
+                                     "upload_filename TEXT, id TEXT, created REAL)")
+        # the token usage and time of each downloaded batch, from which preflight_utils projects new runs
+        _registry_connection.execute("CREATE TABLE IF NOT EXISTS usage_history (batch_id TEXT PRIMARY KEY, " +
+                                     "task TEXT, postfix TEXT, model TEXT, responses INTEGER, request_chars INTEGER, " +
+                                     "input_tokens INTEGER, reasoning_tokens INTEGER, output_tokens INTEGER, " +
+                                     "latency_seconds REAL, created REAL)")
+        _registry_connection.commit()
+    return _registry_connection
+
+# Registers a batch that has just been started.  The script defaults to the one running now, which is the
+# stage that started the batch.
+def register_batch(batch_id:str, testname:str, model:str, script:str = None):
+    if script is None:
+        script = os.path.basename(sys.argv[0])
+    timestamp = str(datetime.datetime.now())
+    connection = get_registry_connection()
+    connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (batch_id, script, testname, model, STATUS_SUBMITTED, "", timestamp, timestamp))
+    connection.commit()
+
+def set_status(batch_id:str, status:str, note:str = ""):
+    connection = get_registry_connection()
+    connection.execute("UPDATE runs SET status = ?, note = ?, updated = ? WHERE batch_id = ?",
+                       (status, note, str(datetime.datetime.now()), batch_id))
+    connection.commit()
+
+# Returns the (batch_id, script, testname, model, status, note, created, updated) rows of the registered
+# runs, oldest first, optionally only those with the given status
+def get_runs(status:str = None) -> list:
+    if status is None:
+        return get_registry_connection().execute("SELECT * FROM runs ORDER BY created").fetchall()
+    return get_registry_connection().execute("SELECT * FROM runs WHERE status = ? ORDER BY created",
+                                             (status,)).fetchall()
+
+# Records the (fingerprint, id) pairs of the requests in the given upload file whose responses have been downloaded
+def register_fingerprints(upload_filename:str, fingerprints_ids):
+    created = time.time()
+    connection = get_registry_connection()
+    connection.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                           [(fingerprint, upload_filename, id, created) for fingerprint, id in fingerprints_ids])
+    connection.commit()
+
+# Returns the (upload file, id) of a request with the given fingerprint whose response was downloaded within the
+# last max_age_days, or None
+def find_fingerprint(fingerprint:str, max_age_days:float):
+    return get_registry_connection().execute(
+        "SELECT upload_filename, id FROM fingerprints WHERE fingerprint = ? AND created >= ?",
+        (fingerprint, time.time() - max_age_days * 86400)).fetchone()
+
+# Records the token usage (and time from submission to completion, if known) of a downloaded batch
+def record_usage(batch_id:str, task:str, postfix:str, model:str, responses:int, request_chars:int,
+                 input_tokens:int, reasoning_tokens:int, output_tokens:int, latency_seconds:float):
+    connection = get_registry_connection()
+    connection.execute("INSERT OR REPLACE INTO usage_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (batch_id, task, postfix, model, responses, request_chars, input_tokens, reasoning_tokens,
+                        output_tokens, latency_seconds, time.time()))
+    connection.commit()
+
+# Returns the (responses, request_chars, input_tokens, reasoning_tokens, output_tokens, latency_seconds) rows
+# of the most recent downloads for the model, optionally only those of the given task and postfix
+def get_usage_history(model:str, task:str = None, postfix:str = None, max_rows:int = 20) -> list:
+    query = "SELECT responses, request_chars, input_tokens, reasoning_tokens, output_tokens, latency_seconds " + \
+        "FROM usage_history WHERE model = ?"
+    values = [model]
+    if task is not None:
+        query += " AND task = ? AND postfix = ?"
+        values += [task, postfix]
+    return get_registry_connection().execute(query + " ORDER BY created DESC LIMIT ?", values + [max_rows]).fetchall()
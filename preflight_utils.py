@@ -0,0 +1,211 @@
+# This is the pre-flight planner that batch_utils.upload_file_and_start runs before submitting a batch, so
+# that the size and cost of a run are known before the bill arrives.  The input tokens of each request are
+# counted offline (with tiktoken for OpenAI's models, if it is installed, and otherwise from the characters,
+# at a ratio calibrated on earlier runs), and the output and reasoning tokens are projected from earlier runs
+# of the same task and model (see pipeline_utils.get_usage_history, which download_response records).  The
+# forecast of cost and time is printed, and if the environment variable BATCH_BUDGET_DOLLARS is set, a batch
+# forecast to cost more is not submitted.  The shard size is not chosen to fit the provider's limit on
+# enqueued tokens (ENQUEUED_TOKEN_LIMITS): since a batch's shards are all submitted at once, smaller shards
+# would not get more of them enqueued.  A batch over the limit is only warned about, so that it can be split
+# into runs (e.g. with --num) or submitted as earlier batches finish.
+#   To forecast a batch file without submitting it: python preflight_utils.py <batch file> <model>
+import os, re, statistics, sys
+import batch_utils, metrics_utils, pipeline_utils, response_utils
+try: # counts OpenAI's tokens exactly, but is optional
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+BATCH_BUDGET_DOLLARS = os.getenv("BATCH_BUDGET_DOLLARS") # e.g. "50"; unset for no budget
+
+# Characters per input token, when there is no tokenizer and no history to calibrate on
+DEFAULT_CHARS_PER_TOKEN = {"openai": 4.0, "anthropic": 3.5, "google": 4.0}
+TOKENS_PER_MESSAGE = 4 # the overhead of each message, beyond its text
+
+# Output and reasoning tokens per response, when there is no history for the task and model
+DEFAULT_OUTPUT_TOKENS = 500
+DEFAULT_REASONING_TOKENS = 4000 # for models that reason (see is_reasoning_model)
+
+# Input tokens that can be enqueued (i.e. in batches not yet finished) at once, per provider; these depend on
+# the account's usage tier, so set them to your own limits.  A provider that is not here has no such limit.
+ENQUEUED_TOKEN_LIMITS = {
+    "openai": 250000000,
+}
+
+def get_provider(model:str) -> str:
+    if batch_utils.is_openai(model):
+        return "openai"
+    elif batch_utils.is_claude(model):
+        return "anthropic"
+    elif batch_utils.is_google(model):
+        return "google"
+    assert False, "not supported"
+
+def is_reasoning_model(model:str) -> bool:
+    return model.startswith("o1") or model.startswith("o3") or batch_utils.is_claude(model) # Claude's batches think
+
+# The task of a test name, without its model, time and strategy (its number, "_1" or "_s17", along with the
+# rest of its file name if given), but with its N-shot, since that changes the prompts' shape.  E.g.
+# "analysis_verification" for "analysis_verification_1_gpt-4.1-nano-2025-04-14_2025-07-25at14_50_12", and
+# "step_cloze_N0" for both "step_cloze_N0_..." and "step_cloze_s17_N0_...".
+def get_task(testname:str) -> str:
+    match = re.match(r"^(.*?)_[^_]+_\d{4}-\d{2}-\d{2}at.*$", testname)
+    task = testname if match is None else match.group(1)
+    return re.sub(r"_s?\d+(?:_[A-Za-z].*?)??(?=_N\d+$|$)", "", task)
+
+# The postfix (e.g. "_upload1") that a batch file's name ends with, or ""
+def get_postfix(filename:str) -> str:
+    for postfix in [batch_utils.POSTFIX_UPLOAD1, batch_utils.POSTFIX_UPLOAD2]:
+        if filename.endswith(postfix + ".jsonl") or filename.endswith(postfix + "_submit.jsonl"):
+            return postfix
+    return ""
+
+# The text of the messages of a request line, whichever provider it is for
+def get_request_texts(request_datum) -> list:
+    if "body" in request_datum:
+        messages = request_datum["body"]["messages"]
+    elif "params" in request_datum:
+        messages = request_datum["params"]["messages"]
+    else:
+        messages = request_datum["request"]["contents"]
+    texts = []
+    for message in messages:
+        content = message["content"] if "content" in message else message["parts"]
+        if type(content) == str:
+            texts.append(content)
+        else:
+            texts.extend([block["text"] for block in content if "text" in block])
+    return texts
+
+_encodings = {}
+
+def get_encoding(model:str):
+    if tiktoken is None or not batch_utils.is_openai(model):
+        return None
+    name = "cl100k_base" if model.startswith("gpt-4-") or model == "gpt-4" else "o200k_base"
+    if name not in _encodings:
+        _encodings[name] = tiktoken.get_encoding(name)
+    return _encodings[name]
+
+# Characters per input token for the model, calibrated on its earlier downloads of the same task if there
+# are any, and otherwise on those of any task
+def get_chars_per_token(model:str, task:str = None, postfix:str = None) -> float:
+    for history in [pipeline_utils.get_usage_history(model, task, postfix), pipeline_utils.get_usage_history(model)]:
+        request_chars = sum([row[1] for row in history])
+        input_tokens = sum([row[2] for row in history])
+        if request_chars > 0 and input_tokens > 0:
+            return request_chars / input_tokens
+    return DEFAULT_CHARS_PER_TOKEN[get_provider(model)]
+
+# The number of requests in a batch file, and the characters of their messages' text
+def measure_requests(filename:str):
+    count = 0
+    chars = 0
+    with open(filename, "rb") as f:
+        for line in f:
+            if len(line.strip()) > 0:
+                count += 1
+                chars += sum([len(text) for text in get_request_texts(response_utils.loads(line))])
+    return count, chars
+
+
+class BatchPlan:
+    def __init__(self, filename:str, model:str):
+        self.filename = filename
+        self.model = model
+        self.task = get_task(batch_utils.get_testname_from_filename(filename.replace("_submit.jsonl", ".jsonl")))
+        self.postfix = get_postfix(filename)
+
+        # Count the input tokens, a request at a time
+        encoding = get_encoding(model)
+        chars_per_token = get_chars_per_token(model, self.task, self.postfix)
+        self.count = 0
+        self.input_tokens = 0
+        self.max_request_tokens = 0
+        with open(filename, "rb") as f:
+            for line in f:
+                if len(line.strip()) == 0:
+                    continue
+                texts = get_request_texts(response_utils.loads(line))
+                if encoding is not None:
+                    tokens = sum([len(encoding.encode(text, disallowed_special=())) for text in texts])
+                else:
+                    tokens = int(sum([len(text) for text in texts]) / chars_per_token)
+                tokens += TOKENS_PER_MESSAGE * len(texts)
+                self.count += 1
+                self.input_tokens += tokens
+                self.max_request_tokens = max(self.max_request_tokens, tokens)
+        self.token_counter = "tiktoken" if encoding is not None else "%.2f chars/token" % chars_per_token
+
+        # Project the output from earlier runs of the same task and model
+        history = pipeline_utils.get_usage_history(model, self.task, self.postfix)
+        history_responses = sum([row[0] for row in history])
+        if history_responses > 0:
+            self.output_per_request = sum([row[4] for row in history]) / history_responses
+            self.reasoning_per_request = sum([row[3] for row in history]) / history_responses
+            self.projected_from = str(len(history)) + " earlier runs of " + self.task + self.postfix
+        else:
+            # OpenAI and Claude count the reasoning in the output tokens, Gemini does not
+            self.reasoning_per_request = DEFAULT_REASONING_TOKENS if is_reasoning_model(model) else 0
+            self.output_per_request = DEFAULT_OUTPUT_TOKENS + \
+                (0 if batch_utils.is_google(model) else self.reasoning_per_request)
+            self.projected_from = "defaults (no earlier runs of " + self.task + self.postfix + ")"
+        latencies = [row[5] for row in history if row[5] is not None]
+        self.latency_seconds = statistics.median(latencies) if len(latencies) > 0 else None
+
+        usage = response_utils.UsageTotals()
+        usage.input_tokens = self.input_tokens
+        usage.reasoning_tokens = int(self.reasoning_per_request * self.count)
+        usage.output_tokens = int(self.output_per_request * self.count)
+        self.usage = usage
+        self.estimated_cost = metrics_utils.estimate_cost(model, usage)
+
+    def print_forecast(self):
+        print("PRE-FLIGHT:", self.count, "requests to", self.model, "in", self.filename)
+        print("  input tokens =", self.input_tokens, "(counted with " + self.token_counter + "; largest request =",
+              str(self.max_request_tokens) + ")")
+        print("  projected output tokens =", self.usage.output_tokens, "; reasoning tokens =",
+              self.usage.reasoning_tokens, "(from " + self.projected_from + ")")
+        if metrics_utils.get_prices(self.model) is None:
+            print("  NOTE: no prices for", self.model, "in metrics_utils.PRICES_PER_MILLION")
+        else:
+            print("  estimated cost = $%.2f" % self.estimated_cost)
+        if self.latency_seconds is not None:
+            print("  expected time = %.1f hours (the median of earlier runs)" % (self.latency_seconds / 3600))
+        limit_tokens = ENQUEUED_TOKEN_LIMITS.get(get_provider(self.model))
+        if limit_tokens is not None and self.input_tokens > limit_tokens:
+            print("  WARNING: more input tokens than can be enqueued at once (" + str(limit_tokens) +
+                  "); shards beyond the limit will fail until earlier ones finish")
+
+    # Asserts that the batch is within the budget (if there is one), so that it is not submitted otherwise
+    def check_budget(self, budget_dollars:float = None):
+        if budget_dollars is None and BATCH_BUDGET_DOLLARS is not None and len(BATCH_BUDGET_DOLLARS) > 0:
+            budget_dollars = float(BATCH_BUDGET_DOLLARS)
+        if budget_dollars is not None:
+            assert self.estimated_cost <= budget_dollars, "estimated cost $%.2f is over the budget of $%.2f; " \
+                "not submitting %s (raise BATCH_BUDGET_DOLLARS to submit it)" % \
+                (self.estimated_cost, budget_dollars, self.filename)
+
+# Records the usage of a downloaded batch (i.e. of the responses to the requests that were submitted, rather
+# than reused), for projecting later runs of the same task and model
+def record_download(batchid:str, upload_filename:str, model:str, usage_totals):
+    if usage_totals.count == 0 or not os.path.exists(upload_filename):
+        return
+    submit_filename = upload_filename
+    if os.path.exists(batch_utils.get_submit_filename(upload_filename)):
+        submit_filename = batch_utils.get_submit_filename(upload_filename)
+    try:
+        batch_times = batch_utils.get_batch_times(batchid, model)
+    except Exception as e: # the projections are not worth failing the download over
+        print("NOTE: could not get the batch times:", type(e).__name__, e)
+        batch_times = None
+    pipeline_utils.record_usage(batchid, get_task(batch_utils.get_testname_from_filename(upload_filename)),
+                                get_postfix(upload_filename), model, usage_totals.count,
+                                measure_requests(submit_filename)[1], usage_totals.input_tokens,
+                                usage_totals.reasoning_tokens, usage_totals.output_tokens,
+                                None if batch_times is None else batch_times[1] - batch_times[0])
+
+
+if __name__ == "__main__":
+    assert len(sys.argv) == 3, "Usage: <batch file> <model>"
+    BatchPlan(sys.argv[1], sys.argv[2]).print_forecast()
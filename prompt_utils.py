@@ -0,0 +1,80 @@
+# Precompiled prompt templates, shared by the task entry points.
+# A template is compiled once from a format string like "Here is the goal: {goal}" into its literal text
+# and named fields.  bind() fills in some of the fields (e.g. those that are the same for a whole strategy),
+# giving a smaller compiled template, and render() fills in the rest with a single join.
+from string import Formatter
+
+
+class PromptTemplate:
+    __slots__ = ("parts",) # list of (is_field, literal text or field name); adjacent literals are merged
+
+    def __init__(self, template:str = "", parts=None):
+        if parts is None:
+            parts = []
+            for literal, field_name, format_spec, conversion in Formatter().parse(template):
+                assert format_spec in [None, ""] and conversion is None, "only plain {field}s are supported"
+                if len(parts) > 0 and not parts[-1][0]: # "{{" splits a literal in two
+                    parts[-1] = (False, parts[-1][1] + literal)
+                elif len(literal) > 0:
+                    parts.append((False, literal))
+                if field_name is not None:
+                    assert len(field_name) > 0, "fields must be named"
+                    parts.append((True, field_name))
+        self.parts = parts
+
+    @property
+    def fields(self) -> set:
+        return {text for is_field, text in self.parts if is_field}
+
+    # Returns a new template with the given fields filled in (and adjacent literals merged)
+    def bind(self, **values):
+        parts = []
+        for is_field, text in self.parts:
+            if is_field and text in values:
+                is_field, text = False, values[text]
+            if not is_field and len(parts) > 0 and not parts[-1][0]:
+                parts[-1] = (False, parts[-1][1] + text)
+            elif is_field or len(text) > 0:
+                parts.append((is_field, text))
+        return PromptTemplate(parts=parts)
+
+    # Fills in all the remaining fields, returning the prompt
+    def render(self, **values) -> str:
+        return "".join([values[text] if is_field else text for is_field, text in self.parts])
+
+    # Like render(), but splits the prompt just before the first remaining field.  Everything already bound
+    # (e.g. the per-strategy preamble) becomes a prefix that the provider can cache across prompts.
+    def render_split(self, **values):
+        idx_first_field = 0
+        while idx_first_field < len(self.parts) and not self.parts[idx_first_field][0]:
+            idx_first_field += 1
+        prefix = "".join([text for is_field, text in self.parts[:idx_first_field]])
+        suffix = "".join([values[text] if is_field else text for is_field, text in self.parts[idx_first_field:]])
+        return SplitPrompt(prefix, suffix)
+
+
+# A prompt split into a long prefix shared by many prompts, which providers can cache, and a short suffix.
+# It is not a str: only the batch files' writers (batch_utils.BatchFileWriter and write_batch_file) take one
+# as an item's prompt, and merge_input_response can give one back for Claude.  Anything else (e.g. the direct
+# calls, or printing) needs prompt_text(prompt).
+class SplitPrompt:
+    __slots__ = ("prefix", "suffix")
+
+    def __init__(self, prefix:str, suffix:str):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def __str__(self):
+        return self.prefix + self.suffix
+
+
+# The full text of a prompt, whether or not it is a SplitPrompt
+def prompt_text(prompt) -> str:
+    return prompt if type(prompt) == str else str(prompt)
+
+
+# Returns text introduced by a heading, or nothing at all if the text is empty (e.g. optional background)
+def optional_section(heading:str, text:str) -> str:
+    if len(text.strip()) > 0:
+        return heading + text
+    return ""
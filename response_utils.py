@@ -0,0 +1,173 @@
+# This file normalizes the responses in downloaded batch files, whichever provider they came from, so that
+# the later stages of each task deal with one kind of record rather than each provider's format.
+# Records are read a line at a time, so a download of any size is parsed in one pass in constant memory.
+import json
+try: # orjson parses the long responses several times faster, but is optional
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+# Where a response came from, if not from the batch itself.  The responses that batch_utils splices into a
+# download (from the response cache, or from the download of an identical request) are marked with the
+# SPLICED_KEY, since they were not paid for again.
+SOURCE_CACHE = "cache"
+SOURCE_ALIAS = "alias"
+SOURCE_LIVE = "live" # an immediate call, rather than a batch (see normalize_live)
+SPLICED_KEY = "spliced"
+
+# One response from a batch, in the same form for every provider
+class ResponseRecord:
+    __slots__ = ("id", "text", "has_thinking", "input_tokens", "reasoning_tokens", "output_tokens",
+                 "cached_tokens", "cache_write_tokens", "finish_reason", "error", "request", "source")
+
+    def __init__(self, id:str, text, has_thinking:bool = False, input_tokens:int = 0, reasoning_tokens:int = 0,
+                 output_tokens:int = 0, cached_tokens:int = 0, cache_write_tokens:int = 0,
+                 finish_reason:str = None, error = None, request = None, source:str = None):
+        self.id = id
+        self.text = text # None if the response had no text
+        self.has_thinking = has_thinking # whether the model reasoned (or thought) before answering
+        self.input_tokens = input_tokens
+        self.reasoning_tokens = reasoning_tokens # included in output_tokens for OpenAI, but not for Gemini
+        self.output_tokens = output_tokens
+        self.cached_tokens = cached_tokens # input tokens read from the provider's prompt cache
+        self.cache_write_tokens = cache_write_tokens # input tokens written to it (Claude only)
+        self.finish_reason = finish_reason
+        self.error = error # None if the request succeeded
+        self.request = request # the request, for providers that return it with the response (Gemini)
+        self.source = source # None for a response from the batch itself, or else one of the SOURCE_s
+
+    def is_spliced(self) -> bool:
+        return self.source in [SOURCE_CACHE, SOURCE_ALIAS]
+
+    def __repr__(self):
+        return "ResponseRecord(" + ", ".join([slot + "=" + repr(getattr(self, slot)) for slot in self.__slots__]) + ")"
+
+
+def normalize_openai(response_datum) -> ResponseRecord:
+    if response_datum.get("error") is not None:
+        return ResponseRecord(response_datum["custom_id"], None, error=response_datum["error"])
+    body = response_datum["response"]["body"]
+    usage = body["usage"]
+    assert len(body["choices"]) == 1
+    assert body["choices"][0]["message"]["role"] == "assistant"
+    reasoning_tokens = (usage.get("completion_tokens_details") or {}).get("reasoning_tokens") or 0
+    return ResponseRecord(response_datum["custom_id"], body["choices"][0]["message"]["content"],
+                          has_thinking=reasoning_tokens > 0,
+                          input_tokens=usage["prompt_tokens"],
+                          reasoning_tokens=reasoning_tokens,
+                          output_tokens=usage["completion_tokens"],
+                          cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0,
+                          finish_reason=body["choices"][0].get("finish_reason"))
+
+def normalize_claude(response_datum) -> ResponseRecord:
+    result = response_datum["result"]
+    if result["type"] != "succeeded":
+        return ResponseRecord(response_datum["custom_id"], None, error=result.get("error") or result["type"])
+    message = result["message"]
+    text = None
+    has_thinking = False
+    for content in message["content"]:
+        if content["type"] == "text":
+            assert text == None, "should be only one"
+            text = content["text"]
+        elif content["type"] in ["thinking", "redacted_thinking"]:
+            has_thinking = True
+    usage = message["usage"]
+    return ResponseRecord(response_datum["custom_id"], text,
+                          has_thinking=has_thinking,
+                          input_tokens=usage["input_tokens"],
+                          output_tokens=usage["output_tokens"],
+                          cached_tokens=usage.get("cache_read_input_tokens") or 0,
+                          cache_write_tokens=usage.get("cache_creation_input_tokens") or 0,
+                          finish_reason=message.get("stop_reason"))
+
+def normalize_google(response_datum) -> ResponseRecord:
+    if "response" not in response_datum or len(response_datum.get("status") or "") > 0:
+        return ResponseRecord(response_datum["key"], None, error=response_datum.get("status") or "no response",
+                              request=response_datum.get("request"))
+    response = response_datum["response"]
+    assert len(response["candidates"]) == 1
+    candidate = response["candidates"][0]
+    text = None
+    if "content" in candidate:
+        assert len(candidate["content"]["parts"]) == 1
+        assert candidate["content"]["role"] == "model"
+        text = candidate["content"]["parts"][0]["text"]
+    usage = response["usageMetadata"]
+    reasoning_tokens = usage.get("thoughtsTokenCount", 0)
+    return ResponseRecord(response_datum["key"], text,
+                          has_thinking=reasoning_tokens > 0,
+                          input_tokens=usage["promptTokenCount"],
+                          reasoning_tokens=reasoning_tokens,
+                          output_tokens=usage.get("candidatesTokenCount", 0),
+                          cached_tokens=usage.get("cachedContentTokenCount", 0),
+                          finish_reason=candidate.get("finishReason"),
+                          request=response_datum["request"])
+
+# Normalizes one response, as parsed from a line of a downloaded file.  The provider is told from the
+# shape of the line, so this works on any download.
+def normalize_response(response_datum) -> ResponseRecord:
+    if "custom_id" in response_datum:
+        if "result" in response_datum:
+            record = normalize_claude(response_datum)
+        else:
+            record = normalize_openai(response_datum)
+    else:
+        assert "key" in response_datum, "unknown response format"
+        record = normalize_google(response_datum)
+    record.source = response_datum.get(SPLICED_KEY)
+    return record
+
+# Normalizes one line of a downloaded file (which must not be blank)
+def normalize_line(line) -> ResponseRecord:
+    return normalize_response(loads(line))
+
+# Normalizes the response to an immediate call (see call_utils.get_call_spec), as given by the SDK, into a
+# record with the given id
+def normalize_live(id:str, response) -> ResponseRecord:
+    response_datum = response.model_dump()
+    if "choices" in response_datum: # OpenAI's chat completions
+        record = normalize_openai({"custom_id": id, "response": {"body": response_datum}})
+    elif response_datum.get("type") == "message": # Claude
+        record = normalize_claude({"custom_id": id, "result": {"type": "succeeded", "message": response_datum}})
+    else: # OpenAI's responses
+        usage = response_datum["usage"]
+        reasoning_tokens = (usage.get("output_tokens_details") or {}).get("reasoning_tokens") or 0
+        record = ResponseRecord(id, response.output_text, has_thinking=reasoning_tokens > 0,
+                                input_tokens=usage["input_tokens"], reasoning_tokens=reasoning_tokens,
+                                output_tokens=usage["output_tokens"],
+                                cached_tokens=(usage.get("input_tokens_details") or {}).get("cached_tokens") or 0,
+                                finish_reason=response_datum.get("status"))
+    record.source = SOURCE_LIVE
+    return record
+
+# Yields the normalized responses in a downloaded file, a line at a time
+def iter_responses(downloaded_filename:str):
+    with open(downloaded_filename, "rb") as f:
+        for line in f:
+            if len(line.strip()) > 0:
+                yield normalize_line(line)
+
+
+# Totals of the token usage over many responses, which is useful information for keeping track of costs
+class UsageTotals:
+    __slots__ = ("count", "input_tokens", "reasoning_tokens", "output_tokens", "cached_tokens", "cache_write_tokens")
+
+    def __init__(self):
+        for slot in self.__slots__:
+            setattr(self, slot, 0)
+
+    def add(self, record:ResponseRecord):
+        self.count += 1
+        self.input_tokens += record.input_tokens
+        self.reasoning_tokens += record.reasoning_tokens
+        self.output_tokens += record.output_tokens
+        self.cached_tokens += record.cached_tokens
+        self.cache_write_tokens += record.cache_write_tokens
+
+    def print_totals(self):
+        print("total_input_tokens =", self.input_tokens)
+        print("total_reasoning_tokens =", self.reasoning_tokens)
+        print("total_output_tokens = ", self.output_tokens)
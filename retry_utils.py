@@ -0,0 +1,146 @@
+# This is the retry policy for immediate calls (call_utils.raw_call, and the concurrent engine in
+# async_call_utils).  Errors are classified, so that bad requests fail at once while rate limits, overloads
+# and hiccups are retried, with exponential backoff and random jitter (so that many workers do not retry in
+# step), or as long as the server's Retry-After says.  All the retries share a budget, so that a widespread
+# outage fails fast rather than retrying forever, and a circuit breaker per provider and model holds off all
+# calls to it after repeated failures, rather than have every worker keep hitting it.
+import email.utils, random, threading, time
+
+MAX_ATTEMPTS = 10
+BASE_DELAY = 2.0 # seconds, doubled with each retry
+MAX_DELAY = 120.0 # seconds
+RETRY_BUDGET = 200 # retries allowed, over all calls, within RETRY_BUDGET_WINDOW
+RETRY_BUDGET_WINDOW = 600.0 # seconds
+BREAKER_FAILURES = 5 # consecutive failures after which a provider and model's circuit breaker opens
+BREAKER_COOLDOWN = 60.0 # seconds that an open circuit breaker holds off calls
+
+# Classes of errors
+ERROR_RATE_LIMIT = "rate_limit"
+ERROR_OVERLOADED = "overloaded"
+ERROR_SERVER = "server"
+ERROR_CONNECTION = "connection"
+ERROR_FATAL = "fatal" # e.g. a bad request, or bad credentials; retrying would not help
+
+# Classifies an exception from a call by its HTTP status (or, for errors with no response, by its type)
+def classify_error(e:Exception) -> str:
+    status_code = getattr(e, "status_code", None)
+    if status_code is None and getattr(e, "response", None) is not None:
+        status_code = getattr(e.response, "status_code", None)
+    if status_code is None and type(getattr(e, "code", None)) == int: # Google's API errors
+        status_code = e.code
+    if status_code == 429:
+        return ERROR_RATE_LIMIT
+    elif status_code in [503, 529]:
+        return ERROR_OVERLOADED
+    elif status_code == 408 or status_code == 409 or (status_code is not None and status_code >= 500):
+        return ERROR_SERVER
+    elif status_code is not None:
+        return ERROR_FATAL
+    elif "Timeout" in type(e).__name__ or "Connection" in type(e).__name__ or isinstance(e, (TimeoutError, ConnectionError)):
+        return ERROR_CONNECTION
+    elif isinstance(e, (AssertionError, TypeError, ValueError, KeyError, AttributeError)):
+        return ERROR_FATAL # a bug on our side
+    return ERROR_SERVER # unknown, so give it the benefit of the doubt
+
+# The seconds the server asked us to wait (from its Retry-After header), or None
+def get_retry_after(e:Exception):
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000.0
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        if retry_after.strip().replace(".", "", 1).isdigit():
+            return float(retry_after)
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()) # an HTTP date
+    except (TypeError, ValueError):
+        return None
+
+# The retries (over all calls) within the last RETRY_BUDGET_WINDOW
+class RetryBudget:
+    def __init__(self, max_retries:int, window:float):
+        self.max_retries = max_retries
+        self.window = window
+        self._times = []
+        self._lock = threading.Lock()
+
+    # Takes one retry from the budget, returning False if it is spent
+    def take(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._times = [t for t in self._times if t > now - self.window]
+            if len(self._times) >= self.max_retries:
+                return False
+            self._times.append(now)
+            return True
+
+# Opens after BREAKER_FAILURES consecutive failures, and then holds off calls for BREAKER_COOLDOWN, after which
+# calls are let through again (and a failure reopens it at once)
+class CircuitBreaker:
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    # Seconds to wait before calling (0 if the breaker is closed)
+    def get_wait(self) -> float:
+        with self._lock:
+            return max(0.0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= BREAKER_FAILURES:
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+_budget = RetryBudget(RETRY_BUDGET, RETRY_BUDGET_WINDOW)
+_breakers = {} # (provider, model) -> CircuitBreaker
+_breakers_lock = threading.Lock()
+
+def get_breaker(provider:str, model:str) -> CircuitBreaker:
+    with _breakers_lock:
+        if (provider, model) not in _breakers:
+            _breakers[(provider, model)] = CircuitBreaker()
+        return _breakers[(provider, model)]
+
+# Tracks the retries of one call.  Before each attempt, wait for get_wait() seconds; after a success, call
+# record_success(); after an exception, call get_retry_delay(), and either wait that long and try again, or
+# (if it returns None) give up and re-raise.
+class RetryState:
+    def __init__(self, provider:str, model:str):
+        self.breaker = get_breaker(provider, model)
+        self.model = model
+        self.attempts = 0
+
+    def get_wait(self) -> float:
+        return self.breaker.get_wait()
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def get_retry_delay(self, e:Exception):
+        self.attempts += 1
+        error_class = classify_error(e)
+        print("EXCEPTION from ", self.model, f", Error Type: {type(e).__name__} {e}, try number {self.attempts}",
+              "(" + error_class + ")")
+        if error_class == ERROR_FATAL:
+            return None
+        self.breaker.record_failure()
+        if self.attempts >= MAX_ATTEMPTS:
+            return None # re-throw it, since we've tried repeatedly
+        if not _budget.take():
+            print("RETRY BUDGET SPENT: too many retries across all calls; giving up")
+            return None
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** self.attempts)) # "full jitter"
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, MAX_DELAY))
+        return max(delay, self.breaker.get_wait())
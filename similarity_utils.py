@@ -0,0 +1,51 @@
+# This is a local grader for step-cloze answers, so that the foregone conclusions need not be sent to the
+# critic model: an answer that is a verbatim copy of the correct step (but for articles and the like, and
+# punctuation) gets a 3, and one that shares nothing with it (or is missing) gets a 0.  Everything in
+# between is left to the critic.  Along with the grade, it gives the similarity it was based on and the rule
+# that decided it.
+import collections, difflib, math, re
+
+NO_OVERLAP_MAX_SIMILARITY = 0.2 # of the character trigrams, for a local 0 (along with no content words shared)
+NO_ANSWER = "**HAD ERROR**" # what step_cloze_grade.py grades when there was no response
+
+STOPWORDS = set(["a", "an", "the", "of", "to", "in", "on", "for", "and", "or", "by", "with", "from", "as", "at",
+                 "its", "their", "his", "her", "which", "that", "this", "is", "are", "be", "all", "also"])
+# Words whose presence or absence never changes the meaning of a step, so that a verbatim copy may differ in them.
+# A single other word (e.g. "foreign" for "domestic", or "to" for "from") can turn the step around.
+VERBATIM_IGNORED_WORDS = set(["a", "an", "the", "also", "that", "which"])
+
+# Lowercased words and numbers (e.g. "$1,000" becomes "1000"), in order
+def get_tokens(text:str) -> list:
+    return re.findall(r"[a-z0-9§]+(?:['.][a-z0-9]+)*", text.lower().replace(",", "").replace("$", ""))
+
+# Cosine similarity of the character trigram counts of the two texts
+def get_char_similarity(text1:str, text2:str) -> float:
+    def trigrams(text):
+        text = " " + " ".join(get_tokens(text)) + " "
+        return collections.Counter([text[i:i+3] for i in range(len(text) - 2)])
+    counts1 = trigrams(text1)
+    counts2 = trigrams(text2)
+    dot = sum([count * counts2[trigram] for trigram, count in counts1.items()])
+    norms = math.sqrt(sum([c * c for c in counts1.values()])) * math.sqrt(sum([c * c for c in counts2.values()]))
+    return 0.0 if norms == 0 else dot / norms
+
+# Returns (grade, similarity, rule), where grade is 3 or 0 if the answer can be graded locally, or None if it
+# needs the critic
+def grade_locally(correct_answer:str, answer_to_grade:str):
+    if answer_to_grade is None or len(answer_to_grade.strip()) == 0 or answer_to_grade.strip() == NO_ANSWER:
+        return 0, 0.0, "no answer"
+    correct_tokens = get_tokens(correct_answer)
+    answer_tokens = get_tokens(answer_to_grade)
+
+    # Every other word must be the same, in the same order, since one word can change the meaning
+    sequence_similarity = difflib.SequenceMatcher(None, correct_tokens, answer_tokens, autojunk=False).ratio()
+    if [token for token in correct_tokens if token not in VERBATIM_IGNORED_WORDS] == \
+            [token for token in answer_tokens if token not in VERBATIM_IGNORED_WORDS]:
+        return 3, sequence_similarity, "verbatim"
+
+    correct_content = set(correct_tokens) - STOPWORDS
+    answer_content = set(answer_tokens) - STOPWORDS
+    char_similarity = get_char_similarity(correct_answer, answer_to_grade)
+    if len(correct_content.intersection(answer_content)) == 0 and char_similarity < NO_OVERLAP_MAX_SIMILARITY:
+        return 0, char_similarity, "no overlap"
+    return None, max(sequence_similarity, char_similarity), "needs critic"
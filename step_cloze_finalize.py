@@ -1,55 +1,95 @@
 # This is the final step in step-cloze grading
-import os, sys, json, re
-import batch_utils
+import json, os, sys
+import async_call_utils, batch_utils, metrics_utils, response_utils, step_grading_utils
 
 CRITIC_MODEL = "o3-2025-04-16"
 
 assert len(sys.argv) == 3, "Usage: <testname> <batchid>"
 testname = sys.argv[1]
 batchid = sys.argv[2] # This is an ID used by the server API (e.g. OpenAI's API)
+metrics = metrics_utils.StageMetrics(testname, CRITIC_MODEL, batchid)
 
 # Do the download from the server to a local file
 download_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_DOWNLOAD2 + ".jsonl"
 if os.path.exists(download_file):
     print("NOTE: The following file already exists:", download_file)
-batch_utils.download_response(batchid, download_file, CRITIC_MODEL)
-
-# Open the downloaded file
-download_data = []
-with open(download_file, "r") as f:
-    for line in f.readlines():
-        download_data.append(json.loads(line))
-
-# Run through the output
-total_input_tokens = 0
-total_reasoning_tokens = 0
-total_output_tokens = 0
+with metrics.phase("download"):
+    batch_utils.download_response(batchid, download_file, CRITIC_MODEL)
+
+# The answers packed several to a request, if any (see step_grading_utils)
+upload_file = batch_utils.get_upload_filename(download_file)
+packs = {}
+if os.path.exists(step_grading_utils.get_packs_filename(upload_file)):
+    packs = step_grading_utils.read_packs(upload_file)
+
+# Run through the output, a record at a time
 dict_histogram = {"0": 0, "1":0, "2":0, "3":0, "unknown":0}
-for response_datum in download_data:
-    assert response_datum["error"] == None
-    total_input_tokens += response_datum["response"]["body"]["usage"]["prompt_tokens"]
-    total_reasoning_tokens += response_datum["response"]["body"]["usage"]["completion_tokens_details"]["reasoning_tokens"]
-    total_output_tokens += response_datum["response"]["body"]["usage"]["completion_tokens"]
-    id = response_datum["custom_id"]
-    assert len(response_datum["response"]["body"]["choices"]) == 1
-    assert response_datum["response"]["body"]["choices"][0]["message"]["role"] == "assistant"
-    response = response_datum["response"]["body"]["choices"][0]["message"]["content"]
+list_to_requeue = [] # (id, correct answer, answer to grade) of the packed answers that got no proper grade
+seen_pack_ids = set()
+for record in response_utils.iter_responses(download_file):
+    assert record.error == None, "error for " + record.id + ": " + str(record.error)
+    metrics.add_record(record)
+    id = record.id
+    response = record.text
+
+    # A packed request has a grade per answer, which should be on a line of its own
+    if id in packs:
+        seen_pack_ids.add(id)
+        grades = step_grading_utils.parse_packed_grades(response, len(packs[id]))
+        for item_num, (item_id, correct_answer, answer_to_grade) in enumerate(packs[id], 1):
+            if item_num not in grades:
+                print("WARNING: No grade for", item_id, "in", id)
+                list_to_requeue.append((item_id, correct_answer, answer_to_grade))
+                continue
+            print(item_id, "\t", "(" + id + ")", "\t", grades[item_num])
+            dict_histogram[grades[item_num]] += 1
+        continue
 
     # Analyze it, taking the rightmost instance of one of the acceptable numbers
-    matches = list(re.finditer("[0-3]", response))
-    if len(matches) == 0:
-        result = "unknown"
+    result = step_grading_utils.parse_grade(response)
+    if result == "unknown":
         print("WARNING: Unknown answer")
-    else:
-        result = matches[-1].group()
 
     print(id, "\t", response, "\t", result)
     dict_histogram[result] += 1
+count_downloaded = metrics.totals.count
+for pack_id in packs:
+    if pack_id not in seen_pack_ids:
+        print("WARNING: No response for", pack_id)
+        list_to_requeue.extend([tuple(item) for item in packs[pack_id]])
+
+# Grade the packed answers that got no proper grade again, one to a request, now rather than in another batch
+if len(list_to_requeue) > 0:
+    print("Grading", len(list_to_requeue), "answers again, one at a time")
+    grading_preamble = step_grading_utils.read_grading_preamble()
+    with metrics.phase("grade_again"):
+        responses = async_call_utils.call_api_many(
+            [step_grading_utils.make_grading_prompt(grading_preamble, correct_answer, answer_to_grade)
+             for id, correct_answer, answer_to_grade in list_to_requeue], CRITIC_MODEL,
+            on_response=lambda item_num, response: metrics.add_record(
+                response_utils.normalize_live(list_to_requeue[item_num][0], response)))
+    for (id, correct_answer, answer_to_grade), response in zip(list_to_requeue, responses):
+        result = step_grading_utils.parse_grade(response)
+        print(id, "\t", "(graded again)", "\t", response, "\t", result)
+        dict_histogram[result] += 1
+
+# Add the grades that step_cloze_grade.py gave locally, rather than with the critic
+local_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_LOCAL2 + ".jsonl"
+count_local = 0
+if os.path.exists(local_file):
+    with open(local_file, "r", encoding="utf-8") as f:
+        for line in f:
+            local_grade = json.loads(line)
+            print(local_grade["id"], "\t", "(graded locally: " + local_grade["rule"] + ")", "\t", local_grade["grade"])
+            dict_histogram[local_grade["grade"]] += 1
+            count_local += 1
 
 # Here is useful information for keeping track of costs
-print("total_input_tokens =", total_input_tokens)
-print("total_reasoning_tokens =", total_reasoning_tokens)
-print("total_output_tokens = ", total_output_tokens)
-print("TOTAL DOWNLOADED=", len(download_data))
+metrics.print_totals()
+metrics.add_count("graded_locally", count_local)
+metrics.add_count("graded_again", len(list_to_requeue))
+print("TOTAL DOWNLOADED=", count_downloaded, "TOTAL GRADED LOCALLY=", count_local, "TOTAL GRADED AGAIN=", len(list_to_requeue))
 
-print("HISTOGRAM:", dict_histogram)
\ No newline at end of file
+print("HISTOGRAM:", dict_histogram)
+metrics.add_count("unknown_grades", dict_histogram["unknown"])
+metrics.write()
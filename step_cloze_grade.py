@@ -1,67 +1,50 @@
 # This is the second part of step-cloze, in which we call to get a grade on the answer.
-# We always use o3 as the critic model.
-import os, sys, json
-import batch_utils, utils
+# We always use o3 as the critic model.  Answers that are verbatim copies of the correct step (a 3), or
+# that share nothing with it (a 0), are graded locally (see similarity_utils) and written to the _local2 file,
+# so only the rest go to the critic; add --grade_all to send them all.  With --pack K, each request to the
+# critic grades K answers under a single copy of the few-shot preamble (see step_grading_utils).
+import argparse, json, os
+import batch_utils, metrics_utils, response_utils, similarity_utils, step_grading_utils, utils
 
 CRITIC_MODEL = "o3-2025-04-16"
 
-assert len(sys.argv) == 4, "Usage: <testname> <original-model> <batchid>"
-testname = sys.argv[1]
-original_model = sys.argv[2]
-batchid = sys.argv[3] # This is an ID used by the server API (e.g. OpenAI's API)
+parser = argparse.ArgumentParser(
+    description='Grades the step-cloze answers, locally or with the critic model')
+parser.add_argument('testname')
+parser.add_argument('original_model')
+parser.add_argument('batchid', help='ID used by the server API (e.g. OpenAI\'s API)')
+parser.add_argument('--grade_all', action="store_true",
+                    help='send every answer to the critic, rather than grading the clear ones locally')
+parser.add_argument('--pack', default=1, type=int,
+                    help='number of answers to grade in each request to the critic')
+args = parser.parse_args()
+assert args.pack >= 1
+testname = args.testname
+original_model = args.original_model
+batchid = args.batchid
+grade_all = args.grade_all
+metrics = metrics_utils.StageMetrics(testname, original_model, batchid)
 
 download_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_DOWNLOAD1 + ".jsonl"
 if os.path.exists(download_file):
     print("NOTE: The following file already exists:", download_file)
-batch_utils.download_response(batchid, download_file, original_model)
+with metrics.phase("download"):
+    batch_utils.download_response(batchid, download_file, original_model)
 
-# Open the downloaded file
-download_data = []
-with open(download_file, "r") as f:
-    for line in f.readlines():
-        download_data.append(json.loads(line))
-
-# Run through the output, building up the input
-total_input_tokens = 0
-total_reasoning_tokens = 0
-total_output_tokens = 0
+# Run through the output (a record at a time), building up the input
 list_ids_prompts = [] # will be passed to call for grading
-for response_datum in download_data:
-    line_to_grade = None
-    id = None
-    if batch_utils.is_openai(original_model):
-        assert response_datum["error"] == None
-        total_input_tokens += response_datum["response"]["body"]["usage"]["prompt_tokens"]
-        total_reasoning_tokens += response_datum["response"]["body"]["usage"]["completion_tokens_details"]["reasoning_tokens"]
-        total_output_tokens += response_datum["response"]["body"]["usage"]["completion_tokens"]
-        id = response_datum["custom_id"]
-        assert len(response_datum["response"]["body"]["choices"]) == 1
-        assert response_datum["response"]["body"]["choices"][0]["message"]["role"] == "assistant"
-        line_to_grade = response_datum["response"]["body"]["choices"][0]["message"]["content"]
-    elif batch_utils.is_claude(original_model):
-        assert response_datum["result"]["type"] == "succeeded"
-        total_input_tokens += response_datum["result"]["message"]["usage"]["input_tokens"]
-        total_output_tokens += response_datum["result"]["message"]["usage"]["output_tokens"]
-        id = response_datum["custom_id"]
-
-        for content in response_datum["result"]["message"]["content"]:
-            if content["type"] == "text":  # other type includes "thinking"
-                assert line_to_grade == None, "should be only one"
-                line_to_grade = content["text"]
-    elif batch_utils.is_google(original_model):
-        id = response_datum["key"]
-
-        assert len(response_datum["response"]["candidates"]) == 1
-        assert response_datum["response"]["candidates"][0]["finishReason"] == "STOP"
-
-        total_input_tokens += response_datum["response"]["usageMetadata"]["promptTokenCount"]
-        total_output_tokens += response_datum["response"]["usageMetadata"]["candidatesTokenCount"]
-
-        assert len(response_datum["response"]["candidates"][0]["content"]["parts"]) == 1
-        line_to_grade = response_datum["response"]["candidates"][0]["content"]["parts"][0]["text"]
-
-    else:
-        assert False, "not implemented"
+list_to_pack = [] # (id, correct answer, answer to grade), if packing
+grading_preamble = step_grading_utils.read_grading_preamble()
+local_file = batch_utils.DIR_BATCH_DOWNLOADS + testname + batch_utils.POSTFIX_LOCAL2 + ".jsonl"
+f_local = open(local_file, "w", encoding="utf-8") # the grades given locally
+count_local = 0
+for record in response_utils.iter_responses(download_file):
+    assert record.error == None, "error for " + record.id + ": " + str(record.error)
+    if batch_utils.is_google(original_model):
+        assert record.finish_reason == "STOP"
+    metrics.add_record(record)
+    id = record.id
+    line_to_grade = record.text
 
     if line_to_grade == None:
         print("ERROR: no line to grade", id)
@@ -78,29 +61,53 @@ for response_datum in download_data:
         else:
             line_to_grade = line_to_grade.split("\n")[1].strip()
 
-    f_grading = open("few_shot_step_grading.txt", "r")  # This file is a key component
-    user_prompt = f_grading.read()
-    correct_and_to_grade = "CORRECT ANSWER: "
-    correct_and_to_grade += utils.get_strategy_step_by_str(id)
-    correct_and_to_grade += "\nANSWER TO GRADE: "
-    correct_and_to_grade += line_to_grade
-    print(id, "\n", correct_and_to_grade)
-    user_prompt += correct_and_to_grade
-    user_prompt += "\nWhat grade do you give this answer (3, 2, 1, or 0)?  Do **not** show your analysis.  " + \
-        "Answer with **only** one of the numbers 3, 2, 1 or 0."
-
-    list_ids_prompts.append((id, user_prompt))
+    correct_answer = utils.get_strategy_step_by_str(id)
+    if not grade_all:
+        grade, similarity, rule = similarity_utils.grade_locally(correct_answer, line_to_grade)
+        if grade is not None:
+            print(id, "\n", "GRADED LOCALLY:", grade, "(" + rule + ")", line_to_grade)
+            f_local.write(json.dumps({"id": id, "grade": str(grade), "similarity": similarity, "rule": rule,
+                                      "answer": line_to_grade}) + "\n")
+            count_local += 1
+            continue
+
+    print(id, "\n", "CORRECT ANSWER: " + correct_answer + "\nANSWER TO GRADE: " + line_to_grade)
+    if args.pack > 1:
+        list_to_pack.append((id, correct_answer, line_to_grade))
+    else:
+        list_ids_prompts.append((id, step_grading_utils.make_grading_prompt(grading_preamble, correct_answer,
+                                                                           line_to_grade)))
+f_local.close()
+
+# Pack the answers, K to a request, recording which answers went into each (a lone answer is not packed)
+packs = {}
+for idx_start in range(0, len(list_to_pack), args.pack):
+    items = list_to_pack[idx_start:idx_start + args.pack]
+    if len(items) == 1:
+        id, correct_answer, line_to_grade = items[0]
+        list_ids_prompts.append((id, step_grading_utils.make_grading_prompt(grading_preamble, correct_answer,
+                                                                           line_to_grade)))
+        continue
+    pack_id = step_grading_utils.PACK_ID_PREFIX + str(len(packs) + 1)
+    packs[pack_id] = [list(item) for item in items]
+    list_ids_prompts.append((pack_id, step_grading_utils.make_packed_grading_prompt(
+        grading_preamble, [(correct_answer, line_to_grade) for id, correct_answer, line_to_grade in items])))
 
 # Here is useful information for keeping track of costs
-print("total_input_tokens =", total_input_tokens)
-print("total_reasoning_tokens =", total_reasoning_tokens)
-print("total_output_tokens = ", total_output_tokens)
-print("TOTAL ITEMS IN=", len(download_data), "TOTAL ITEMS OUT=", len(list_ids_prompts))
+metrics.print_totals()
+metrics.add_count("graded_locally", count_local)
+metrics.add_count("packed", sum([len(items) for items in packs.values()]))
+print("TOTAL ITEMS IN=", metrics.totals.count, "TOTAL ITEMS OUT=", len(list_ids_prompts), "GRADED LOCALLY=", count_local,
+      "PACKED=", sum([len(items) for items in packs.values()]), "IN", len(packs), "REQUESTS")
 
 # Write the files to get the clarifications and make the call
 batch_filename = batch_utils.write_batch_file(testname,
                                               batch_utils.POSTFIX_UPLOAD2,
                                               CRITIC_MODEL,
                                               list_ids_prompts)
+if len(packs) > 0:
+    step_grading_utils.write_packs(batch_filename, packs)
+elif os.path.exists(step_grading_utils.get_packs_filename(batch_filename)):
+    os.remove(step_grading_utils.get_packs_filename(batch_filename)) # from an earlier run
 batch_utils.upload_file_and_start(batch_filename, CRITIC_MODEL)
-
+metrics.write()
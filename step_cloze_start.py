@@ -1,7 +1,7 @@
 # This is the first file for step cloze.  This generates the actual prompt that will
 # elicit the result that is the central part of the task.
-import argparse, copy
-import call_utils, utils, batch_utils
+import argparse, contextlib
+import call_utils, utils, batch_utils, prompt_utils
 
 parser = argparse.ArgumentParser(
     description='Starts the step-cloze task on Shelter Check dataset')
@@ -9,119 +9,125 @@ parser.add_argument('--num', required=False, type=int,
                     help='number of which strategy to run over; if not passed, then ALL are run')
 parser.add_argument('--model', required=True,
                     help='which LLM to call or prepare to call')
-parser.add_argument('--N_shot', default=0, type=int,
-                    help='number of N-shots (0, 1, or 2)')
+parser.add_argument('--N_shot', default=[0], type=int, nargs="+",
+                    help='number of N-shots (0, 1, or 2); pass several (e.g. 0 1 2) to generate each in the same pass')
+parser.add_argument('--N_shot_selector', default="paper", choices=["paper"],
+                    help='which examples to use for the N-shots (see N_SHOT_SELECTORS)')
 args = parser.parse_args()
+args.N_shot = sorted(set(args.N_shot)) # each N has one output file, so one writer
 print("args=", args)
 call_utils.log_arbitrary("step_cloze, with args=" + str(args))
-assert args.N_shot in [0, 1, 2]
 
-FILES_TO_EXCLUDE = [1, 11] # cannot run tests on files with steps used in N-shot
+# The N-shot examples, as (filename, step number) pairs.  A selector returns the examples for a given N;
+# to try other examples, add a selector here (and to the choices for --N_shot_selector).  Every file the
+# selector might use is excluded from the tests, so the results for different N remain comparable.
+PAPER_N_SHOT_EXAMPLES = [("1_Distressed_Assets_Trust.txt", 3), ("11_Subsidiary_Handling_Stock_Compensation.txt", 4)]
+N_SHOT_SELECTORS = {
+    "paper": (lambda N_shot: PAPER_N_SHOT_EXAMPLES[:N_shot], PAPER_N_SHOT_EXAMPLES),
+}
+select_N_shot_examples, all_N_shot_examples = N_SHOT_SELECTORS[args.N_shot_selector]
+for N_shot in args.N_shot:
+    assert 0 <= N_shot <= len(all_N_shot_examples), "not enough examples for " + str(N_shot) + "-shot"
+
+FILES_TO_EXCLUDE = sorted(set([int(utils.get_prefix_from_filename(x[0])) for x in all_N_shot_examples]))
 assert args.num not in FILES_TO_EXCLUDE, "this file used for N-shot"
-if args.N_shot == 0:
-    N_shot_examples = []
-elif args.N_shot == 1:
-    N_shot_examples = [("1_Distressed_Assets_Trust.txt", 3)]
-elif args.N_shot == 2:
-    N_shot_examples = [("1_Distressed_Assets_Trust.txt", 3), ("11_Subsidiary_Handling_Stock_Compensation.txt", 4)]
-
-
-# TODO: Get the N-shots if necessary
-
-
-list_ids_prompts = [] # These will be actually passed to the LLM; list of 2-tuples of (id, prompt)
-
-# Loop over all filenames (that are not excluded or pre-specified)
-for filename in utils.get_list_filenames():
-    if (args.num is None or filename == utils.get_filename_from_prefix(args.num)) and \
-            int(utils.get_prefix_from_filename(filename)) not in FILES_TO_EXCLUDE:
-        num_strategy_steps = utils.count_strategy_steps(filename)
-
-        # Loop over all strategy steps in that filename's strategy
-        for step_num in range(1, num_strategy_steps+1):
-            files_and_nums = copy.deepcopy(N_shot_examples)
-            files_and_nums.append((filename , step_num))  # The final one to pass is the actual one we want completed
-
-            user_prompt = "You will be filling in one missing step in a tax strategy that must meet a " + \
-                          "specified goal or goal(s). You will be given background facts, " + \
-                          "particular tax-law authorities that the strategy should employ, " + \
-                          "and other steps in a tax strategy that does meet the goal or goal(s). " + \
-                          utils.IGNORE_DOCTRINES_PROMPT_TEXT + "\n\n"
-
-            # Further construct the prompt, including any N-shot examples prior to the one at hand.
-            gold_standard_answer = None
-            for idx_strategy_step in range(args.N_shot + 1):  # when it equals N_shot, we will be using the actual one to test
-                DIVIDER = "-----------------------------------\n"
-                if args.N_shot > 1 and 0 == idx_strategy_step:
-                    user_prompt += "First, here are " + str(args.N_shot) + " examples of the task being completed:\n" + \
-                                   DIVIDER
-                elif args.N_shot > 1 and 0 < idx_strategy_step < args.N_shot:
-                    user_prompt += DIVIDER + "Here is another example of the task being completed:\n" + DIVIDER
-                elif args.N_shot == 1 and 0 == idx_strategy_step:
-                    user_prompt += DIVIDER + "First, here is an example of the task being completed:\n" + DIVIDER
-                elif args.N_shot > 0 and args.N_shot == idx_strategy_step:
-                    user_prompt += DIVIDER + "Now, here is the actual task for you:\n" + DIVIDER
-
-                cur_file, cur_step_num = files_and_nums[idx_strategy_step]
-                authorities_str, background_str, goal_str, strategy_str, analysis_str, \
-                    adversarial_step_str, primary_area_str, strategy_type_str = utils.parse_file(cur_file)
-
-                goals = utils.strip_numbering(goal_str)
-                is_are = "is"
-                goal_goals = "goal"
-                if len(goals) > 1:
-                    is_are = "are"
-                    goal_goals = "goals"
-
-                strategy_steps = strategy_str.strip().split("\n")
-                assert len(strategy_steps) == len(utils.strip_numbering(strategy_str))
-                assert len(strategy_steps) > 1
-                if len(strategy_steps) == 2:
-                    step_steps = "step"
-                else:
-                    step_steps = "steps"
-
-                user_prompt += "Here are the authorities to employ:\n\n" + authorities_str
-                assert len(
-                    background_str.strip()) > 0, "Expected background; generation makes no sense without background facts"
-                user_prompt += "\n\nHere are the background facts:\n\n" + background_str.strip()
-                user_prompt += "\n\nHere " + is_are + " the " + goal_goals + \
-                               " the tax strategy must meet:\n\n" + goal_str
-                user_prompt += "\n\nHere is a tax strategy that meets the " + goal_goals + ":\n\n"
-
-                blanked_out_step = None
-                for step in range(1, len(strategy_steps) + 1):  # 1-indexed, whereas strategy_steps is 0-indexed
-                    assert strategy_steps[step - 1].startswith(str(step))
-                    if step == cur_step_num:
-                        user_prompt += str(step) + ") [BLANK]\n"
-                        blanked_out_step = strategy_steps[step - 1][len(str(step) + ")"):].strip()
-                        if idx_strategy_step == args.N_shot:
-                            gold_standard_answer = blanked_out_step
-                    else:
-                        user_prompt += strategy_steps[step - 1] + "\n"
-
-                user_prompt += "\nCome up with a strategy step that would replace [BLANK] and would meet the " + \
-                      goal_goals + ", given the authorities, background facts, and other " + step_steps + ".  " + \
-                      "Your answer must be a **single** sentence and cannot include your reasoning or " + \
-                      "any legal analysis."
-
-                if idx_strategy_step < args.N_shot:  # for N-shot items, give the answer
-                    user_prompt += "\nANSWER: " + blanked_out_step + "\n\n"
-
-            id = utils.make_strategy_step_str(utils.get_prefix_from_filename(filename), step_num)
-            assert gold_standard_answer == utils.get_strategy_step_by_str(id)
-
-            list_ids_prompts.append((id, user_prompt))
-
-
-if args.num is None:
-    testname = batch_utils.get_testname("step_cloze_N" + str(args.N_shot), args.model)
-else:
-    testname = batch_utils.get_testname("step_cloze_s" + str(args.num) + "_N" + str(args.N_shot), args.model)
-print("testname=", testname)
-print("NUM ITEMS=", len(list_ids_prompts))
-batch_filename = batch_utils.write_batch_file(testname,
-                                              batch_utils.POSTFIX_UPLOAD1,
-                                              args.model,
-                                              list_ids_prompts)
-batch_utils.upload_file_and_start(batch_filename, args.model)
+
+INTRO = "You will be filling in one missing step in a tax strategy that must meet a " + \
+        "specified goal or goal(s). You will be given background facts, " + \
+        "particular tax-law authorities that the strategy should employ, " + \
+        "and other steps in a tax strategy that does meet the goal or goal(s). " + \
+        utils.IGNORE_DOCTRINES_PROMPT_TEXT + "\n\n"
+DIVIDER = "-----------------------------------\n"
+
+# One strategy with one step blanked out; used both for the N-shot examples and for the actual task
+BLANKED_STRATEGY_TEMPLATE = prompt_utils.PromptTemplate(
+    "Here are the authorities to employ:\n\n{authorities}\n\nHere are the background facts:\n\n{background}" +
+    "\n\nHere {is_are} the {goal_goals} the tax strategy must meet:\n\n{goal_str}" +
+    "\n\nHere is a tax strategy that meets the {goal_goals}:\n\n{steps}" +
+    "\nCome up with a strategy step that would replace [BLANK] and would meet the {goal_goals}, " +
+    "given the authorities, background facts, and other {step_steps}.  " +
+    "Your answer must be a **single** sentence and cannot include your reasoning or any legal analysis.")
+
+# Binds everything about a strategy except which step is blanked out.  Returns the bound template and the
+# strategy's (numbered) steps.
+def bind_strategy(filename:str):
+    record = utils.load_strategy(filename)
+    strategy_steps = record.strategy_str.strip().split("\n")
+    assert len(strategy_steps) == record.num_strategy_steps
+    assert len(strategy_steps) > 1
+    for step in range(1, len(strategy_steps) + 1):  # 1-indexed, whereas strategy_steps is 0-indexed
+        assert strategy_steps[step - 1].startswith(str(step))
+    assert len(record.background_str.strip()) > 0, "Expected background; generation makes no sense without background facts"
+    template = BLANKED_STRATEGY_TEMPLATE.bind(authorities=record.authorities_str,
+                                              background=record.background_str.strip(),
+                                              is_are="are" if len(record.goals) > 1 else "is",
+                                              goal_goals="goals" if len(record.goals) > 1 else "goal",
+                                              goal_str=record.goal_str,
+                                              step_steps="step" if len(strategy_steps) == 2 else "steps")
+    return template, strategy_steps
+
+# Renders the strategy with the given step blanked out, returning it and the step that was blanked out
+def render_blanked(template, strategy_steps, blank_step_num:int):
+    steps = "".join([str(step) + ") [BLANK]\n" if step == blank_step_num else strategy_steps[step - 1] + "\n"
+                     for step in range(1, len(strategy_steps) + 1)])
+    blanked_out_step = strategy_steps[blank_step_num - 1][len(str(blank_step_num) + ")"):].strip()
+    return template.render(steps=steps), blanked_out_step
+
+# The text introducing each of the N-shot examples, and then the actual task
+def get_divider(idx_strategy_step:int, N_shot:int) -> str:
+    if N_shot > 1 and 0 == idx_strategy_step:
+        return "First, here are " + str(N_shot) + " examples of the task being completed:\n" + DIVIDER
+    elif N_shot > 1 and 0 < idx_strategy_step < N_shot:
+        return DIVIDER + "Here is another example of the task being completed:\n" + DIVIDER
+    elif N_shot == 1 and 0 == idx_strategy_step:
+        return DIVIDER + "First, here is an example of the task being completed:\n" + DIVIDER
+    elif N_shot > 0 and N_shot == idx_strategy_step:
+        return DIVIDER + "Now, here is the actual task for you:\n" + DIVIDER
+    return ""
+
+
+# Everything in the prompt before the actual task (the introduction and any N-shot examples, with their
+# answers) is the same for every step, so it is built just once per N for the whole run.
+N_shot_prefixes = {}
+for N_shot in args.N_shot:
+    prompt_parts = [INTRO]
+    for idx_strategy_step, (example_file, example_step_num) in enumerate(select_N_shot_examples(N_shot)):
+        example_template, example_steps = bind_strategy(example_file)
+        example_text, example_answer = render_blanked(example_template, example_steps, example_step_num)
+        prompt_parts += [get_divider(idx_strategy_step, N_shot), example_text,
+                         "\nANSWER: " + example_answer + "\n\n"] # for N-shot items, give the answer
+    prompt_parts.append(get_divider(N_shot, N_shot))
+    N_shot_prefixes[N_shot] = "".join(prompt_parts)
+
+# The prompts are streamed straight to a batch file for each N (the ExitStack closes them all, or removes
+# them all if anything goes wrong, before any is uploaded)
+batch_writers = {}
+with contextlib.ExitStack() as stack:
+    for N_shot in args.N_shot:
+        if args.num is None:
+            testname = batch_utils.get_testname("step_cloze_N" + str(N_shot), args.model)
+        else:
+            testname = batch_utils.get_testname("step_cloze_s" + str(args.num) + "_N" + str(N_shot), args.model)
+        print("testname=", testname)
+        batch_writers[N_shot] = stack.enter_context(
+            batch_utils.BatchFileWriter(testname, batch_utils.POSTFIX_UPLOAD1, args.model))
+
+    # Loop over all filenames (that are not excluded or pre-specified)
+    for filename in utils.get_list_filenames():
+        if (args.num is None or filename == utils.get_filename_from_prefix(args.num)) and \
+                int(utils.get_prefix_from_filename(filename)) not in FILES_TO_EXCLUDE:
+            strategy_template, strategy_steps = bind_strategy(filename)
+
+            # Loop over all strategy steps in that filename's strategy
+            for step_num in range(1, len(strategy_steps)+1):
+                task_text, gold_standard_answer = render_blanked(strategy_template, strategy_steps, step_num)
+                id = utils.make_strategy_step_str(utils.get_prefix_from_filename(filename), step_num)
+                assert gold_standard_answer == utils.get_strategy_step_by_str(id)
+
+                for N_shot in args.N_shot:
+                    batch_writers[N_shot].write((id, N_shot_prefixes[N_shot] + task_text))
+
+
+for N_shot, batch_writer in batch_writers.items():
+    print("N_shot=", N_shot, "NUM ITEMS=", batch_writer.count)
+    batch_utils.upload_file_and_start(batch_writer.filename, args.model)
@@ -0,0 +1,72 @@
+# This is the code for the critic's step-cloze grading prompts, shared by step_cloze_grade.py and
+# step_cloze_finalize.py.  A prompt grades either a single pair (the correct step and the answer to grade),
+# or, when packed, several pairs under a single copy of the few-shot preamble, so that the preamble is paid
+# for once per request rather than once per pair.  The grades of a packed request come back as one
+# "ITEM <number>: <grade>" line per pair, and the pairs of each packed request are recorded in a file
+# alongside the batch file, so that the grades can be mapped back to their ids.
+import json, re
+
+GRADING_PREAMBLE_FILE = "few_shot_step_grading.txt" # This file is a key component
+SINGLE_PAIR_INTRO = "Here is the pair to analyze and grade:\n\n" # how the preamble ends
+PACK_ID_PREFIX = "Pack_"
+
+def read_grading_preamble() -> str:
+    with open(GRADING_PREAMBLE_FILE, "r") as f:
+        return f.read()
+
+def make_grading_prompt(preamble:str, correct_answer:str, answer_to_grade:str) -> str:
+    return preamble + "CORRECT ANSWER: " + correct_answer + "\nANSWER TO GRADE: " + answer_to_grade + \
+        "\nWhat grade do you give this answer (3, 2, 1, or 0)?  Do **not** show your analysis.  " + \
+        "Answer with **only** one of the numbers 3, 2, 1 or 0."
+
+# A prompt to grade the (correct answer, answer to grade) pairs, each on its own
+def make_packed_grading_prompt(preamble:str, pairs:list) -> str:
+    if preamble.endswith(SINGLE_PAIR_INTRO):
+        preamble = preamble[:-len(SINGLE_PAIR_INTRO)]
+    prompt = preamble + "Here are the " + str(len(pairs)) + " pairs to analyze and grade.  Grade each pair " + \
+        "on its own, independently of the others:\n\n"
+    for item_num, (correct_answer, answer_to_grade) in enumerate(pairs, 1):
+        prompt += "ITEM " + str(item_num) + "\nCORRECT ANSWER: " + correct_answer + \
+            "\nANSWER TO GRADE: " + answer_to_grade + "\n\n"
+    prompt += "What grade (3, 2, 1, or 0) do you give the answer of each item?  Do **not** show your analysis.  " + \
+        "Answer with **only** one line per item, from ITEM 1 to ITEM " + str(len(pairs)) + \
+        ", each in the form \"ITEM <number>: <grade>\"."
+    return prompt
+
+# The grade in a response to a single-pair prompt: the rightmost instance of one of the acceptable numbers
+# ("unknown" if there is none, or no response at all)
+def parse_grade(response:str) -> str:
+    matches = list(re.finditer("[0-3]", response if response is not None else ""))
+    if len(matches) == 0:
+        return "unknown"
+    return matches[-1].group()
+
+PACKED_GRADE = re.compile(r"^[\s*_#>\-]*item\s*(\d+)\**\s*[:.)\-–—=]\s*\**\s*([0-3])\**\s*\.?\s*$",
+                          re.IGNORECASE | re.MULTILINE)
+
+# The grades in a response to a packed prompt of num_items pairs, as a dict of item number -> grade.  Items
+# that are missing, out of range or given conflicting grades are left out, to be graded again.
+def parse_packed_grades(response:str, num_items:int) -> dict:
+    grades = {}
+    conflicting = set()
+    for match in PACKED_GRADE.finditer(response if response is not None else ""):
+        item_num = int(match.group(1))
+        if not 1 <= item_num <= num_items:
+            continue
+        if item_num in grades and grades[item_num] != match.group(2):
+            conflicting.add(item_num)
+        grades[item_num] = match.group(2)
+    return {item_num: grade for item_num, grade in grades.items() if item_num not in conflicting}
+
+# The file recording the pairs of each packed request in a batch file, as pack id -> list of
+# [id, correct answer, answer to grade]
+def get_packs_filename(filename:str) -> str:
+    return filename[:-len(".jsonl")] + "_packs.json"
+
+def write_packs(filename:str, packs:dict):
+    with open(get_packs_filename(filename), "w", encoding="utf-8") as f:
+        json.dump(packs, f)
+
+def read_packs(filename:str) -> dict:
+    with open(get_packs_filename(filename), "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,29 @@
+# Tests of the local step-cloze grading (run with python -m pytest)
+import similarity_utils
+
+CORRECT_STEP = "The taxpayer sells the appreciated stock to the foreign trust in exchange for an installment note " + \
+    "and defers recognizing the gain until the note is paid."
+
+def test_verbatim_copies_get_a_3():
+    assert similarity_utils.grade_locally(CORRECT_STEP, CORRECT_STEP)[0] == 3
+    assert similarity_utils.grade_locally(CORRECT_STEP, CORRECT_STEP.upper().rstrip("."))[0] == 3
+    assert similarity_utils.grade_locally(CORRECT_STEP, CORRECT_STEP.replace("for an installment", "for installment"))[0] == 3
+
+def test_one_word_substitutions_need_the_critic():
+    for old, new in [("foreign", "domestic"), ("defers recognizing", "recognizes"), ("defers", "accelerates"),
+                     ("sells", "gifts"), ("to the foreign trust", "from the foreign trust"), ("is paid", "is not paid")]:
+        assert old in CORRECT_STEP
+        assert similarity_utils.grade_locally(CORRECT_STEP, CORRECT_STEP.replace(old, new))[0] is None, new
+
+def test_deferring_versus_recognizing_needs_the_critic():
+    assert similarity_utils.grade_locally("The partnership distributes the property, deferring the gain.",
+                                          "The partnership distributes the property, recognizing the gain.")[0] is None
+
+def test_swapped_parties_need_the_critic():
+    assert similarity_utils.grade_locally("The parent buys the shares from the subsidiary.",
+                                          "The subsidiary buys the shares from the parent.")[0] is None
+
+def test_missing_or_unrelated_answers_get_a_0():
+    assert similarity_utils.grade_locally(CORRECT_STEP, "")[0] == 0
+    assert similarity_utils.grade_locally(CORRECT_STEP, similarity_utils.NO_ANSWER)[0] == 0
+    assert similarity_utils.grade_locally(CORRECT_STEP, "Hire a lawyer.")[0] == 0
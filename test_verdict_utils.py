@@ -0,0 +1,42 @@
+# Tests of the local Yes/No verdict extraction (run with python -m pytest)
+import verdict_utils
+
+def check(response:str, verdict, min_confidence:float = None):
+    extracted, confidence, rule = verdict_utils.extract_verdict(response)
+    assert extracted == verdict, (response, extracted, confidence, rule)
+    if min_confidence is not None:
+        assert confidence >= min_confidence, (response, confidence, rule)
+
+def test_clear_verdicts():
+    check("Yes", True, 1.0)
+    check("**No.**", False, 1.0)
+    check("The trust is a grantor trust.\n\n**Answer: Yes**", True, verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE)
+    check("Under section 1031 the exchange fails.\n\nFinal answer - no.", False, verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE)
+    check("Yes, because the stock is held for more than a year.", True, verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE)
+
+def test_bare_first_line_is_an_opening_verdict():
+    check("Yes\nThe stock is held for more than a year.", True, verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE)
+    check("Yes\nNo", None)
+
+def test_negated_verdicts_are_not_resolved():
+    check("I would not say the answer is yes.", None)
+    check("I don't think the answer is no.", None)
+    check("Yes.\nIt never holds, so the answer is yes.", None)
+
+def test_both_verdicts_are_not_resolved():
+    check("No. Actually, on reflection, yes, it does.", None)
+    check("No - well, yes.", None)
+    check("Yes, the gain is deferred.\n\nAnswer: No", None)
+
+def test_incidental_yes_or_no_is_not_a_verdict():
+    check("There is no basis for recognizing the gain, and no election is needed.\n\n**Answer: Yes**", True,
+          verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE)
+    check("Yes, because no gain is recognized on the exchange.", True, verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE)
+    check("The shareholders vote yes on the merger, but the step transaction doctrine applies.\n\nAnswer: No", False,
+          verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE)
+
+def test_unclear_responses_are_not_resolved():
+    check("It depends on the facts; there are arguments either way.", None)
+    check(None, None)
+    assert verdict_utils.extract_verdict("Yes, although it depends on the facts.")[1] < \
+        verdict_utils.LOCAL_VERDICT_MIN_CONFIDENCE
@@ -1,4 +1,4 @@
-import os
+import os, json, hashlib
 
 IGNORE_DOCTRINES_PROMPT_TEXT = "Do **NOT** consider the " + \
         "application of any tax-law judicial doctrines like substance-over-form, " + \
@@ -6,36 +6,56 @@ IGNORE_DOCTRINES_PROMPT_TEXT = "Do **NOT** consider the " + \
 
 FREEFORM_DIR = "FreeformOutputsGraded"
 
+# Parsed strategies are compiled once into a JSON sidecar named by the hash of the strategy file's
+# contents, so later stages (and later runs) can load them without re-parsing.  Bump the version
+# whenever the parsed output changes, so that stale sidecars are never picked up.
+DIR_COMPILED = "Strategies_Compiled/"
+COMPILED_FORMAT_VERSION = "3"
+_parsed_cache = {} # filename -> ((mtime_ns, size), StrategyRecord); avoids even the hash within a process
+
+# The same authorities (e.g. I.R.C. § 671) appear in many strategies, so each authority's text is stored
+# once, content-addressed by its hash, both in memory and on disk.  Strategies refer to them by id.
+DIR_AUTHORITIES = DIR_COMPILED + "authorities/"
+_authority_store = {} # authority id -> text
+
 def strip_numbering(in_str:str):
-    lines = [line.strip() for line in in_str.split("\n") if len(line.strip()) > 0]
-    for i in range(len(lines)):
-        assert lines[i].startswith(str(i+1)+") ") # ensure the line numbering is correct
-        lines[i] = lines[i][len(str(i+1)+") "):] # strip the line numbering
-    return lines
+    return list(strip_numbering_lines(in_str.split("\n")))
+
+# Index of prefix -> filename for the strategies directory, built from a single directory scan and
+# rebuilt only when the directory's mtime changes (i.e., when a file is added, removed or renamed).
+_filename_index = {}
+_filename_index_mtime = None
+
+def get_filename_index() -> dict:
+    global _filename_index, _filename_index_mtime
+    mtime = os.stat("Strategies").st_mtime_ns
+    if mtime != _filename_index_mtime:
+        index = {}
+        with os.scandir("Strategies") as entries:
+            for entry in entries:
+                if entry.name.endswith(".txt") and "_" in entry.name and \
+                        get_prefix_from_filename(entry.name).isnumeric():
+                    prefix = get_prefix_from_filename(entry.name)
+                    assert prefix not in index, "Two strategy files with prefix " + prefix
+                    index[prefix] = entry.name
+        _filename_index = index
+        _filename_index_mtime = mtime
+    return _filename_index
 
 # Given the prefix, find the filename
 def get_filename_from_prefix(prefix:str):
-    for filename in os.listdir("Strategies"):
-        if filename.startswith(str(prefix) + "_") and filename.endswith(".txt"):
-            return filename
-    return None
+    return get_filename_index().get(str(prefix))
 
 # Given the filename, find the prefix
 def get_prefix_from_filename(filename:str):
     assert "_" in filename
     return filename.split("_")[0]
 
-# Gets a list of the filenames, sorted by index (i.e., 1_ first, then 2_, ... )
+# Gets a list of the filenames, sorted by index (i.e., 1_ first, then 2_, ... ).  The numbering may be
+# sparse (e.g., 1, 11, 17, 31, 34), so every strategy file is returned, not just those up to the first gap.
 def get_list_filenames():
-    rv = []
-    prefix = 1
-    while True:
-        filename = get_filename_from_prefix(str(prefix))
-        if filename is None:
-            return rv
-        else:
-            rv.append(filename)
-        prefix += 1
+    index = get_filename_index()
+    return [index[prefix] for prefix in sorted(index, key=int)]
 
 
 def replace_adversarial_step(strategy_str:str, adversarial_step_str:str) -> str:
@@ -43,12 +63,7 @@ def replace_adversarial_step(strategy_str:str, adversarial_step_str:str) -> str:
     strategy_lines = strip_numbering(strategy_str)
     assert len(strategy_lines) >= 2, "expected at least two steps in real strategy"
 
-    adversarial_step_num = -1
-    assert adversarial_step_str[0].isnumeric()
-    if adversarial_step_str[1].isnumeric(): # handle steps 10 thru 99
-        adversarial_step_num = int(adversarial_step_str[0:2])
-    else:
-        adversarial_step_num = int(adversarial_step_str[0])
+    adversarial_step_num = get_adversarial_step_num(adversarial_step_str)
     assert 1 <= adversarial_step_num <= len(strategy_lines), "False strategy step should be to replace one of the existing ones"
 
     # If first step
@@ -65,54 +80,241 @@ def replace_adversarial_step(strategy_str:str, adversarial_step_str:str) -> str:
         idx_end = strategy_str.find("\n" + str(adversarial_step_num+1) + ")")
         return strategy_str[0:idx_start + 1] + adversarial_step_str.strip() + strategy_str[idx_end:]
 
+PRIMARY_AREAS = ["Income Tax", "Partnership", "International", "Corporate", "Employee Benefits"]
+# These strategies are the three set out by Joseph E. Stiglitz, “The General Theory of Tax Avoidance,”
+# 38 National Tax J. 325-337 (Sept. 1985), plus a fourth "Legal Cleverness" that Stiglitz, as a
+# non-lawyer did not appreciate and discuss.
+STRATEGY_TYPES = ["Arbitrage Between Taxpayers", "Arbitrage Between Rates", "Deferral", "Legal Cleverness"]
+
+# The section headers of a strategy file, in the order they must appear, each at the start of a line.
+# The AUTHORITY header is kept as part of its section (there is one per authority); for all the others
+# the section text is whatever follows the header.
+SECTION_HEADERS = ["AUTHORITY", "BACKGROUND:", "GOALS:", "STRATEGY:",
+                   "ANALYSIS (the analysis numbering below does NOT correspond to the strategy step numbering above):",
+                   "ADVERSARIAL STRATEGY STEP(S):", "PRIMARY TAX-LAW AREA:", "STRATEGY TYPE:", "NOTES:"]
+
+# Compact, parsed form of one strategy file.  The numbered sections are pre-split (with the numbering
+# stripped) so that callers do not need to call strip_numbering again and again.
+class StrategyRecord:
+    __slots__ = ("filename", "authority_ids", "background_str", "goal_str", "strategy_str",
+                 "analysis_str", "adversarial_step_str", "primary_area_str", "strategy_type_str",
+                 "background_lines", "goals", "strategy_steps", "analysis_steps", "adversarial_step_num")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    # The text of each authority, without its "AUTHORITY n:" label
+    @property
+    def authorities(self) -> list:
+        return [get_authority(authority_id) for authority_id in self.authority_ids]
+
+    # The authorities as they appear in the strategy file; they are stored only once, in the authority store
+    @property
+    def authorities_str(self) -> str:
+        return "\n\n".join(["AUTHORITY " + str(i+1) + ": " + authority for i, authority in enumerate(self.authorities)])
+
+    @property
+    def prefix(self) -> str:
+        return get_prefix_from_filename(self.filename)
+
+    @property
+    def num_strategy_steps(self) -> int:
+        return len(self.strategy_steps)
+
+    # The 8-tuple historically returned by parse_file
+    def as_tuple(self):
+        return self.authorities_str, self.background_str, self.goal_str, self.strategy_str, self.analysis_str, \
+            self.adversarial_step_str, self.primary_area_str, self.strategy_type_str
+
+    def to_json(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_json(cls, fields:dict):
+        fields = {name: tuple(value) if type(value) == list else value for name, value in fields.items()}
+        return cls(**fields)
+
+# Adds an authority's text to the store (in memory and on disk), returning its id
+def intern_authority(authority:str) -> str:
+    authority_id = hashlib.sha256(authority.encode("utf-8")).hexdigest()
+    if authority_id not in _authority_store:
+        authority_filename = DIR_AUTHORITIES + authority_id + ".txt"
+        if not os.path.exists(authority_filename):
+            os.makedirs(DIR_AUTHORITIES, exist_ok=True)
+            tmp_filename = authority_filename + "." + str(os.getpid()) + ".tmp"
+            with open(tmp_filename, "w", encoding="utf-8") as f:
+                f.write(authority)
+            os.replace(tmp_filename, authority_filename)
+        _authority_store[authority_id] = authority
+    return authority_id
+
+# Gets an authority's text by id, loading it from disk the first time it is needed
+def get_authority(authority_id:str) -> str:
+    authority = _authority_store.get(authority_id)
+    if authority is None:
+        with open(DIR_AUTHORITIES + authority_id + ".txt", "r", encoding="utf-8") as f:
+            authority = f.read()
+        _authority_store[authority_id] = authority
+    return authority
+
+# Either records a problem found in a strategy file (if collecting them, e.g. when validating the whole
+# corpus) or fails right away.  Line numbers are 1-indexed; section is the header of the enclosing section.
+def report_problem(problems, line_num, section:str, message:str):
+    if problems is None:
+        assert False, "line " + str(line_num) + " (" + section + "): " + message
+    problems.append({"line": line_num, "section": section, "message": message})
+
+# Splits the authorities section into the text of each authority, without the "AUTHORITY n:" labels.
+# Each authority is stripped, so authorities_str always has exactly one blank line between authorities.
+def split_authorities(authorities_lines, problems=None, first_line_num=1) -> list:
+    authorities = []
+    for idx, line in enumerate(authorities_lines):
+        if line.startswith("AUTHORITY"):
+            label = "AUTHORITY " + str(len(authorities)+1) + ":"
+            if not line.startswith(label):
+                report_problem(problems, first_line_num + idx, "AUTHORITY", "expected " + label)
+                label = line.split(":")[0] + ":"
+            authorities.append([line[len(label):]])
+        else:
+            authorities[-1].append(line)
+    return ["\n".join(authority_lines).strip() for authority_lines in authorities]
+
+# Like strip_numbering, but on lines that have already been split out
+def strip_numbering_lines(lines, problems=None, first_line_num=1, section="") -> tuple:
+    rv = []
+    for idx, line in enumerate(lines):
+        line = line.strip()
+        if len(line) > 0:
+            numbering = str(len(rv)+1) + ") "
+            if not line.startswith(numbering): # ensure the line numbering is correct
+                report_problem(problems, first_line_num + idx, section, "expected line numbered " + numbering.strip())
+            rv.append(line[len(numbering):]) # strip the line numbering
+    return tuple(rv)
+
+# The adversarial step begins with the number of the strategy step it replaces (e.g. "4) FP is given ...")
+def get_adversarial_step_num(adversarial_step_str:str) -> int:
+    assert adversarial_step_str[0].isnumeric()
+    if adversarial_step_str[1].isnumeric(): # handle steps 10 thru 99
+        return int(adversarial_step_str[0:2])
+    else:
+        return int(adversarial_step_str[0])
+
+# Loads the parsed strategy for a filename, using the compiled cache when possible
+def load_strategy(filename) -> StrategyRecord:
+    path = "Strategies/" + filename
+    stat = os.stat(path)
+    file_key = (stat.st_mtime_ns, stat.st_size)
+    cached = _parsed_cache.get(filename)
+    if cached is not None and cached[0] == file_key:
+        return cached[1]
+
+    with open(path, "r") as f:
+        in_str = f.read()
+    digest = hashlib.sha256((COMPILED_FORMAT_VERSION + "\n" + in_str).encode("utf-8")).hexdigest()
+    compiled_filename = DIR_COMPILED + digest + ".json"
+    if os.path.exists(compiled_filename):
+        with open(compiled_filename, "r", encoding="utf-8") as f:
+            record = StrategyRecord.from_json(json.load(f))
+        record.filename = filename # the same contents may have been compiled under another name
+    else:
+        record = parse_text(in_str, filename)
+        os.makedirs(DIR_COMPILED, exist_ok=True)
+        tmp_filename = compiled_filename + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            json.dump(record.to_json(), f, ensure_ascii=False)
+        os.replace(tmp_filename, compiled_filename) # atomic, so concurrent stages never see half a file
+
+    _parsed_cache[filename] = (file_key, record)
+    return record
+
 # We open the file and get the relevant portions of it out
 def parse_file(filename):
-    in_str = open("Strategies/" + filename, "r").read()
-    first_authority_idx = in_str.find("\nAUTHORITY")
-    assert first_authority_idx > 0, "expected AUTHORITY"
-    background_idx = in_str.find("\nBACKGROUND:")
-    assert background_idx > 0, "expected BACKGROUND"
-    goal_idx = in_str.find("\nGOALS:")
-    assert goal_idx > 0, "expected GOALS"
-    strategy_idx = in_str.find("\nSTRATEGY:")
-    assert strategy_idx > 0, "expected STRATEGY"
-    analysis_header = "\nANALYSIS (the analysis numbering below does NOT correspond to the strategy step numbering above):"
-    analysis_idx = in_str.find(analysis_header)
-    assert analysis_idx > 0, "expected ANALYSIS"
-    adversarial_step_header = "\nADVERSARIAL STRATEGY STEP(S):"
-    adversarial_step_idx = in_str.find(adversarial_step_header)
-    assert adversarial_step_idx > 0, "expected FALSE STRATEGY STEP(S)"
-    primary_area_idx = in_str.find("\nPRIMARY TAX-LAW AREA:")
-    assert primary_area_idx > 0, "expected PRIMARY TAX-LAW AREA"
-    strategy_type_idx = in_str.find("\nSTRATEGY TYPE:")
-    assert strategy_type_idx > 0, "expected STRATEGY TYPE"
-    notes_idx = in_str.find("\nNOTES:")
-    assert first_authority_idx < background_idx < goal_idx < strategy_idx \
-           < analysis_idx < adversarial_step_idx < primary_area_idx < strategy_type_idx < notes_idx
-    authorities_str = in_str[first_authority_idx:background_idx].strip()
-    background_str = in_str[background_idx+len("\nBACKGROUND:"):goal_idx].strip()
-    goal_str = in_str[goal_idx+len("\nGOALS:"):strategy_idx].strip()
-    strategy_str = in_str[strategy_idx+len("\nSTRATEGY:"):analysis_idx].strip()
-    analysis_str = in_str[analysis_idx+len(analysis_header):adversarial_step_idx].strip()
-    adversarial_step_str = in_str[adversarial_step_idx+len(adversarial_step_header):primary_area_idx].strip()
-    primary_area_str = in_str[primary_area_idx+len("\nPRIMARY TAX-LAW AREA:"):strategy_type_idx].strip()
-    assert primary_area_str in ["Income Tax", "Partnership", "International",
-                                "Corporate", "Employee Benefits"]
-    strategy_type_str = in_str[strategy_type_idx+len("\nSTRATEGY TYPE:"):notes_idx].strip()
-    # These strategies are the three set out by Joseph E. Stiglitz, “The General Theory of Tax Avoidance,”
-    # 38 National Tax J. 325-337 (Sept. 1985), plus a fourth "Legal Cleverness" that Stiglitz, as a
-    # non-lawyer did not appreciate and discuss.
-    assert strategy_type_str in ["Arbitrage Between Taxpayers", "Arbitrage Between Rates",
-                                 "Deferral", "Legal Cleverness"]
-
-    return authorities_str, background_str, goal_str, strategy_str, analysis_str, \
-        adversarial_step_str, primary_area_str, strategy_type_str
+    return load_strategy(filename).as_tuple()
+
+# Does the actual parsing of a strategy file's contents, in a single pass over its lines.  By default any
+# problem with the file's format fails right away; if a problems list is passed, every problem found is
+# added to it instead, and None is returned if there were any.
+def parse_text(in_str:str, filename:str, problems=None) -> StrategyRecord:
+    num_problems = 0 if problems is None else len(problems)
+    sections = [[] for _ in SECTION_HEADERS] # lines of each section
+    section_line_nums = [None for _ in SECTION_HEADERS] # line number of each section's header
+    idx_section = -1 # the section we are currently in; -1 is the title before the first AUTHORITY
+    lines = in_str.split("\n")
+    for line_num in range(2, len(lines)+1): # a header on the very first line is the title, not a header
+        line = lines[line_num-1]
+        for idx_header in range(idx_section+1, len(SECTION_HEADERS)):
+            if line.startswith(SECTION_HEADERS[idx_header]):
+                for idx_missing in range(idx_section+1, idx_header):
+                    report_problem(problems, line_num, SECTION_HEADERS[idx_header],
+                                   "expected " + SECTION_HEADERS[idx_missing] + " before this")
+                idx_section = idx_header
+                section_line_nums[idx_section] = line_num
+                if idx_section > 0: # the AUTHORITY header stays part of the authorities
+                    line = line[len(SECTION_HEADERS[idx_section]):]
+                break
+        if idx_section >= 0:
+            sections[idx_section].append(line)
+    for idx_missing in range(idx_section+1, len(SECTION_HEADERS)):
+        report_problem(problems, len(lines), SECTION_HEADERS[idx_missing],
+                       "expected " + SECTION_HEADERS[idx_missing] + " by the end of the file")
+
+    authorities_lines, background_lines, goal_lines, strategy_lines, analysis_lines, \
+        adversarial_step_lines, primary_area_lines, strategy_type_lines, _ = sections
+    authority_line_num, background_line_num, goal_line_num, strategy_line_num, analysis_line_num, \
+        adversarial_step_line_num, primary_area_line_num, strategy_type_line_num, _ = section_line_nums
+
+    primary_area_str = "\n".join(primary_area_lines).strip()
+    if primary_area_line_num is not None and primary_area_str not in PRIMARY_AREAS:
+        report_problem(problems, primary_area_line_num, SECTION_HEADERS[6], "unknown area " + primary_area_str)
+    strategy_type_str = "\n".join(strategy_type_lines).strip()
+    if strategy_type_line_num is not None and strategy_type_str not in STRATEGY_TYPES:
+        report_problem(problems, strategy_type_line_num, SECTION_HEADERS[7], "unknown type " + strategy_type_str)
+
+    authorities = split_authorities(authorities_lines, problems, authority_line_num)
+    background = strip_numbering_lines(background_lines, problems, background_line_num, SECTION_HEADERS[1])
+    goals = strip_numbering_lines(goal_lines, problems, goal_line_num, SECTION_HEADERS[2])
+    strategy_steps = strip_numbering_lines(strategy_lines, problems, strategy_line_num, SECTION_HEADERS[3])
+    analysis_steps = strip_numbering_lines(analysis_lines, problems, analysis_line_num, SECTION_HEADERS[4])
+
+    if strategy_line_num is not None and len(strategy_steps) < 2:
+        report_problem(problems, strategy_line_num, SECTION_HEADERS[3], "expected at least two strategy steps")
+
+    adversarial_step_str = "\n".join(adversarial_step_lines).strip()
+    adversarial_step_num = -1
+    if adversarial_step_line_num is not None:
+        if "\n" in adversarial_step_str:
+            report_problem(problems, adversarial_step_line_num, SECTION_HEADERS[5],
+                           "current code assumes a single adversarial step")
+        elif len(adversarial_step_str) < 2 or not adversarial_step_str[0].isnumeric():
+            report_problem(problems, adversarial_step_line_num, SECTION_HEADERS[5],
+                           "expected the number of the strategy step it replaces")
+        elif not 1 <= get_adversarial_step_num(adversarial_step_str) <= len(strategy_steps):
+            report_problem(problems, adversarial_step_line_num, SECTION_HEADERS[5],
+                           "should replace one of the " + str(len(strategy_steps)) + " strategy steps")
+        else:
+            adversarial_step_num = get_adversarial_step_num(adversarial_step_str)
+
+    if problems is not None and len(problems) > num_problems:
+        return None
+    return StrategyRecord(filename=filename,
+                          authority_ids=tuple(intern_authority(authority) for authority in authorities),
+                          background_str="\n".join(background_lines).strip(),
+                          goal_str="\n".join(goal_lines).strip(),
+                          strategy_str="\n".join(strategy_lines).strip(),
+                          analysis_str="\n".join(analysis_lines).strip(),
+                          adversarial_step_str=adversarial_step_str,
+                          primary_area_str=primary_area_str,
+                          strategy_type_str=strategy_type_str,
+                          background_lines=background,
+                          goals=goals,
+                          strategy_steps=strategy_steps,
+                          analysis_steps=analysis_steps,
+                          adversarial_step_num=adversarial_step_num)
 
 # This returns the number of strategy steps for a particular file
 def count_strategy_steps(filename):
-    _, _, _, strategy_str, _, _, _, _ = parse_file(filename)
-    strategy_lines = strip_numbering(strategy_str)
-    return len(strategy_lines)
+    return load_strategy(filename).num_strategy_steps
 
 # Used for step-cloze across batches
 def get_strategy_step_by_str(strategy_step_str:str) -> str:
@@ -122,12 +324,9 @@ def get_strategy_step_by_str(strategy_step_str:str) -> str:
     assert segs[2] == "Step"
     strategy_num = int(segs[1])
     step_num = int(segs[3])
-    strategy_file = get_filename_from_prefix(str(strategy_num))
-    _, _, _, strategy_str, _, _, _, _ = parse_file(strategy_file)
-    lines = [line.strip() for line in strategy_str.split("\n") if len(line.strip()) > 0]
-    filtered_lines = [line for line in lines if line.startswith(str(step_num)+")")]
-    assert len(filtered_lines) == 1
-    return filtered_lines[0][len(str(step_num))+1:].strip()
+    record = load_strategy(get_filename_from_prefix(str(strategy_num)))
+    assert 1 <= step_num <= record.num_strategy_steps
+    return record.strategy_steps[step_num-1].strip()
 
 
 # Used for step-cloze across batches
@@ -135,54 +334,3 @@ def make_strategy_step_str(strategy_num, step_num) -> str:
     return "Strategy_" + str(strategy_num) + \
             "_Step_" + str(step_num)
 
-
-# Running this file directly goes through and tabulates the area and strategy counts
-# for the dataset.
-if __name__ == "__main__":
-    count_files = 0
-    DIR = "./Strategies"
-    strategy_counts = dict()
-    primary_area_counts = dict()
-    background_steps = []
-    goal_steps = []
-    analysis_steps = []
-    strategy_steps = []
-    filenames = get_list_filenames()
-    total_num_steps = 0
-    print("{:<44} ".format("FILENAME"), "num strategy steps")
-
-    for filename in filenames:
-        assert os.path.isfile(DIR + "/" + filename)
-        assert filename.lower().endswith(".txt")
-
-        count_files += 1
-        _, background_str, goal_str, strategy_str, analysis_str, \
-           adversarial_step_str, primary_area_str, strategy_type_str = parse_file(filename)
-
-        primary_area_counts[primary_area_str] = 1 + primary_area_counts.get(primary_area_str, 0)
-        strategy_counts[strategy_type_str] = 1 + strategy_counts.get(strategy_type_str, 0)
-
-        num_strategy_steps = count_strategy_steps(filename)
-
-        print("{:<44} ".format(filename[:-4]), num_strategy_steps)
-        total_num_steps += num_strategy_steps
-
-        strategy_steps.append(num_strategy_steps)
-        background_steps.append(len(strip_numbering(background_str)))
-        goal_steps.append(len(strip_numbering(goal_str)))
-        analysis_steps.append(len(strip_numbering(analysis_str)))
-
-    print("Total steps:", total_num_steps)
-
-    print("Primary Area:")
-    for k, v in primary_area_counts.items():
-        print(k, "\t", v)
-    print("***")
-    print("Strategy Type:")
-    for k, v in strategy_counts.items():
-        print(k, "\t", v)
-
-    print("strategy_steps:", min(strategy_steps), max(strategy_steps), sum(strategy_steps)/36.0)
-    print("background_steps:", min(background_steps), max(background_steps), sum(background_steps)/36.0)
-    print("goal_steps:", min(goal_steps), max(goal_steps), sum(goal_steps)/36.0)
-    print("analysis_steps:", min(analysis_steps), max(analysis_steps), sum(analysis_steps)/36.0)
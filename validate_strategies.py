@@ -0,0 +1,94 @@
+# Validates every strategy file and tabulates the area, type and step-count statistics for the dataset.
+# Files are checked in parallel, and every problem in every file is reported (with its section and line
+# number), rather than stopping at the first malformed file.  Exits with status 1 if there were problems.
+import argparse, json, os, sys
+from concurrent.futures import ProcessPoolExecutor
+import utils
+
+parser = argparse.ArgumentParser(
+    description='Validates the strategy files and tabulates statistics about them')
+parser.add_argument('--json', required=False,
+                    help='file to write the statistics and problems to as JSON ("-" for stdout)')
+parser.add_argument('--workers', required=False, type=int, default=os.cpu_count(),
+                    help='number of worker processes')
+
+
+# Checks a single file, returning its problems and (if there are none) its statistics
+def check_file(filename:str) -> dict:
+    rv = {"filename": filename, "problems": []}
+    if not filename.split("_")[0].isnumeric():
+        rv["problems"].append({"line": None, "section": None,
+                               "message": "filename should start with the strategy number and _"})
+        return rv
+    with open("Strategies/" + filename, "r") as f:
+        in_str = f.read()
+    record = utils.parse_text(in_str, filename, rv["problems"])
+    rv["problems"].sort(key=lambda problem: problem["line"])
+    if record is not None:
+        rv["primary_area"] = record.primary_area_str
+        rv["strategy_type"] = record.strategy_type_str
+        rv["strategy_steps"] = record.num_strategy_steps
+        rv["background_steps"] = len(record.background_lines)
+        rv["goal_steps"] = len(record.goals)
+        rv["analysis_steps"] = len(record.analysis_steps)
+    return rv
+
+
+def min_max_mean(values:list) -> dict:
+    if len(values) == 0:
+        return {"min": None, "max": None, "mean": None}
+    return {"min": min(values), "max": max(values), "mean": sum(values)/float(len(values))}
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    # Every .txt file is checked, including any whose name would keep it out of utils.get_list_filenames()
+    filenames = sorted([filename for filename in os.listdir("Strategies") if filename.lower().endswith(".txt")],
+                       key=lambda x: (len(x.split("_")[0]), x)) # i.e., 1_ first, then 2_, ..., 10_, ...
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        chunksize = max(1, len(filenames) // (4 * args.workers))
+        results = list(executor.map(check_file, filenames, chunksize=chunksize))
+
+    good_results = [result for result in results if len(result["problems"]) == 0]
+    stats = {"num_files": len(results),
+             "num_malformed": len(results) - len(good_results),
+             "total_strategy_steps": sum([result["strategy_steps"] for result in good_results]),
+             "primary_area_counts": {},
+             "strategy_type_counts": {},
+             "files": {result["filename"]: result["strategy_steps"] for result in good_results},
+             "problems": [dict(filename=result["filename"], **problem)
+                          for result in results for problem in result["problems"]]}
+    for result in good_results:
+        stats["primary_area_counts"][result["primary_area"]] = 1 + stats["primary_area_counts"].get(result["primary_area"], 0)
+        stats["strategy_type_counts"][result["strategy_type"]] = 1 + stats["strategy_type_counts"].get(result["strategy_type"], 0)
+    for key in ["strategy_steps", "background_steps", "goal_steps", "analysis_steps"]:
+        stats[key] = min_max_mean([result[key] for result in good_results])
+
+    if args.json == "-":
+        json.dump(stats, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    else:
+        print("{:<44} ".format("FILENAME"), "num strategy steps")
+        for filename, num_strategy_steps in stats["files"].items():
+            print("{:<44} ".format(filename[:-4]), num_strategy_steps)
+        print("Total steps:", stats["total_strategy_steps"])
+        print("Primary Area:")
+        for k, v in stats["primary_area_counts"].items():
+            print(k, "\t", v)
+        print("***")
+        print("Strategy Type:")
+        for k, v in stats["strategy_type_counts"].items():
+            print(k, "\t", v)
+        for key in ["strategy_steps", "background_steps", "goal_steps", "analysis_steps"]:
+            print(key + ":", stats[key]["min"], stats[key]["max"], stats[key]["mean"])
+
+        for problem in stats["problems"]:
+            print("PROBLEM:", problem["filename"], "line", problem["line"], "(" + str(problem["section"]) + "):",
+                  problem["message"])
+        print("Num files =", stats["num_files"], "; num malformed =", stats["num_malformed"])
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(stats, f, indent=2, ensure_ascii=False)
+
+    sys.exit(1 if stats["num_malformed"] > 0 else 0)
@@ -0,0 +1,77 @@
+# This is a local extractor of Yes/No verdicts from the models' explanations, so that the clear cases need
+# not be sent back to the model just to ask "So the answer (just Yes or No) is:".  A verdict is only given
+# when the response states it unmistakably (e.g. a bare "Yes", a closing "**Answer: No**", or an opening
+# "Yes," with nothing later that contradicts it), along with a confidence and the rule that decided it.  Any
+# response that states both verdicts (e.g. "No.  Actually, on reflection, yes."), or negates its verdict
+# ("not ... the answer is yes"), is left to the model.  Only a "yes" or "no" in a verdict position counts as
+# stated, so an incidental "no" in the explanation ("no gain is recognized") does not.
+import re
+
+LOCAL_VERDICT_MIN_CONFIDENCE = 0.9 # below this, the model is asked to clarify
+
+# e.g. "Answer: Yes", "Final answer - **No**", "The answer is yes", "Verdict: NO."
+LABELED_VERDICT = re.compile(r"(?:answer|verdict|conclusion)\**(?:\s+is)?\s*[:\-–—]?\s*\**\s*(yes|no)\s*\**\s*(?:[.!]|$)",
+                             re.IGNORECASE | re.MULTILINE)
+BARE_VERDICT = re.compile(r"^[\s*_#>\-]*(yes|no)[\s*_.!]*$", re.IGNORECASE) # a line that is just the verdict
+OPENING_VERDICT = re.compile(r"^[\s*_#>]*(yes|no)\b[\s*_]*[,.:;!\-–—]", re.IGNORECASE)
+# e.g. "..., yes." or "No - well, ...": a verdict set off by punctuation on both sides
+INTERJECTED_VERDICT = re.compile(r"(?:^|[.!?;:,\-–—])[\s*_#>]*(yes|no)[\s*_]*(?:[,.!?;:\-–—]|$)",
+                                 re.IGNORECASE | re.MULTILINE)
+NEGATION = re.compile(r"\b(?:not|never)\b|n't\b", re.IGNORECASE)
+HEDGES = ["however", "but ", "although", "depends", "unclear", "uncertain", "not necessarily", "arguably",
+          "partially", "partly", "it is possible", "may or may not"]
+
+# Whether a verdict matched in text is negated earlier in its sentence, e.g. "I would not say the answer is yes"
+def is_negated(text:str, start:int) -> bool:
+    sentence_start = max([text.rfind(end, 0, start) for end in [".", "!", "?", "\n"]]) + 1
+    return NEGATION.search(text, sentence_start, start) is not None
+
+# The verdict that a line opens with (e.g. "Yes, because ..." or a bare "No"), or None
+def get_opening_verdict(line:str):
+    opening = OPENING_VERDICT.match(line) or BARE_VERDICT.match(line)
+    return None if opening is None else opening.group(1).lower()
+
+# The verdicts stated anywhere in a response: labeled ones, interjected ones, and those that lines open with
+def get_stated_verdicts(response:str, lines:list) -> set:
+    verdicts = set([match.group(1).lower() for match in LABELED_VERDICT.finditer(response)])
+    verdicts.update([match.group(1).lower() for match in INTERJECTED_VERDICT.finditer(response)])
+    verdicts.update([get_opening_verdict(line) for line in lines if get_opening_verdict(line) is not None])
+    return verdicts
+
+# Returns (verdict, confidence, rule), where verdict is True for yes, False for no, or None if the response
+# is not clear enough to decide locally
+def extract_verdict(response:str):
+    if response is None:
+        return None, 0.0, "no response"
+    stripped_response = response.strip().strip(".*").strip().lower()
+    if stripped_response in ["yes", "no"]:
+        return stripped_response == "yes", 1.0, "bare answer"
+
+    lines = [line for line in response.strip().split("\n") if len(line.strip()) > 0]
+    if len(lines) == 0:
+        return None, 0.0, "empty"
+    last_line = lines[-1]
+
+    # Whatever the rule, a response that states both (e.g. "No.  Actually, on reflection, yes") is not clear
+    if len(get_stated_verdicts(response, lines)) > 1:
+        return None, 0.0, "both verdicts appear"
+
+    # The verdict stated at the end is the one that counts
+    closing_matches = list(LABELED_VERDICT.finditer(last_line))
+    if any([is_negated(last_line, match.start()) for match in closing_matches]):
+        return None, 0.0, "negated verdict"
+    closing_verdicts = set([match.group(1).lower() for match in closing_matches])
+    if BARE_VERDICT.match(last_line):
+        closing_verdicts.add(BARE_VERDICT.match(last_line).group(1).lower())
+    if len(closing_verdicts) == 1:
+        return closing_verdicts.pop() == "yes", 0.95, "closing verdict"
+
+    # Otherwise, an opening verdict counts if the rest of the response does not hedge or negate it
+    opening_verdict = get_opening_verdict(lines[0])
+    if opening_verdict is not None:
+        if any([is_negated(response, match.start()) for match in LABELED_VERDICT.finditer(response)]):
+            return None, 0.0, "negated verdict"
+        if any([hedge in response.lower() for hedge in HEDGES]):
+            return opening_verdict == "yes", 0.7, "opening verdict, with hedging"
+        return opening_verdict == "yes", 0.9, "opening verdict"
+    return None, 0.0, "no clear verdict"